@@ -0,0 +1,38 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the status bar formatters (formatNumber, formatToDegrees).
+Usage: format_benchmark.py [number of calls, 100000 by default]
+
+Prerequisities:
+    Qt, QGIS
+
+License: GNU General Public License v2.0
+"""
+
+import os, sys, timeit
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), os.pardir, 'postgis_viewer' ) )
+import postgis_viewer
+
+
+def timeIt( label, statement, count ):
+    """ Print the mean time of statement (best of 3 runs) """
+    elapsed = min( timeit.repeat( statement, repeat=3, number=count ) )
+    print '%-30s %12.3f us/op' % ( label, elapsed * 1e6 / count )
+
+def main( argv ):
+    count = int( argv[ 1 ] ) if len( argv ) > 1 else 100000
+
+    formatNumber = postgis_viewer.formatNumber
+    formatToDegrees = postgis_viewer.formatToDegrees
+
+    print 'I: Formatter benchmark with %d calls' % count
+    timeIt( 'formatNumber (scale)', lambda: formatNumber( 2500000.0 ), count )
+    timeIt( 'formatNumber (projected)', lambda: formatNumber( -1234567.891 ), count )
+    timeIt( 'formatNumber (2 decimals)', lambda: formatNumber( 1234567.891, 2 ), count )
+    timeIt( 'formatNumber (other seps)', lambda: formatNumber( 1234567.891, 2, ' ', '.' ), count )
+    timeIt( 'formatToDegrees', lambda: formatToDegrees( -74.0817500 ), count )
+
+if __name__ == "__main__":
+    main( sys.argv )
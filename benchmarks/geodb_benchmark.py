@@ -0,0 +1,504 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the database code of the viewer and of the Fast SQL Layer plugin
+(postgis_utils.GeoDB) against a PostgreSQL/PostGIS stand-in.
+
+Usage: geodb_benchmark.py [options]
+
+Options:
+    --backend=auto|local|server|fake
+        local:  start a throwaway PostgreSQL cluster (initdb, pg_ctl) with PostGIS
+        server: use the server given by --host, --port, --user, --password, --dbname
+        fake:   replay the responses recorded with --record (or answer from the
+                synthetic tables if there is no recording), no database needed
+        auto:   local if initdb and psycopg2 are available, fake otherwise
+    --vector-tables=20 --raster-tables=5 --rows=10000 --runs=10
+    --record=<file>     Record the responses of a local/server run for the fake backend
+    --replay=<file>     Recorded responses for the fake backend
+    --output=<file>     Write the results as JSON (to stdout by default)
+    --no-prepare        Run the catalog queries of GeoDB without prepared statements
+
+Measured: GeoDB.list_geotables, get_table_rows, get_srid_from_geom, the catalog
+queries of the table advisor (get_table_fields, get_table_indexes and
+get_table_analyze_info), the layer
+detection of postgis_viewer.py (detectLayerType, needs Qt and QGIS, run through
+psycopg2) and the database part of a Fast SQL Layer run (a connection from the
+broker, the estimate, size and plan fingerprint of the query, its SRID). The fake
+backend measures the client side only.
+
+License: GNU General Public License v2.0
+"""
+
+import os, sys, re, time, json, getopt, imp, types, shutil, socket, tempfile, subprocess
+
+benchmarks_dir = os.path.dirname( os.path.abspath( __file__ ) )
+viewer_dir = os.path.join( benchmarks_dir, os.pardir, 'postgis_viewer' )
+plugin_dir = os.path.join( viewer_dir, 'plugins', 'FastSQLlayer' )
+
+bench_schema = 'geodb_bench'
+bench_srid = 3857
+synthetic_row_width = 40 # Bytes per row of the synthetic vector tables, as answered by the fake backend
+
+
+# A psycopg2 stand-in, answering with recorded responses or from the synthetic tables
+class FakeError( Exception ):
+    pass
+
+class FakeCursor:
+    def __init__( self, connection ):
+        self.connection = connection
+        self.rows = []
+        self.query = None
+
+    def execute( self, sql, params=None ):
+        self.query = sql = interpolate( sql, params )
+        self.rows = list( self.connection.respond( sql ) )
+
+    def fetchone( self ):
+        return self.rows.pop( 0 ) if self.rows else None
+
+    def fetchall( self ):
+        rows, self.rows = self.rows, []
+        return rows
+
+class FakeConnection:
+    server_version = 90400
+
+    def __init__( self, respond ):
+        self.respond = respond
+        self.closed = 0
+
+    def cursor( self ):
+        return FakeCursor( self )
+
+    def commit( self ):
+        pass
+
+    def rollback( self ):
+        pass
+
+    def set_isolation_level( self, level ):
+        pass
+
+    def close( self ):
+        self.closed = 1
+
+def fakePsycopg2( respond ):
+    """ Return a module with the part of psycopg2 used by GeoDB """
+    psycopg2 = types.ModuleType( 'psycopg2' )
+    psycopg2.Error = psycopg2.OperationalError = FakeError
+    psycopg2.connect = lambda dsn: FakeConnection( respond )
+    extensions = types.ModuleType( 'psycopg2.extensions' )
+    extensions.UNICODE = None
+    extensions.register_type = lambda typeObject: None
+    extensions.ISOLATION_LEVEL_AUTOCOMMIT = 0
+    extensions.ISOLATION_LEVEL_READ_COMMITTED = 1
+    psycopg2.extensions = extensions
+    return psycopg2
+
+def interpolate( sql, params ):
+    """ Return the statement sent by psycopg2 for sql and its parameters """
+    if params is None:
+        return sql
+    def literal( value ):
+        if value is None:
+            return 'NULL'
+        if isinstance( value, ( int, long, float ) ):
+            return str( value )
+        return "'%s'" % unicode( value ).replace( "'", "''" )
+    if isinstance( params, dict ):
+        return sql % dict( ( key, literal( value ) ) for key, value in params.items() )
+    return sql % tuple( literal( value ) for value in params )
+
+def normalize( sql ):
+    return ' '.join( sql.split() )
+
+class Recorder:
+    """ Wrap a psycopg2 module, recording the rows returned by each statement """
+    def __init__( self, psycopg2 ):
+        self.psycopg2 = psycopg2
+        self.responses = {}
+
+    def module( self ):
+        recorder = self
+        class RecordingCursor:
+            def __init__( self, cursor ):
+                self.cursor = cursor
+                self.rows = []
+            def execute( self, sql, params=None ):
+                self.cursor.execute( sql, params )
+                self.rows = self.cursor.fetchall() if self.cursor.description else []
+                recorder.responses[ normalize( self.cursor.query.decode( 'utf-8' ) ) ] = [ list( row ) for row in self.rows ]
+            def fetchone( self ):
+                return self.rows.pop( 0 ) if self.rows else None
+            def fetchall( self ):
+                rows, self.rows = self.rows, []
+                return rows
+        class RecordingConnection:
+            def __init__( self, connection ):
+                self.connection = connection
+            def cursor( self ):
+                return RecordingCursor( self.connection.cursor() )
+            def __getattr__( self, name ):
+                return getattr( self.connection, name )
+
+        module = types.ModuleType( 'psycopg2' )
+        module.__dict__.update( self.psycopg2.__dict__ )
+        module.connect = lambda dsn: RecordingConnection( self.psycopg2.connect( dsn ) )
+        return module
+
+    def save( self, fileName ):
+        f = open( fileName, 'w' )
+        try:
+            json.dump( self.responses, f, indent=1, sort_keys=True )
+        finally:
+            f.close()
+
+def replayResponder( fileName ):
+    """ Answer with the responses recorded with --record """
+    f = open( fileName )
+    try:
+        responses = json.load( f )
+    finally:
+        f.close()
+    def respond( sql ):
+        rows = responses.get( normalize( sql ) )
+        if rows is None:
+            raise FakeError( 'No recorded response for: ' + normalize( sql ) )
+        return [ tuple( row ) for row in rows ]
+    return respond
+
+def syntheticResponder( tables ):
+    """ Answer the statements of GeoDB and detectLayerType from the synthetic table list """
+    byName = dict( ( table[ 'name' ], table ) for table in tables )
+    def tableOf( sql ):
+        match = re.search( r"(?:r_table_name|table_name|f_table_name)\s*=\s*'([^']*)'", sql ) or \
+            re.search( r'from\s+"?\w+"?\."?(\w+)"?', sql, re.I )
+        return byName.get( match.group( 1 ) ) if match else None
+
+    prepared = {} # Statements of GeoDB._exec_catalog
+    def respond( sql ):
+        match = re.match( r'PREPARE (\w+) (?:\([^)]*\) )?AS (.*)', sql, re.S )
+        if match:
+            prepared[ match.group( 1 ) ] = match.group( 2 )
+            return []
+        match = re.match( r'EXECUTE (\w+)(?: \((.*)\))?$', sql, re.S )
+        if match:
+            args = re.findall( r"'(?:[^']|'')*'|[^,\s]+", match.group( 2 ) or '' )
+            sql = re.sub( r'\$(\d+)', lambda m: args[ int( m.group( 1 ) ) - 1 ], prepared[ match.group( 1 ) ] )
+        lower = normalize( sql ).lower()
+        table = tableOf( sql )
+        if "proname = 'postgis_version'" in lower:
+            return [ ( 1, ) ]
+        if "relname = 'geometry_columns'" in lower:
+            return [ ( 'geometry_columns', ) ]
+        if lower.startswith( 'select has_table_privilege' ):
+            return [ ( True, True, True, True ) ]
+        if lower.startswith( 'select pg_class.relname, pg_namespace.nspname' ):
+            rows = []
+            for t in tables:
+                geom = t[ 'geom' ] if t[ 'kind' ] == 'vector' else None
+                rows.append( ( t[ 'name' ], bench_schema, 'r', 'postgres', float( t[ 'rows' ] ),
+                    t[ 'rows' ] / 100 + 1, geom, 'POINT' if geom else None, 2 if geom else None,
+                    bench_srid if geom else None ) )
+            match = re.search( r'limit (\d+) offset (\d+)', lower )
+            if match:
+                rows = rows[ int( match.group( 2 ) ) : int( match.group( 2 ) ) + int( match.group( 1 ) ) ]
+            return rows
+        if lower.startswith( 'select count(*) from' ) and table:
+            return [ ( table[ 'rows' ], ) ]
+        if lower.startswith( 'explain (format json)' ) and table:
+            return [ ( json.dumps( [ { 'Plan':{ 'Node Type':'Seq Scan', 'Relation Name':table[ 'name' ],
+                'Plan Rows':table[ 'rows' ], 'Plan Width':synthetic_row_width } } ] ), ) ]
+        if lower.startswith( 'select count(*), coalesce(sum(pg_column_size(t.*)), 0)' ) and table:
+            return [ ( table[ 'rows' ], table[ 'rows' ] * synthetic_row_width ) ]
+        if lower.startswith( 'select getsrid' ):
+            return [ ( bench_srid, ) ]
+        if lower.startswith( 'select count(srid) from raster_columns' ):
+            return [ ( 1 if table and table[ 'kind' ] == 'raster' else 0, ) ]
+        if lower.startswith( 'select srid, r_raster_column from raster_columns' ):
+            return [ ( bench_srid, 'rast' ) ]
+        if 'from raster_overviews' in lower:
+            return []
+        if "udt_name = 'geometry'" in lower:
+            return [ ( table[ 'geom' ], ) ] if table and table[ 'kind' ] == 'vector' else []
+        if "udt_name = 'geography'" in lower:
+            return []
+        if lower.startswith( 'select srid from geometry_columns' ):
+            return [ ( bench_srid, ) ]
+        if lower.startswith( 'select' ): # Fast SQL Layer query
+            return []
+        raise FakeError( 'Unexpected statement: ' + normalize( sql ) )
+    return respond
+
+
+# QSqlQuery-like access to a DB-API cursor, to run detectLayerType through psycopg2
+class CursorValue:
+    def __init__( self, value ):
+        self.value = value
+
+    def toString( self ):
+        return '' if self.value is None else unicode( self.value )
+
+    def toBool( self ):
+        return bool( self.value )
+
+    def toInt( self ):
+        return ( int( self.value or 0 ), self.value is not None )
+
+    def toDouble( self ):
+        return ( float( self.value or 0 ), self.value is not None )
+
+    def isNull( self ):
+        return self.value is None
+
+class CursorQuery:
+    def __init__( self, connection, errorClass ):
+        self.connection = connection
+        self.errorClass = errorClass
+        self.rows = []
+        self.pos = -1
+
+    def exec_( self, sql ):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute( sql )
+            self.rows = cursor.fetchall()
+        except self.errorClass:
+            self.connection.rollback()
+            self.rows = []
+            self.pos = -1
+            return False
+        self.pos = -1
+        return True
+
+    def next( self ):
+        self.pos += 1
+        return self.pos < len( self.rows )
+
+    def first( self ):
+        self.pos = 0
+        return len( self.rows ) > 0
+
+    def value( self, i ):
+        return CursorValue( self.rows[ self.pos ][ i ] )
+
+
+# A throwaway PostgreSQL cluster
+class LocalPostgres:
+    """ Start a PostgreSQL cluster in a temporary directory, listening on a Unix socket """
+    def __init__( self ):
+        self.directory = None
+        self.bindir = self.findBindir()
+        self.port = None
+
+    def findBindir( self ):
+        for directory in os.environ.get( 'PATH', '' ).split( os.pathsep ):
+            if os.path.exists( os.path.join( directory, 'initdb' ) ):
+                return directory
+        try:
+            return subprocess.check_output( [ 'pg_config', '--bindir' ] ).strip()
+        except Exception:
+            return None
+
+    def available( self ):
+        return self.bindir is not None and os.path.exists( os.path.join( self.bindir, 'initdb' ) )
+
+    def start( self ):
+        self.directory = tempfile.mkdtemp( prefix='geodb_bench_' )
+        data = os.path.join( self.directory, 'data' )
+        s = socket.socket()
+        s.bind( ( '127.0.0.1', 0 ) )
+        self.port = s.getsockname()[ 1 ]
+        s.close()
+        devnull = open( os.devnull, 'w' )
+        subprocess.check_call( [ os.path.join( self.bindir, 'initdb' ), '-D', data, '-U', 'postgres',
+            '-A', 'trust' ], stdout=devnull, stderr=devnull )
+        subprocess.check_call( [ os.path.join( self.bindir, 'pg_ctl' ), '-D', data, '-w', '-l',
+            os.path.join( self.directory, 'log' ), '-o', '-p %d -k %s -c listen_addresses=' % (
+            self.port, self.directory ), 'start' ], stdout=devnull, stderr=devnull )
+        devnull.close()
+        return { 'host':self.directory, 'port':self.port, 'user':'postgres', 'password':'', 'dbname':'postgres' }
+
+    def stop( self ):
+        if self.directory:
+            subprocess.call( [ os.path.join( self.bindir, 'pg_ctl' ), '-D',
+                os.path.join( self.directory, 'data' ), '-m', 'fast', 'stop' ],
+                stdout=open( os.devnull, 'w' ) )
+            shutil.rmtree( self.directory, True )
+            self.directory = None
+
+
+def syntheticTables( vectorTables, rasterTables, rows ):
+    tables = [ { 'name':'vector_%03d' % i, 'kind':'vector', 'geom':'the_geom', 'rows':rows }
+        for i in range( vectorTables ) ]
+    tables += [ { 'name':'raster_%03d' % i, 'kind':'raster', 'geom':'rast', 'rows':max( rows / 1000, 1 ) }
+        for i in range( rasterTables ) ]
+    return tables
+
+def createTables( psycopg2, params, tables ):
+    """ Create the synthetic tables (points and 100x100 raster tiles) in a real database """
+    con = psycopg2.connect( conInfo( params ) )
+    con.set_isolation_level( 0 )
+    c = con.cursor()
+    c.execute( "CREATE EXTENSION IF NOT EXISTS postgis" )
+    try:
+        c.execute( "CREATE EXTENSION IF NOT EXISTS postgis_raster" ) # PostGIS 3
+    except psycopg2.Error:
+        pass
+    c.execute( 'DROP SCHEMA IF EXISTS %s CASCADE' % bench_schema )
+    c.execute( 'CREATE SCHEMA %s' % bench_schema )
+    for t in tables:
+        name = '%s.%s' % ( bench_schema, t[ 'name' ] )
+        if t[ 'kind' ] == 'vector':
+            c.execute( "CREATE TABLE %s AS SELECT g AS id, ST_SetSRID( ST_MakePoint( random() * 1000, \
+                random() * 1000 ), %d )::geometry(Point, %d) AS the_geom FROM generate_series( 1, %d ) g" % (
+                name, bench_srid, bench_srid, t[ 'rows' ] ) )
+            c.execute( "CREATE INDEX ON %s USING GIST( the_geom )" % name )
+        else:
+            c.execute( "CREATE TABLE %s AS SELECT g AS rid, ST_AddBand( ST_MakeEmptyRaster( 100, 100, \
+                ( g %% 100 ) * 100, ( g / 100 ) * 100, 1, -1, 0, 0, %d ), '8BUI'::text, 1, 0 ) AS rast \
+                FROM generate_series( 0, %d ) g" % ( name, bench_srid, t[ 'rows' ] - 1 ) )
+            c.execute( "SELECT AddRasterConstraints( '%s', '%s', 'rast' )" % ( bench_schema, t[ 'name' ] ) )
+        c.execute( "ANALYZE %s" % name )
+    con.close()
+
+def conInfo( params ):
+    return "host='%(host)s' port=%(port)s dbname='%(dbname)s' user='%(user)s' password='%(password)s'" % params
+
+
+def timeIt( label, function, items, runs, results ):
+    """ Time function( item ) for every item, runs times, storing the statistics in results """
+    times = []
+    for run in range( runs ):
+        for item in items:
+            start = time.time()
+            function( item )
+            times.append( ( time.time() - start ) * 1000 )
+    times.sort()
+    results[ label ] = { 'calls':len( times ), 'mean_ms':sum( times ) / len( times ),
+        'min_ms':times[ 0 ], 'median_ms':times[ len( times ) / 2 ], 'max_ms':times[ -1 ] }
+    print >> sys.stderr, '%-30s %12.3f ms/op' % ( label, results[ label ][ 'mean_ms' ] )
+
+def loadModule( name, directory ):
+    f, filename, description = imp.find_module( name, [ directory ] )
+    try:
+        return imp.load_module( name, f, filename, description )
+    finally:
+        if f:
+            f.close()
+
+def main( argv ):
+    opts = { '--backend':'auto', '--vector-tables':'20', '--raster-tables':'5', '--rows':'10000',
+        '--runs':'10', '--host':'localhost', '--port':'5432', '--user':'postgres', '--password':'',
+        '--dbname':'postgres' }
+    options, args = getopt.getopt( argv[ 1: ], '', [ 'backend=', 'vector-tables=', 'raster-tables=',
+        'rows=', 'runs=', 'host=', 'port=', 'user=', 'password=', 'dbname=', 'record=', 'replay=', 'output=',
+        'no-prepare' ] )
+    opts.update( options )
+    tables = syntheticTables( int( opts[ '--vector-tables' ] ), int( opts[ '--raster-tables' ] ),
+        int( opts[ '--rows' ] ) )
+    runs = int( opts[ '--runs' ] )
+
+    try:
+        import psycopg2
+    except ImportError:
+        psycopg2 = None
+    local = LocalPostgres()
+    backend = opts[ '--backend' ]
+    if backend == 'auto':
+        backend = 'local' if psycopg2 and local.available() else 'fake'
+
+    recorder = None
+    try:
+        if backend == 'fake':
+            respond = replayResponder( opts[ '--replay' ] ) if '--replay' in opts else syntheticResponder( tables )
+            sys.modules[ 'psycopg2' ] = fakePsycopg2( respond )
+            sys.modules[ 'psycopg2.extensions' ] = sys.modules[ 'psycopg2' ].extensions
+            params = { 'host':'localhost', 'port':5432, 'user':'postgres', 'password':'', 'dbname':'postgres' }
+        else:
+            if not psycopg2:
+                print >> sys.stderr, 'E: psycopg2 is needed for the %s backend' % backend
+                return 1
+            if backend == 'local':
+                print >> sys.stderr, 'I: Starting a local PostgreSQL cluster...'
+                params = local.start()
+            else:
+                params = { 'host':opts[ '--host' ], 'port':int( opts[ '--port' ] ), 'user':opts[ '--user' ],
+                    'password':opts[ '--password' ], 'dbname':opts[ '--dbname' ] }
+            print >> sys.stderr, 'I: Creating %d synthetic tables...' % len( tables )
+            createTables( psycopg2, params, tables )
+            if '--record' in opts:
+                recorder = Recorder( psycopg2 )
+                sys.modules[ 'psycopg2' ] = recorder.module()
+        psycopg2 = sys.modules[ 'psycopg2' ]
+
+        sys.path.insert( 0, viewer_dir ) # postgis_utils shares its connections through the broker, as in the viewer
+        postgis_utils = loadModule( 'postgis_utils', plugin_dir )
+        connect = lambda: postgis_utils.GeoDB( params[ 'host' ], int( params[ 'port' ] ),
+            params[ 'dbname' ], params[ 'user' ], params[ 'password' ], '--no-prepare' not in opts )
+        db = connect()
+        vector = [ t for t in tables if t[ 'kind' ] == 'vector' ]
+        results = {}
+        skipped = {}
+
+        timeIt( 'connect', lambda item: connect(), [ None ], runs, results )
+        timeIt( 'list_geotables', lambda item: db.list_geotables( bench_schema ), [ None ], runs, results )
+        timeIt( 'list_geotables_page', lambda item: db.list_geotables( bench_schema, 10, 0 ), [ None ], runs, results )
+        timeIt( 'get_table_rows', lambda t: db.get_table_rows( t[ 'name' ], bench_schema ), tables, runs, results )
+        timeIt( 'table_catalog', lambda t: ( db.get_table_fields( t[ 'name' ], bench_schema ),
+            db.get_table_indexes( t[ 'name' ], bench_schema ),
+            db.get_table_analyze_info( t[ 'name' ], bench_schema ) ), tables, runs, results )
+        timeIt( 'get_srid_from_geom', lambda t: db.get_srid_from_geom( t[ 'geom' ],
+            'SELECT * FROM %s.%s' % ( bench_schema, t[ 'name' ] ) ), vector, runs, results )
+
+        def fastSqlRun( t ):
+            """ The database part of PostgisLayer.runQuery and addQueryLayer (the layer itself
+                is loaded by QGIS)
+            """
+            query = 'SELECT * FROM %s.%s' % ( bench_schema, t[ 'name' ] )
+            with postgis_utils.shared_connection( params[ 'host' ], int( params[ 'port' ] ), params[ 'dbname' ],
+                    params[ 'user' ], params[ 'password' ] ) as runDb:
+                runDb.get_query_estimate( query )
+                runDb.get_query_size( query )
+                runDb.get_plan_fingerprint( query )
+                runDb.get_srid_from_geom( t[ 'geom' ], query )
+        timeIt( 'fast_sql_layer_run', fastSqlRun, vector, runs, results )
+        if postgis_utils.connections:
+            postgis_utils.connections.broker.closeAll()
+
+        try:
+            import postgis_viewer
+        except ( ImportError, SystemExit ), e:
+            skipped[ 'detect_layer_type' ] = 'postgis_viewer could not be imported (Qt and QGIS are needed)'
+        else:
+            def detect( t ):
+                dictOpts = { '-s':bench_schema, '-t':t[ 'name' ], '-g':'', 'type':'unknown', 'srid':'',
+                    'col':'', 'overviews':[] }
+                postgis_viewer.detectLayerType( dictOpts, CursorQuery( db.con, psycopg2.Error ) )
+            timeIt( 'detect_layer_type', detect, tables, runs, results )
+
+        db.con.close()
+        if recorder:
+            recorder.save( opts[ '--record' ] )
+    finally:
+        local.stop()
+
+    output = json.dumps( { 'backend':backend, 'replay':opts.get( '--replay' ), 'runs':runs,
+        'prepare':'--no-prepare' not in opts,
+        'tables':{ 'vector':int( opts[ '--vector-tables' ] ), 'raster':int( opts[ '--raster-tables' ] ),
+        'rows':int( opts[ '--rows' ] ) }, 'timestamp':time.time(), 'results':results,
+        'skipped':skipped }, indent=2, sort_keys=True )
+    if '--output' in opts:
+        f = open( opts[ '--output' ], 'w' )
+        try:
+            f.write( output + '\n' )
+        finally:
+            f.close()
+    else:
+        print output
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main( sys.argv ) )
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the legend with many layers (adding, toggling and looking up layers).
+Usage: legend_benchmark.py [number of layers, 1000 by default]
+
+Prerequisities:
+    Qt, QGIS
+
+License: GNU General Public License v2.0
+"""
+
+import os, sys, time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), os.pardir, 'postgis_viewer' ) )
+import postgis_viewer
+
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QApplication, QMainWindow
+from qgis.core import QgsApplication, QgsVectorLayer, QgsMapLayerRegistry
+from qgis.gui import QgsMapCanvas
+
+
+class LegendHost( QMainWindow ):
+    """ The part of ViewerWnd used by the legend """
+    def getLayerSRS( self, layer ):
+        return 'Unknown SRS (-1)'
+
+    def isOverviewLayer( self, layer ):
+        return False
+
+    def invalidateRenderCache( self ):
+        pass
+
+    def zoomToLayerExtent( self, layer, factor=1.0 ):
+        extent = layer.extent()
+        extent.scale( factor )
+        self.canvas.setExtent( extent )
+
+
+def timeIt( label, function, items ):
+    """ Print the mean time of function( item ) """
+    start = time.time()
+    for item in items:
+        function( item )
+    elapsed = time.time() - start
+    print '%-30s %12.1f us/op' % ( label, elapsed * 1e6 / max( len( items ), 1 ) )
+
+def main( argv ):
+    count = int( argv[ 1 ] ) if len( argv ) > 1 else 1000
+
+    app = QApplication( argv )
+    QgsApplication.setPrefixPath( postgis_viewer.qgis_prefix, True )
+    QgsApplication.initQgis()
+
+    host = LegendHost()
+    canvas = host.canvas = QgsMapCanvas()
+    canvas.freeze( True ) # Measure the legend, not the rendering
+    legend = postgis_viewer.Legend( host )
+    legend.setCanvas( canvas )
+
+    print 'I: Legend benchmark with %d layers' % count
+    # Half of the names are repeated, to exercise createUniqueName
+    layers = [ QgsVectorLayer( "Point", "layer %d" % ( i % ( count / 2 or 1 ) ), "memory" ) for i in range( count ) ]
+    timeIt( 'Add layer', QgsMapLayerRegistry.instance().addMapLayer, layers )
+
+    items = [ legend.topLevelItem( i ) for i in range( legend.topLevelItemCount() ) ]
+    timeIt( 'Look up layer by id', lambda item: legend.legendItem( item.layerId ), items )
+    timeIt( 'Next sibling', lambda item: item.nextSibling(), items )
+    timeIt( 'Create unique name', lambda item: legend.createUniqueName( item.text( 0 ) ), items )
+    timeIt( 'Hide layer', lambda item: item.setCheckState( 0, Qt.Unchecked ), items )
+    timeIt( 'Show layer', lambda item: item.setCheckState( 0, Qt.Checked ), items )
+    timeIt( 'Zoom to layer', legend.zoomToLegendLayer, items )
+    timeIt( 'Move layer', lambda item: legend.moveItem( item, items[ 0 ] ), items[ 1:100 ] )
+
+    QgsMapLayerRegistry.instance().removeAllMapLayers()
+    QgsApplication.exitQgis()
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Memory budget of the PostGIS Layer Viewer and its plugins.
+
+Layers whose data is fetched into the viewer (e.g., query layers of the Fast SQL
+Layer) are charged the size of their result, estimated up front from the plan
+(rows x width). A layer may use up to layer_budget bytes and all of them up to
+session_budget bytes; results that would exceed them are refused or loaded as
+a preview (see check()). The charge of a layer is kept as a custom property of
+it (bytes_property), shown in the legend, and released when it's removed.
+
+The budgets are set in MB by the POSTGIS_VIEWER_LAYER_BUDGET and
+POSTGIS_VIEWER_SESSION_BUDGET environment variables.
+
+License: GNU General Public License v2.0
+"""
+
+import os, threading
+
+def budgetFromEnvironment( variable, default ):
+    """ Return a budget in bytes from a variable in MB, or the default one """
+    try:
+        return int( float( os.environ[ variable ] ) * 1024 * 1024 )
+    except ( KeyError, ValueError ):
+        return default
+
+layer_budget = budgetFromEnvironment( "POSTGIS_VIEWER_LAYER_BUDGET", 256 * 1024 * 1024 )
+session_budget = budgetFromEnvironment( "POSTGIS_VIEWER_SESSION_BUDGET", 1024 * 1024 * 1024 )
+
+bytes_property = "postgis_viewer/bytes" # Custom property of the layers with the estimated bytes
+
+
+def formatBytes( bytes ):
+    """ Return a size in bytes as text (e.g., '12.3 MB') """
+    for unit in ( 'bytes', 'KB', 'MB' ):
+        if abs( bytes ) < 1024:
+            return ( "%d %s" if unit == 'bytes' else "%.1f %s" ) % ( bytes, unit )
+        bytes /= 1024.0
+    return "%.1f GB" % bytes
+
+
+class MemoryBudget:
+    """ Bytes charged to each layer of the session """
+    def __init__( self, layerBudget=layer_budget, sessionBudget=session_budget ):
+        self.layerBudget = layerBudget
+        self.sessionBudget = sessionBudget
+        self.lock = threading.Lock()
+        self.charges = {} # Layer id -> bytes
+
+    def used( self ):
+        with self.lock:
+            return sum( self.charges.values() )
+
+    def check( self, bytes ):
+        """ Return why a result of bytes can't be loaded ('layer' or 'session' budget exceeded),
+            or None if it fits
+        """
+        if bytes > self.layerBudget:
+            return 'layer'
+        if self.used() + bytes > self.sessionBudget:
+            return 'session'
+        return None
+
+    def available( self ):
+        """ Return the bytes a new layer may use """
+        return max( min( self.layerBudget, self.sessionBudget - self.used() ), 0 )
+
+    def charge( self, layer, bytes ):
+        """ Charge bytes to a layer (QgsMapLayer), keeping them in its bytes_property """
+        with self.lock:
+            self.charges[ unicode( layer.id() ) ] = bytes
+        layer.setCustomProperty( bytes_property, bytes )
+
+    def release( self, layerId ):
+        """ Release the bytes charged to a layer (e.g., once removed) """
+        with self.lock:
+            self.charges.pop( unicode( layerId ), None )
+
+
+session = MemoryBudget() # Shared by the viewer and its plugins
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Connection broker of the PostGIS Layer Viewer and its plugins.
+
+The connections opened to a database, i.e., a (host, port, dbname, user), by
+the viewer (QtSql) and the plugins (GeoDB) are bounded to max_connections at a
+time: once they're all in use, the next user waits for one to be released.
+Background threads leave one of them to the main thread, so that the GUI doesn't
+wait for long running work (e.g., creating raster overviews).
+Released connections are kept open, up to max_idle per database and kind, and
+handed to the next user of that kind instead of opening a new backend. Connections
+bound to the thread that opened them (e.g., QSqlDatabase) are only reused or
+closed by that thread: they don't count against the other threads, and only as
+many are kept idle as background threads leave to the main thread.
+
+Layers don't go through the broker: the QGIS PostGIS provider already shares one
+connection among the layers with the same connection info.
+
+License: GNU General Public License v2.0
+"""
+
+import threading, time
+from contextlib import contextmanager
+
+max_connections = 4 # Per database
+max_idle = 2 # Per database and kind
+acquire_timeout = 60 # Seconds to wait for a connection before giving up
+
+
+class BrokerError( Exception ):
+    pass
+
+
+def databaseKey( host, port, dbname, user ):
+    """ Return the key of a database in the broker """
+    return ( unicode( host or '' ), unicode( port or '' ), unicode( dbname or '' ), unicode( user or '' ) )
+
+
+class Broker:
+    """ Bound and share the connections to each database (see the module docstring) """
+    def __init__( self, maxConnections=max_connections, maxIdle=max_idle ):
+        self.maxConnections = maxConnections
+        self.maxIdle = maxIdle
+        self.condition = threading.Condition()
+        self.busy = {} # ( database, kind ) -> number of connections in use
+        self.idle = {} # ( database, kind ) -> [ ( connection, close, owner thread or None ) ]
+
+    def count( self, database, bUsableOnly=False ):
+        """ Return the number of connections open to a database. bUsableOnly: leave out
+            the idle ones bound to other threads
+        """
+        return sum( n for ( d, kind ), n in self.busy.items() if d == database ) + \
+            sum( len( [ entry for entry in idle if not bUsableOnly or self.usable( entry ) ] )
+                for ( d, kind ), idle in self.idle.items() if d == database )
+
+    def threadBoundIdle( self, database ):
+        """ Return the number of idle connections to a database bound to a thread """
+        return sum( len( [ entry for entry in idle if entry[ 2 ] is not None ] )
+            for ( d, kind ), idle in self.idle.items() if d == database )
+
+    def workerLimit( self ):
+        """ Return the number of connections to a database background threads may open """
+        return max( self.maxConnections - 1, 1 ) # One left to the main thread
+
+    def usable( self, entry ):
+        """ Check whether the current thread may use (or close) an idle connection """
+        return entry[ 2 ] is None or entry[ 2 ] is threading.current_thread()
+
+    def takeIdle( self, key ):
+        """ Remove and return an idle connection of a key usable by the current thread, or None """
+        for i, entry in enumerate( self.idle.get( key, [] ) ):
+            if self.usable( entry ):
+                return self.idle[ key ].pop( i )
+        return None
+
+    def closeIdle( self, database ):
+        """ Close an idle connection to a database (of any kind) the current thread may close,
+            return whether there was one
+        """
+        for ( d, kind ) in self.idle.keys():
+            if d == database:
+                entry = self.takeIdle( ( d, kind ) )
+                if entry:
+                    connection, close, owner = entry
+                    close( connection )
+                    return True
+        return False
+
+    def acquire( self, database, kind, connect, timeout=acquire_timeout ):
+        """ Return a connection of a kind to a database: an idle one, or connect() once
+            there are less than maxConnections. Give it back with release()
+        """
+        key = ( database, kind )
+        deadline = time.time() + timeout
+        limit = self.maxConnections
+        bUsableOnly = False
+        if not isinstance( threading.current_thread(), threading._MainThread ):
+            limit = self.workerLimit()
+            bUsableOnly = True # Idle connections of the main thread take the one left to it
+        with self.condition:
+            while True:
+                entry = self.takeIdle( key )
+                if entry:
+                    self.busy[ key ] = self.busy.get( key, 0 ) + 1
+                    return entry[ 0 ]
+                if self.count( database, bUsableOnly ) < limit or self.closeIdle( database ):
+                    self.busy[ key ] = self.busy.get( key, 0 ) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise BrokerError( ( u"All the %d connections to %s are in use" % (
+                        self.maxConnections, describe( database ) ) ).encode( 'utf-8' ) )
+                self.condition.wait( remaining )
+        try:
+            return connect() # Without the lock, it may take a while
+        except:
+            self.release( database, kind, None, None, False )
+            raise
+
+    def release( self, database, kind, connection, close, bReuse=True, bThreadBound=False ):
+        """ Give back a connection, kept for reuse if bReuse, closed with close( connection ) otherwise.
+            bThreadBound: only the current thread may reuse or close it
+        """
+        key = ( database, kind )
+        with self.condition:
+            self.busy[ key ] -= 1
+            idle = self.idle.setdefault( key, [] )
+            if bThreadBound and self.threadBoundIdle( database ) >= self.maxConnections - self.workerLimit():
+                bReuse = False # Beyond the connections left to the main thread
+            if bReuse and len( idle ) < self.maxIdle:
+                idle.append( ( connection, close, threading.current_thread() if bThreadBound else None ) )
+                connection = None
+            self.condition.notify_all() # Waiting threads may not be able to use it
+        if connection is not None:
+            close( connection )
+
+    @contextmanager
+    def connection( self, database, kind, connect, close, reusable=lambda connection: True, bThreadBound=False ):
+        """ With block with a connection (see acquire()), given back at the end. It's only
+            reused if the block succeeds and reusable( connection ) is True (see release())
+        """
+        connection = self.acquire( database, kind, connect )
+        bReuse = False
+        try:
+            yield connection
+            bReuse = reusable( connection )
+        finally:
+            self.release( database, kind, connection, close, bReuse, bThreadBound )
+
+    def stats( self ):
+        """ Return [ ( database, kind, connections in use, idle connections ) ] """
+        with self.condition:
+            keys = set( self.busy ) | set( self.idle )
+            return sorted( ( database, kind, self.busy.get( ( database, kind ), 0 ),
+                len( self.idle.get( ( database, kind ), [] ) ) ) for database, kind in keys )
+
+    def closeAll( self ):
+        """ Close the idle connections (e.g., on exit) """
+        with self.condition:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection, close, owner in connections:
+                close( connection )
+
+
+def describe( database ):
+    host, port, dbname, user = database
+    return "%s@%s:%s/%s" % ( user, host, port, dbname )
+
+broker = Broker() # Shared by the viewer and its plugins
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of the features of PostGIS vector layers for the PostGIS Layer Viewer.
+
+Features are cached by square tiles of a grid. Each zoom band has its own grid,
+whose tiles are 4 times as wide as the ones of the next band, so that a few bands
+cover all the scales and a view needs a handful of tiles (see tilesFor()). Only
+the tiles of a view missing in the cache have to be fetched from the database.
+
+Tiles expire after maxAge seconds, and the tiles of a layer are invalidated at
+once when its data changes (see invalidate()). The cache counts its hits and
+the bytes they saved fetching (see stats()).
+
+License: GNU General Public License v2.0
+"""
+
+import math, time, threading
+from collections import OrderedDict
+
+tile_pixels = 256 # Canvas pixels a tile spans at least
+
+
+def bandFor( mapUnitsPerPixel ):
+    """ Return the zoom band of a scale, i.e., the smallest one whose tiles span tile_pixels """
+    return int( math.ceil( math.log( max( mapUnitsPerPixel * tile_pixels, 1e-9 ), 4 ) ) )
+
+def tileSize( band ):
+    return 4.0 ** band
+
+def tilesFor( extent, mapUnitsPerPixel ):
+    """ Return the tiles ( band, column, row ) covering an extent ( xMin, yMin, xMax, yMax ) """
+    band = bandFor( mapUnitsPerPixel )
+    size = tileSize( band )
+    xMin, yMin, xMax, yMax = extent
+    return [ ( band, column, row )
+        for column in range( int( math.floor( xMin / size ) ), int( math.floor( xMax / size ) ) + 1 )
+        for row in range( int( math.floor( yMin / size ) ), int( math.floor( yMax / size ) ) + 1 ) ]
+
+def tileExtent( tile ):
+    """ Return the extent ( xMin, yMin, xMax, yMax ) of a tile """
+    band, column, row = tile
+    size = tileSize( band )
+    return ( column * size, row * size, ( column + 1 ) * size, ( row + 1 ) * size )
+
+
+class FeatureTileCache:
+    """ Size-bounded in-memory LRU cache of features by tiles
+
+        layerKey: Identifier of a layer (e.g., connection, schema, table, geometry column)
+        tile: ( band, column, row ) (see tilesFor())
+    """
+    def __init__( self, maxBytes, maxAge ):
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.lock = threading.Lock() # Tiles are stored from worker threads
+        self.tiles = OrderedDict() # ( layerKey, tile ) -> ( features, size, time ), LRU first
+        self.size = 0
+        self.layerSizes = {} # layerKey -> bytes of its cached tiles
+        self.hits = 0
+        self.misses = 0
+        self.bytesSaved = 0 # Bytes of the hits, not fetched again
+
+    def get( self, layerKey, tile ):
+        """ Return the features of a tile, None if it's not cached or expired """
+        key = ( layerKey, tile )
+        with self.lock:
+            entry = self.tiles.pop( key, None )
+            if entry and time.time() - entry[ 2 ] > self.maxAge:
+                self.forget( key, entry )
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.tiles[ key ] = entry # Most recently used
+            self.hits += 1
+            self.bytesSaved += entry[ 1 ]
+            return entry[ 0 ]
+
+    def put( self, layerKey, tile, features, size, maxLayerBytes=None, keepTiles=() ):
+        """ Store the features of a tile (of size bytes), evicting old tiles if needed.
+            With maxLayerBytes, the least recently used tiles of the layer but keepTiles (e.g.,
+            the ones being drawn) are evicted so that all its tiles fit in maxLayerBytes, and
+            the tile isn't stored (return False) if they can't
+        """
+        key = ( layerKey, tile )
+        with self.lock:
+            if key in self.tiles:
+                self.forget( key, self.tiles.pop( key ) )
+            if maxLayerBytes is not None:
+                keys = [ k for k in self.tiles if k[ 0 ] == layerKey and not k[ 1 ] in keepTiles ]
+                while keys and self.layerSizes.get( layerKey, 0 ) + size > maxLayerBytes:
+                    k = keys.pop( 0 )
+                    self.forget( k, self.tiles.pop( k ) )
+                if self.layerSizes.get( layerKey, 0 ) + size > maxLayerBytes:
+                    return False
+            self.tiles[ key ] = ( features, size, time.time() )
+            self.size += size
+            self.layerSizes[ layerKey ] = self.layerSizes.get( layerKey, 0 ) + size
+            while self.size > self.maxBytes and self.tiles:
+                self.forget( *self.tiles.popitem( last=False ) )
+            return True
+
+    def forget( self, key, entry ):
+        """ Account for the removal of a tile (key, entry) """
+        self.size -= entry[ 1 ]
+        self.layerSizes[ key[ 0 ] ] -= entry[ 1 ]
+        if not self.layerSizes[ key[ 0 ] ]:
+            del self.layerSizes[ key[ 0 ] ]
+
+    def layerSize( self, layerKey ):
+        """ Return the bytes of the cached tiles of a layer """
+        with self.lock:
+            return self.layerSizes.get( layerKey, 0 )
+
+    def invalidate( self, layerKey ):
+        """ Remove the tiles of a layer, e.g., when its data has changed """
+        with self.lock:
+            for key in list( self.tiles.keys() ):
+                if key[ 0 ] == layerKey:
+                    self.forget( key, self.tiles.pop( key ) )
+
+    def stats( self ):
+        """ Return ( hits, misses, hit ratio, bytes saved, bytes cached ) """
+        with self.lock:
+            requests = self.hits + self.misses
+            return ( self.hits, self.misses, float( self.hits ) / requests if requests else 0.0,
+                self.bytesSaved, self.size )
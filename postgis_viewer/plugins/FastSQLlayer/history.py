@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Query history of the Fast SQL Layer: the queries run on each database, with the
+time they took, the rows and bytes of their result (see GeoDB.get_query_size) and
+a fingerprint of their plan (see GeoDB.get_plan_fingerprint), stored in a SQLite
+database.
+"""
+import os, time, sqlite3
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+history_file = os.path.join(os.path.expanduser("~"), ".postgis_viewer", "fastsqllayer_history.sqlite")
+history_limit = 500 # Queries listed by the history dialog
+
+
+def normalize(query):
+    """ text of a query used to tell whether two runs are of the same query """
+    return " ".join(query.split()).rstrip(";").strip()
+
+
+class QueryHistory:
+    """ the history database. Runs are grouped by database and normalized query """
+
+    def __init__(self, path=history_file):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.con = sqlite3.connect(path)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS queries (
+                id INTEGER PRIMARY KEY,
+                database TEXT NOT NULL,
+                normalized TEXT NOT NULL,
+                query TEXT NOT NULL, -- text of the last run
+                last_run REAL NOT NULL,
+                UNIQUE (database, normalized) );
+            CREATE TABLE IF NOT EXISTS runs (
+                query_id INTEGER NOT NULL REFERENCES queries(id),
+                started REAL NOT NULL,
+                seconds REAL NOT NULL,
+                rows INTEGER,
+                bytes INTEGER,
+                plan TEXT );
+            CREATE INDEX IF NOT EXISTS runs_query ON runs (query_id, started); """)
+
+    def record(self, database, query, started, seconds, rows, bytes, plan):
+        """ add a run of a query """
+        normalized = normalize(query)
+        row = self.con.execute("SELECT id FROM queries WHERE database = ? AND normalized = ?",
+            (database, normalized)).fetchone()
+        if row:
+            query_id = row[0]
+            self.con.execute("UPDATE queries SET query = ?, last_run = ? WHERE id = ?", (query, started, query_id))
+        else:
+            query_id = self.con.execute("INSERT INTO queries (database, normalized, query, last_run) VALUES (?, ?, ?, ?)",
+                (database, normalized, query, started)).lastrowid
+        self.con.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)", (query_id, started, seconds, rows, bytes, plan))
+        self.con.commit()
+
+    def search(self, database, text=None, limit=history_limit):
+        """ queries of a database containing text, last run first:
+            (id, query, last run, runs, seconds, rows and bytes of the last run, number of plans) """
+        pattern = "%" + (text or "").replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+        return self.con.execute("""
+            SELECT q.id, q.query, q.last_run, COUNT(*), last.seconds, last.rows, last.bytes, COUNT(DISTINCT r.plan)
+            FROM queries q JOIN runs r ON r.query_id = q.id
+            JOIN runs last ON last.query_id = q.id AND last.started = q.last_run
+            WHERE q.database = ? AND q.normalized LIKE ? ESCAPE '!'
+            GROUP BY q.id ORDER BY q.last_run DESC LIMIT ?""", (database, pattern, limit)).fetchall()
+
+    def runs(self, query_id):
+        """ runs of a query, oldest first: (started, seconds, rows, bytes, plan) """
+        return self.con.execute("SELECT started, seconds, rows, bytes, plan FROM runs WHERE query_id = ? ORDER BY started",
+            (query_id,)).fetchall()
+
+    def close(self):
+        self.con.close()
+
+
+class TrendChart(QWidget):
+    """ execution time (and rows) of the runs of a query. Runs whose plan differs
+        from the previous one are marked in red """
+    margin = 6
+
+    def __init__(self, parent=None):
+        QWidget.__init__(self, parent)
+        self.runs = []
+        self.setMinimumHeight(100)
+
+    def setRuns(self, runs):
+        self.runs = runs
+        self.update()
+
+    def points(self, values, rect):
+        top = max(values) or 1
+        step = float(rect.width()) / max(len(values) - 1, 1)
+        return [QPointF(rect.left() + i * step, rect.bottom() - rect.height() * value / top)
+            for i, value in enumerate(values)]
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.fillRect(self.rect(), self.palette().color(QPalette.Base))
+        if not self.runs:
+            painter.drawText(self.rect(), Qt.AlignCenter, "Select a query to see its runs")
+            return
+        metrics = painter.fontMetrics()
+        rect = QRectF(self.rect()).adjusted(self.margin, self.margin + metrics.height(), -self.margin, -self.margin)
+        seconds = self.points([run[1] for run in self.runs], rect)
+        rows = self.points([run[2] or 0 for run in self.runs], rect)
+
+        painter.setPen(QPen(QColor(170, 170, 170), 1, Qt.DashLine))
+        painter.drawPolyline(QPolygonF(rows))
+        painter.setPen(QPen(QColor(40, 90, 170), 2))
+        painter.drawPolyline(QPolygonF(seconds))
+        for i, point in enumerate(seconds):
+            bPlanChanged = i > 0 and self.runs[i][4] != self.runs[i - 1][4]
+            painter.setBrush(QColor(200, 40, 40) if bPlanChanged else QColor(40, 90, 170))
+            painter.drawEllipse(point, 3, 3)
+
+        painter.setPen(self.palette().color(QPalette.Text))
+        painter.drawText(QPointF(self.margin, self.margin + metrics.ascent()),
+            "%d runs, %.3f s max, %d rows max (dashed). Red: plan changed" % (len(self.runs),
+            max(run[1] for run in self.runs), max(run[2] or 0 for run in self.runs)))
+
+
+class HistoryDialog(QDialog):
+    """ browse and search the queries run on a database. Emits loadQuery(QString, bool)
+        with the text of the chosen query and whether to run it """
+
+    def __init__(self, history, database, parent=None):
+        QDialog.__init__(self, parent)
+        self.history = history
+        self.database = database
+        self.setWindowTitle("Query history - " + database)
+        self.resize(700, 450)
+
+        self.searchEdit = QLineEdit()
+        self.searchEdit.setPlaceholderText("Search")
+        self.table = QTableWidget(0, 6)
+        self.table.setHorizontalHeaderLabels(["Query", "Last run", "Runs", "Time (s)", "Rows", "Plans"])
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setResizeMode(0, QHeaderView.Stretch)
+        self.chart = TrendChart()
+        buttons = QDialogButtonBox(QDialogButtonBox.Close)
+        self.buttonLoad = buttons.addButton("Load", QDialogButtonBox.ActionRole)
+        self.buttonRun = buttons.addButton("Run", QDialogButtonBox.ActionRole)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.searchEdit)
+        layout.addWidget(self.table, 2)
+        layout.addWidget(self.chart, 1)
+        layout.addWidget(buttons)
+
+        self.connect(self.searchEdit, SIGNAL("textChanged(QString)"), self.refresh)
+        self.connect(self.table, SIGNAL("itemSelectionChanged()"), self.showRuns)
+        self.connect(self.table, SIGNAL("itemDoubleClicked(QTableWidgetItem *)"), lambda item: self.choose(False))
+        self.connect(self.buttonLoad, SIGNAL("clicked()"), lambda: self.choose(False))
+        self.connect(self.buttonRun, SIGNAL("clicked()"), lambda: self.choose(True))
+        self.connect(buttons, SIGNAL("rejected()"), self.reject)
+        self.refresh()
+
+    def refresh(self, text=None):
+        """ list the queries matching the search text """
+        self.queries = self.history.search(self.database, unicode(self.searchEdit.text()))
+        self.table.setRowCount(len(self.queries))
+        for i, (query_id, query, last_run, runs, seconds, rows, bytes, plans) in enumerate(self.queries):
+            values = [normalize(query), time.strftime("%Y-%m-%d %H:%M", time.localtime(last_run)),
+                str(runs), "%.3f" % seconds, "" if rows is None else str(rows), str(plans)]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column == 0:
+                    item.setToolTip(query)
+                self.table.setItem(i, column, item)
+        self.table.resizeColumnsToContents()
+        self.table.horizontalHeader().setResizeMode(0, QHeaderView.Stretch)
+        self.showRuns()
+
+    def currentQuery(self):
+        rows = self.table.selectionModel().selectedRows()
+        return self.queries[rows[0].row()] if rows else None
+
+    def showRuns(self):
+        query = self.currentQuery()
+        self.chart.setRuns(self.history.runs(query[0]) if query else [])
+        self.buttonLoad.setEnabled(query is not None)
+        self.buttonRun.setEnabled(query is not None)
+
+    def choose(self, bRun):
+        query = self.currentQuery()
+        if query:
+            self.emit(SIGNAL("loadQuery(QString, bool)"), query[1], bRun)
+            self.accept()
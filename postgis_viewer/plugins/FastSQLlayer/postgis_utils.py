@@ -18,7 +18,17 @@ http://www.postgresql.org/docs/8.0/static/functions-info.html
 
 import psycopg2
 import psycopg2.extensions # for isolation levels
-import re
+import re, time, hashlib, json
+from contextlib import contextmanager
+
+try:
+	import tracing # round trips of the PostGIS Layer Viewer actions
+except ImportError:
+	tracing = None
+try:
+	import connections # connection broker of the PostGIS Layer Viewer
+except ImportError:
+	connections = None
 
 # use unicode!
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
@@ -54,8 +64,17 @@ class TableConstraint:
 class TableIndex:
 
 	def __init__(self, row):
-		self.name, columns = row
+		self.name, columns = row[:2]
 		self.columns = map(int, columns.split(' '))
+		self.method = row[2] if len(row) > 2 else None # Access method: btree, gist, ...
+
+
+class QueryColumn:
+	""" a column of a query result. table_oid, table_column: the table column it comes 
+		straight from (None if unknown, e.g. an expression or an old psycopg2) """
+
+	def __init__(self, name, data_type, table_oid=None, table_column=None):
+		self.name, self.data_type, self.table_oid, self.table_column = name, data_type, table_oid, table_column
 
 
 class TableTrigger:
@@ -84,6 +103,7 @@ class DbError(Exception):
 		# save error. funny that the variables are in utf8, not 
 		self.msg = unicode( error.args[0], 'utf-8')
 		self.a = error.args[0]
+		self.pgcode = getattr(error, "pgcode", None) # SQLSTATE
 		if hasattr(error, "cursor") and hasattr(error.cursor, "query"):
 			self.query = unicode(str(error.cursor.query), 'utf-8')
 		else:
@@ -114,9 +134,37 @@ class TableField:
 		return txt
 		
 
+class CatalogStatement:
+	""" a catalog query with named parameters (psycopg2 style, e.g. %(table)s), 
+		and the PREPARE and EXECUTE commands to run it as a prepared statement """
+
+	def __init__(self, name, params, sql):
+		self.sql = sql
+		# the name depends on the query, so that a session never has two statements with the same name
+		self.name = "geodb_%s_%s" % (name, hashlib.sha1(sql.encode('utf-8')).hexdigest()[:8])
+		positions = dict( (param, i + 1) for i, (param, data_type) in enumerate(params) )
+		body = re.sub(r'%\((\w+)\)s', lambda m: "$%d" % positions[m.group(1)], sql)
+		if params:
+			self.prepare_sql = "PREPARE %s (%s) AS %s" % (self.name, ", ".join(data_type for param, data_type in params), body)
+			self.execute_sql = "EXECUTE %s (%s)" % (self.name, ", ".join("%%(%s)s" % param for param, data_type in params))
+		else:
+			self.prepare_sql = "PREPARE %s AS %s" % (self.name, body)
+			self.execute_sql = "EXECUTE %s" % self.name
+
+# statement name -> CatalogStatement, shared by all connections (see GeoDB._exec_catalog)
+catalog_statements = {}
+
+# errors meaning that prepared statements can't be used on a connection, e.g. through
+# a pooler that runs each transaction in another session (pgbouncer in transaction mode):
+# invalid statement name (not prepared in this session), duplicate statement, feature not supported
+prepare_error_codes = ('26000', '42P05', '0A000')
+
+
 class GeoDB:
 	
-	def __init__(self, host=None, port=None, dbname=None, user=None, passwd=None):
+	def __init__(self, host=None, port=None, dbname=None, user=None, passwd=None, prepare=True):
+		""" prepare: run the catalog queries as prepared statements (see _exec_catalog). 
+			They are disabled by themselves if the server (or a pooler) doesn't support them """
 		
 		self.host = host
 		self.port = port
@@ -124,6 +172,9 @@ class GeoDB:
 		self.user = user
 		self.passwd = passwd
 		
+		# names of the statements prepared in this session, None when not preparing them
+		self.prepared = set() if prepare else None
+		
 		if self.dbname == '' or self.dbname is None:
 			self.dbname = self.user
 		
@@ -156,7 +207,7 @@ class GeoDB:
 	def check_postgis(self):
 		""" check whether postgis_version is present in catalog """
 		c = self.con.cursor()
-		self._exec_sql(c, "SELECT COUNT(*) FROM pg_proc WHERE proname = 'postgis_version'")
+		self._exec_catalog(c, 'check_postgis', [], "SELECT COUNT(*) FROM pg_proc WHERE proname = 'postgis_version'")
 		return (c.fetchone()[0] > 0)
 	
 	def get_postgis_info(self):
@@ -175,7 +226,7 @@ class GeoDB:
 	def check_geometry_columns_table(self):
 
 		c = self.con.cursor()
-		self._exec_sql(c, "SELECT relname FROM pg_class WHERE relname = 'geometry_columns' AND pg_class.relkind IN ('v', 'r')")
+		self._exec_catalog(c, 'geometry_columns', [], "SELECT relname FROM pg_class WHERE relname = 'geometry_columns' AND pg_class.relkind IN ('v', 'r')")
 		self.has_geometry_columns = (len(c.fetchall()) != 0)
 		
 		if not self.has_geometry_columns:
@@ -192,15 +243,16 @@ class GeoDB:
 		"""
 		c = self.con.cursor()
 		sql = "SELECT oid, nspname, pg_get_userbyid(nspowner), nspacl FROM pg_namespace WHERE nspname !~ '^pg_' AND nspname != 'information_schema'"
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'list_schemas', [], sql)
 
 		schema_cmp = lambda x,y: -1 if x[1] < y[1] else 1
 		
 		return sorted(c.fetchall(), cmp=schema_cmp)
 			
-	def list_geotables(self, schema=None):
+	def list_geotables(self, schema=None, limit=None, offset=0, name_filter=None):
 		"""
 			get list of tables with schemas, whether user has privileges, whether table has geometry column(s) etc.
+			in tuples: (relname, nspname, relkind, owner, reltuples, relpages, geometry column, type, coord_dimension, srid)
 			
 			geometry_columns:
 			- f_table_schema
@@ -209,52 +261,53 @@ class GeoDB:
 			- coord_dimension
 			- srid
 			- type
+			
+			limit, offset: page of the list (ordered by schema, table and column)
+			name_filter: only tables whose name contains it (case insensitive)
 		"""
 		c = self.con.cursor()
 		
-		if schema:
-			schema_where = " AND nspname = '%s' " % self._quote_str(schema)
-		else:
-			schema_where = " AND (nspname != 'information_schema' AND nspname !~ 'pg_') "
+		schema_where = """ AND (nspname = %(schema)s OR %(schema)s IS NULL AND nspname != 'information_schema' AND nspname !~ 'pg_')
+							AND (relname ILIKE %(pattern)s ESCAPE '!' OR %(pattern)s IS NULL) """
+		params = { 'schema' : schema or None, 'pattern' : None, 'limit' : limit, 'offset' : offset }
+		if name_filter:
+			params['pattern'] = '%' + name_filter.replace('!', '!!').replace('%', '!%').replace('_', '!_') + '%'
 			
 		# LEFT OUTER JOIN: like LEFT JOIN but if there are more matches, for join, all are used (not only one)
 		
 		# first find out whether postgis is enabled
 		if not self.has_postgis:
 			# get all tables and views
+			name = 'list_tables'
 			sql = """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, NULL, NULL, NULL, NULL
 							FROM pg_class
 							JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
 							WHERE pg_class.relkind IN ('v', 'r')""" + schema_where + "ORDER BY nspname, relname"
 		else:
-			# discovery of all tables and whether they contain a geometry column
-			sql = """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, pg_attribute.attname, pg_attribute.atttypid::regtype, NULL, NULL
+			# discovery of all tables and whether they contain a geometry column, 
+			# with the geometry info from geometry_columns (joined on schema, table and column) if exists
+			if self.has_geometry_columns and self.has_geometry_columns_access:
+				name = 'list_geotables'
+				geo_fields = "COALESCE(geometry_columns.type, pg_attribute.atttypid::regtype::text), geometry_columns.coord_dimension, geometry_columns.srid"
+				geo_join = """LEFT OUTER JOIN geometry_columns ON geometry_columns.f_table_schema = pg_namespace.nspname AND
+								geometry_columns.f_table_name = pg_class.relname AND geometry_columns.f_geometry_column = pg_attribute.attname"""
+			else:
+				name = 'list_geotables_without_geometry_columns'
+				geo_fields = "pg_attribute.atttypid::regtype, NULL, NULL"
+				geo_join = ""
+			sql = """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, pg_attribute.attname, %s
 							FROM pg_class
 							JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
-							LEFT OUTER JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND
+							LEFT OUTER JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND NOT pg_attribute.attisdropped AND
 									( pg_attribute.atttypid = 'geometry'::regtype
 										OR pg_attribute.atttypid IN (SELECT oid FROM pg_type WHERE typbasetype='geometry'::regtype ) )
-							WHERE pg_class.relkind IN ('v', 'r')""" + schema_where + "ORDER BY nspname, relname, attname"
-						  
-		self._exec_sql(c, sql)
-		items = c.fetchall()
+							%s
+							WHERE pg_class.relkind IN ('v', 'r')""" % (geo_fields, geo_join) + schema_where + "ORDER BY nspname, relname, attname"
 		
-		# get geometry info from geometry_columns if exists
-		if self.has_postgis and self.has_geometry_columns and self.has_geometry_columns_access:
-			sql = """SELECT relname, nspname, relkind, pg_get_userbyid(relowner), reltuples, relpages,
-							geometry_columns.f_geometry_column, geometry_columns.type, geometry_columns.coord_dimension, geometry_columns.srid
-							FROM pg_class
-						  JOIN pg_namespace ON relnamespace=pg_namespace.oid
-						  LEFT OUTER JOIN geometry_columns ON relname=f_table_name AND nspname=f_table_schema
-						  WHERE (relkind = 'r' or relkind='v') """ + schema_where + "ORDER BY nspname, relname, f_geometry_column"
-			self._exec_sql(c, sql)
-			
-			# merge geometry info to "items"
-			for i, geo_item in enumerate(c.fetchall()):
-				if geo_item[7]:
-					items[i] = geo_item
-			
-		return items
+		sql += " LIMIT %(limit)s OFFSET %(offset)s" # LIMIT NULL: all of them
+						  
+		self._exec_catalog(c, name, [('schema', 'text'), ('pattern', 'text'), ('limit', 'bigint'), ('offset', 'bigint')], sql, params)
+		return c.fetchall()
 	
 	
 	def get_table_rows(self, table, schema=None):
@@ -266,7 +319,6 @@ class GeoDB:
 	def get_table_fields(self, table, schema=None):
 		""" return list of columns in table """
 		c = self.con.cursor()
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT a.attnum AS ordinal_position,
 				a.attname AS column_name,
 				t.typname AS data_type,
@@ -281,11 +333,11 @@ class GeoDB:
 			JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
 			LEFT JOIN pg_attrdef adef ON adef.adrelid = a.attrelid AND adef.adnum = a.attnum
 			WHERE
-			  c.relname = '%s' %s AND
+			  c.relname = %(table)s AND (nspname = %(schema)s OR %(schema)s IS NULL) AND
 				a.attnum > 0
-			ORDER BY a.attnum""" % (self._quote_str(table), schema_where)
+			ORDER BY a.attnum"""
 
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'table_fields', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
 		attrs = []
 		for row in c.fetchall():
 			attrs.append(TableAttribute(row))
@@ -296,14 +348,13 @@ class GeoDB:
 		""" get info about table's indexes. ignore primary key and unique constraint index, they get listed in constaints """
 		c = self.con.cursor()
 		
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
-		sql = """SELECT relname, indkey FROM pg_class, pg_index
+		sql = """SELECT relname, indkey, (SELECT amname FROM pg_am WHERE pg_am.oid = pg_class.relam) FROM pg_class, pg_index
 						 WHERE pg_class.oid = pg_index.indexrelid AND pg_class.oid IN (
 						         SELECT indexrelid FROM pg_index, pg_class
 										 JOIN pg_namespace nsp ON pg_class.relnamespace = nsp.oid
-										 WHERE pg_class.relname='%s' %s AND pg_class.oid=pg_index.indrelid
-										 AND indisprimary != 't' )""" % (self._quote_str(table), schema_where) # AND indisunique != 't' 
-		self._exec_sql(c, sql)
+										 WHERE pg_class.relname=%(table)s AND (nspname=%(schema)s OR %(schema)s IS NULL) AND pg_class.oid=pg_index.indrelid
+										 AND indisprimary != 't' )""" # AND indisunique != 't' 
+		self._exec_catalog(c, 'table_indexes', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
 		indexes = []
 		for row in c.fetchall():
 			indexes.append(TableIndex(row))
@@ -312,32 +363,88 @@ class GeoDB:
 
 	def get_table_unique_indexes(self, table, schema=None):
 		""" get all the unique indexes """
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT relname, indkey 
 						FROM pg_index JOIN pg_class ON pg_index.indrelid=pg_class.oid 
 						JOIN pg_namespace nsp ON pg_class.relnamespace = nsp.oid 
-							WHERE pg_class.relname='%s' %s 
-							AND indisprimary != 't' AND indisunique = 't'""" % (self._quote_str(table), schema_where)
+							WHERE pg_class.relname=%(table)s AND (nspname=%(schema)s OR %(schema)s IS NULL) 
+							AND indisprimary != 't' AND indisunique = 't'"""
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'table_unique_indexes', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
 		uniqueIndexes = []
 		for row in c.fetchall():
 			uniqueIndexes.append(TableIndex(row))
 		return uniqueIndexes
 	
 	
+	def get_table_primary_key(self, table, schema=None):
+		""" column numbers of the primary key of a table, [] if it has none """
+		sql = """SELECT indkey FROM pg_index JOIN pg_class ON pg_index.indrelid=pg_class.oid 
+						JOIN pg_namespace nsp ON pg_class.relnamespace = nsp.oid 
+							WHERE pg_class.relname=%(table)s AND (nspname=%(schema)s OR %(schema)s IS NULL) 
+							AND indisprimary = 't'"""
+		c = self.con.cursor()
+		self._exec_catalog(c, 'table_primary_key', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
+		row = c.fetchone()
+		return map(int, row[0].split(' ')) if row else []
+
+	def get_table_name(self, oid):
+		""" (table, schema) of a table oid, None if there is no such table """
+		sql = """SELECT relname, nspname FROM pg_class JOIN pg_namespace nsp ON pg_class.relnamespace = nsp.oid
+						WHERE pg_class.oid = %(oid)s"""
+		c = self.con.cursor()
+		self._exec_catalog(c, 'table_name', [('oid', 'oid')], sql, { 'oid' : oid })
+		return c.fetchone()
+
+	def get_query_columns(self, query):
+		""" describe the result of a query, running it for no rows: list of QueryColumn """
+		c = self.con.cursor()
+		self._exec_sql(c, "SELECT * FROM (%s) AS foo LIMIT 0" % query)
+		description = c.description
+		self._exec_catalog(c, 'type_names', [('oids', 'oid[]')], "SELECT oid, typname FROM pg_type WHERE oid = ANY(%(oids)s)",
+			{ 'oids' : list(set(col[1] for col in description)) })
+		types = dict(c.fetchall())
+		# psycopg2 >= 2.8 tells the table column each result column comes from
+		return [QueryColumn(col[0], types.get(col[1]), getattr(col, 'table_oid', None), getattr(col, 'table_column', None))
+			for col in description]
+
+	def get_unique_columns(self, columns):
+		""" names of the integer columns of a query result (see get_query_columns) that may identify 
+			its rows, best first: primary keys, unique indexes, usual key names and other columns """
+		keys = {} # table oid -> (primary key column, unique index columns)
+		ranked = []
+		for column in columns:
+			if column.data_type not in ('int2', 'int4', 'int8'):
+				continue
+			if column.table_oid and column.table_oid not in keys:
+				keys[column.table_oid] = (None, [])
+				name = self.get_table_name(column.table_oid)
+				if name:
+					primary = self.get_table_primary_key(*name)
+					unique = [index.columns[0] for index in self.get_table_unique_indexes(*name) if len(index.columns) == 1]
+					keys[column.table_oid] = (primary[0] if len(primary) == 1 else None, unique)
+			primary, unique = keys.get(column.table_oid, (None, []))
+			if column.table_column is not None and column.table_column == primary:
+				rank = 0
+			elif column.table_column is not None and column.table_column in unique:
+				rank = 1
+			elif column.name.lower() in ('id', 'gid', 'fid', 'ogc_fid'):
+				rank = 2
+			else:
+				rank = 3
+			ranked.append((rank, column.name))
+		return [name for rank, name in sorted(ranked, key=lambda item: item[0])]
+
 	def get_table_constraints(self, table, schema=None):
 		c = self.con.cursor()
 		
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT c.conname, c.contype, c.condeferrable, c.condeferred, array_to_string(c.conkey, ' '), c.consrc,
 		         t2.relname, c.confupdtype, c.confdeltype, c.confmatchtype, array_to_string(c.confkey, ' ') FROM pg_constraint c
 		  LEFT JOIN pg_class t ON c.conrelid = t.oid
 			LEFT JOIN pg_class t2 ON c.confrelid = t2.oid
 			JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
-			WHERE t.relname = '%s' %s """ % (self._quote_str(table), schema_where)
+			WHERE t.relname = %(table)s AND (nspname = %(schema)s OR %(schema)s IS NULL) """
 		
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'table_constraints', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
 		
 		constrs = []
 		for row in c.fetchall():
@@ -348,14 +455,13 @@ class GeoDB:
 	def get_table_triggers(self, table, schema=None):
 		c = self.con.cursor()
 		
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """ SELECT tgname, proname, tgtype, tgenabled FROM pg_trigger trig
 		          LEFT JOIN pg_class t ON trig.tgrelid = t.oid
 							LEFT JOIN pg_proc p ON trig.tgfoid = p.oid
 							JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
-							WHERE t.relname ='%s' %s """ % (self._quote_str(table), schema_where)
+							WHERE t.relname =%(table)s AND (nspname = %(schema)s OR %(schema)s IS NULL) """
 	
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'table_triggers', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
 
 		triggers = []
 		for row in c.fetchall():
@@ -366,11 +472,10 @@ class GeoDB:
 	def get_table_rules(self, table, schema=None):
 		c = self.con.cursor()
 		
-		schema_where = " AND schemaname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """ SELECT rulename, definition FROM pg_rules
-					WHERE tablename='%s' %s """ % (self._quote_str(table), schema_where)
+					WHERE tablename=%(table)s AND (schemaname=%(schema)s OR %(schema)s IS NULL) """
 	
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'table_rules', [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
 
 		rules = []
 		for row in c.fetchall():
@@ -378,6 +483,19 @@ class GeoDB:
 
 		return rules
 
+	def get_table_analyze_info(self, table, schema=None):
+		""" statistics of a table from pg_stat_user_tables: (live rows, dead rows, last analyze or None,
+			rows modified since the last analyze or None before PostgreSQL 9.4) """
+		c = self.con.cursor()
+		if self.con.server_version >= 90400:
+			name, modified = 'table_analyze_info', "n_mod_since_analyze"
+		else:
+			name, modified = 'table_analyze_info_93', "NULL::bigint"
+		sql = """SELECT n_live_tup, n_dead_tup, GREATEST(last_analyze, last_autoanalyze), %s FROM pg_stat_user_tables
+						WHERE relname=%%(table)s AND (schemaname=%%(schema)s OR %%(schema)s IS NULL)""" % modified
+		self._exec_catalog(c, name, [('table', 'text'), ('schema', 'text')], sql, { 'table' : table, 'schema' : schema })
+		return c.fetchone()
+
 	def get_table_estimated_extent(self, geom, table, schema=None):
 		""" find out estimated extent (from the statistics) """
 		c = self.con.cursor()
@@ -391,12 +509,11 @@ class GeoDB:
 	
 	def get_view_definition(self, view, schema=None):
 		""" returns definition of the view """
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT pg_get_viewdef(c.oid) FROM pg_class c
 						JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
-		        WHERE relname='%s' %s AND relkind='v'""" % (self._quote_str(view), schema_where)
+		        WHERE relname=%(table)s AND (nspname=%(schema)s OR %(schema)s IS NULL) AND relkind='v'"""
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'view_definition', [('table', 'text'), ('schema', 'text')], sql, { 'table' : view, 'schema' : schema })
 		return c.fetchone()[0]
 		
 	"""
@@ -635,7 +752,7 @@ class GeoDB:
 	def create_spatial_index(self, table, schema=None, geom_column='the_geom'):
 		table_name = self._table_name(schema, table)
 		idx_name = self._quote("sidx_"+table)
-		sql = "CREATE INDEX %s ON %s USING GIST(%s GIST_GEOMETRY_OPS)" % (idx_name, table_name, self._quote(geom_column))
+		sql = "CREATE INDEX %s ON %s USING GIST(%s)" % (idx_name, table_name, self._quote(geom_column))
 		self._exec_sql_and_commit(sql)
 		
 	def delete_index(self, name, schema=None):
@@ -645,25 +762,25 @@ class GeoDB:
 		
 	def get_database_privileges(self):
 		""" db privileges: (can create schemas, can create temp. tables) """
-		sql = "SELECT has_database_privilege('%(d)s', 'CREATE'), has_database_privilege('%(d)s', 'TEMP')" % { 'd' : self._quote_str(self.dbname) }
+		sql = "SELECT has_database_privilege(%(d)s, 'CREATE'), has_database_privilege(%(d)s, 'TEMP')"
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'database_privileges', [('d', 'text')], sql, { 'd' : self.dbname })
 		return c.fetchone()
 		
 	def get_schema_privileges(self, schema):
 		""" schema privileges: (can create new objects, can access objects in schema) """
-		sql = "SELECT has_schema_privilege('%(s)s', 'CREATE'), has_schema_privilege('%(s)s', 'USAGE')" % { 's' : self._quote_str(schema) }
+		sql = "SELECT has_schema_privilege(%(s)s, 'CREATE'), has_schema_privilege(%(s)s, 'USAGE')"
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'schema_privileges', [('s', 'text')], sql, { 's' : schema })
 		return c.fetchone()
 	
 	def get_table_privileges(self, table, schema=None):
 		""" table privileges: (select, insert, update, delete) """
 		t = self._table_name(schema, table)
-		sql = """SELECT has_table_privilege('%(t)s', 'SELECT'), has_table_privilege('%(t)s', 'INSERT'),
-		                has_table_privilege('%(t)s', 'UPDATE'), has_table_privilege('%(t)s', 'DELETE')""" % { 't': self._quote_str(t) }
+		sql = """SELECT has_table_privilege(%(t)s, 'SELECT'), has_table_privilege(%(t)s, 'INSERT'),
+		                has_table_privilege(%(t)s, 'UPDATE'), has_table_privilege(%(t)s, 'DELETE')"""
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_catalog(c, 'table_privileges', [('t', 'text')], sql, { 't' : t })
 		return c.fetchone()
 	
 	def vacuum_analyze(self, table, schema=None):
@@ -675,6 +792,36 @@ class GeoDB:
 		self._exec_sql(c, "VACUUM ANALYZE %s" % t)
 		self.con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
 		
+	def get_plan_fingerprint(self, query):
+		""" hash of the shape of the plan of a query (node types, joins, relations and indexes, 
+			not the estimates), which changes when the planner picks another plan """
+		c = self.con.cursor()
+		self._exec_sql(c, "EXPLAIN (FORMAT JSON) %s" % query)
+		plan = c.fetchone()[0]
+		if isinstance(plan, basestring): # psycopg2 < 2.5 doesn't parse json
+			plan = json.loads(plan)
+		def shape(node):
+			return [node.get(key) for key in ('Node Type', 'Join Type', 'Relation Name', 'Index Name')] + \
+				[shape(child) for child in node.get('Plans', [])]
+		return hashlib.sha1(json.dumps(shape(plan[0]['Plan']))).hexdigest()[:12]
+
+	def get_query_estimate(self, query):
+		""" (rows, width in bytes) of the result of a query, as estimated by the planner """
+		c = self.con.cursor()
+		self._exec_sql(c, "EXPLAIN (FORMAT JSON) %s" % query)
+		plan = c.fetchone()[0]
+		if isinstance(plan, basestring): # psycopg2 < 2.5 doesn't parse json
+			plan = json.loads(plan)
+		return int(plan[0]['Plan']['Plan Rows']), int(plan[0]['Plan']['Plan Width'])
+
+	def get_query_size(self, query):
+		""" (rows, bytes) of the result of a query, running it on the server. Bytes are the
+			size of its rows as stored (pg_column_size), the rows are not fetched """
+		c = self.con.cursor()
+		self._exec_sql(c, "SELECT count(*), coalesce(sum(pg_column_size(t.*)), 0) FROM (%s) AS t" % query)
+		rows, bytes = c.fetchone()
+		return int(rows), int(bytes)
+
 	def get_srid_from_geom(self, geomFieldName, query):
 		if not self.has_postgis:
 			return "Unknown"
@@ -696,7 +843,7 @@ class GeoDB:
 		
 		try:
 			c = self.con.cursor()
-			self._exec_sql(c, "SELECT srtext FROM spatial_ref_sys WHERE srid = '%d'" % srid)
+			self._exec_catalog(c, 'srtext', [('srid', 'integer')], "SELECT srtext FROM spatial_ref_sys WHERE srid = %(srid)s", { 'srid' : srid })
 			sr = c.fetchone()
 			if sr is None:
 				return "Unknown"
@@ -769,13 +916,38 @@ class GeoDB:
 		#cur_name = cur_name.encode('ascii','replace').replace('?', '_')
 		return self.con.cursor(cur_name)
 		
-	def _exec_sql(self, cursor, sql):
+	def _exec_sql(self, cursor, sql, params=None):
+		start = time.time()
 		try:
-			cursor.execute(sql)
+			cursor.execute(sql, params)
 		except psycopg2.Error, e:
 			# do the rollback to avoid a "current transaction aborted, commands ignored" errors
 			self.con.rollback()
 			raise DbError(e)
+		finally:
+			if tracing:
+				tracing.record('geodb', sql, time.time() - start)
+		
+	def _exec_catalog(self, cursor, name, params, sql, values=None):
+		""" run a catalog query as a prepared statement, preparing it the first time it's used 
+			in the session. params: [(name, type)] of the named parameters of sql, values: their values.
+			If the statement can't be prepared or executed, prepared statements are disabled 
+			for the connection and the query is run with bound parameters """
+		statement = catalog_statements.get(name)
+		if statement is None:
+			statement = catalog_statements[name] = CatalogStatement(name, params, sql)
+		if self.prepared is not None:
+			try:
+				if statement.name not in self.prepared:
+					self._exec_sql(cursor, statement.prepare_sql)
+					self.prepared.add(statement.name)
+				self._exec_sql(cursor, statement.execute_sql, values)
+				return
+			except DbError, e:
+				if e.pgcode not in prepare_error_codes:
+					raise
+				self.prepared = None
+		self._exec_sql(cursor, sql, values)
 		
 	def _exec_sql_and_commit(self, sql):
 		""" tries to execute and commit some action, on error it rolls back the change """
@@ -803,6 +975,41 @@ class GeoDB:
 			return u"%s.%s" % (self._quote(schema), self._quote(table))
 		
 
+def close_connection(db):
+	db.con.close()
+
+def reusable_connection(db):
+	""" end the transaction of a connection given back to the broker, tell whether it can be reused """
+	try:
+		db.con.rollback()
+		return not db.con.closed
+	except psycopg2.Error:
+		return False
+
+@contextmanager
+def shared_connection(host=None, port=None, dbname=None, user=None, passwd=None):
+	""" with block with a GeoDB connection from the connection broker of the PostGIS Layer Viewer
+		(see connections.py), or with a new connection closed at the end without the broker """
+	if connections is None:
+		db = GeoDB(host, port, dbname, user, passwd)
+		try:
+			yield db
+		finally:
+			db.con.close()
+		return
+	database = connections.databaseKey(host, port, dbname, user)
+	try:
+		db = connections.broker.acquire(database, 'geodb', lambda: GeoDB(host, port, dbname, user, passwd))
+	except connections.BrokerError, e:
+		raise DbError(e)
+	bReuse = False
+	try:
+		yield db
+		bReuse = True
+	finally:
+		connections.broker.release(database, 'geodb', db, close_connection, bReuse and reusable_connection(db))
+
+
 # for debugging / testing
 if __name__ == '__main__':
 
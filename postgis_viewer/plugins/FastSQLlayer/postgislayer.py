@@ -25,12 +25,23 @@ from PyQt4.QtGui import *
 from qgis.core import *
 
 import highlighter as hl
-import os, re
+import os, re, time
 import resources
 
 import postgis_utils 
+import history
+try:
+    import tracing # round trips of the PostGIS Layer Viewer actions
+except ImportError:
+    tracing = None
+try:
+    import budget # memory budget of the PostGIS Layer Viewer
+except ImportError:
+    budget = None
 # Initialize Qt resources from file resources.py
 
+describe_delay = 500 # The query is described when the user stops typing for describe_delay ms
+
 
 class PostgisLayer:
     def __init__(self, iface, host, port, dbname, user, passwd):
@@ -58,10 +69,27 @@ class PostgisLayer:
         #connect the action to the run method
         QObject.connect(self.action, SIGNAL("triggered()"), self.show)
         QObject.connect(self.dock.buttonRun, SIGNAL('clicked()'), self.run)        
+        QObject.connect(self.dock.buttonHistory, SIGNAL('clicked()'), self.showHistory)
+        self.history = None # Opened on the first run
         
         #populate the id and the_geom combos
         self.dock.uniqueCombo.addItem('id')
         self.dock.geomCombo.addItem('the_geom')
+
+        #describe the query as it's edited, to offer its actual columns in the combos
+        self.describer = None
+        self.chosen = {} # combo -> column chosen by the user
+        self.describeTimer = QTimer()
+        self.describeTimer.setSingleShot(True)
+        self.describeTimer.setInterval(describe_delay)
+        QObject.connect(self.describeTimer, SIGNAL('timeout()'), self.describeQuery)
+        QObject.connect(self.dock.textQuery, SIGNAL('textChanged()'), self.describeTimer.start)
+        for combo in (self.dock.uniqueCombo, self.dock.geomCombo):
+            QObject.connect(combo, SIGNAL('activated(QString)'), lambda text, combo=combo: self.chooseColumn(combo, text))
+
+        #query layers are charged to the memory budget until removed
+        if budget:
+            QObject.connect(QgsMapLayerRegistry.instance(), SIGNAL('layerWillBeRemoved(QString)'), budget.session.release)
                 
         #start the highlight engine
         self.higlight_text = hl.Highlighter(self.dock.textQuery.document(), "sql")
@@ -72,9 +100,95 @@ class PostgisLayer:
     def unload(self):
         # Remove the plugin menu item and icon
         self.iface.removeToolBarIcon(self.action)
+        self.describeTimer.stop()
+        if budget:
+            QObject.disconnect(QgsMapLayerRegistry.instance(), SIGNAL('layerWillBeRemoved(QString)'), budget.session.release)
+        if self.describer:
+            self.describer.wait()
+        if self.history:
+            self.history.close()
+
+    def getHistory(self):
+		""" Open the query history, None if it can't be opened """
+		if self.history is None:
+			try:
+				self.history = history.QueryHistory()
+			except (history.sqlite3.Error, EnvironmentError), e:
+				print 'W: The query history could not be opened:', e
+		return self.history
+
+    def databaseName(self):
+		return "%s:%s/%s" % (self.host, self.port, self.dbname)
+
+    def showHistory(self):
+		if not self.getHistory():
+			QMessageBox.warning(self.iface.mainWindow(), "Warning", "The query history could not be opened.")
+			return
+		dialog = history.HistoryDialog(self.history, self.databaseName(), self.iface.mainWindow())
+		QObject.connect(dialog, SIGNAL('loadQuery(QString, bool)'), self.loadQuery)
+		dialog.exec_()
+
+    def loadQuery(self, query, bRun):
+		""" Put a query of the history in the editor, and run it if bRun """
+		self.dock.textQuery.setPlainText(query)
+		if bRun:
+			self.run()
+
+    def recordRun(self, db, query, started, seconds, rows, bytes):
+		""" Add a run to the query history: time, rows, bytes of the result and plan """
+		if not self.getHistory():
+			return
+		try:
+			plan = db.get_plan_fingerprint(query)
+		except postgis_utils.DbError, e:
+			plan = None
+		try:
+			self.history.record(self.databaseName(), query, started, seconds, rows, bytes, plan)
+		except history.sqlite3.Error, e:
+			print 'W: The query could not be added to the history:', e
+
+    def getQuery(self):
+		#lstrip() is needed to remove spaces in the first line.
+		return str(self.dock.textQuery.toPlainText()).lstrip().replace(";","")
+
+    def describeQuery(self):
+		""" Describe the query in the background (see QueryDescriber) """
+		if self.describer and self.describer.isRunning():
+			self.describeTimer.start() # Once the previous one is finished
+			return
+		query = self.getQuery()
+		if not re.match("^SELECT", query.upper() ):
+			return
+		self.describer = QueryDescriber(self, query)
+		QObject.connect(self.describer, SIGNAL('finished()'), self.queryDescribed)
+		self.describer.start()
+
+    def queryDescribed(self):
+		""" Offer the columns of the described query in the id and geometry combos """
+		self.setComboColumns(self.dock.uniqueCombo, self.describer.uniqueColumns)
+		self.setComboColumns(self.dock.geomCombo, self.describer.geomColumns)
+
+    def chooseColumn(self, combo, text):
+		self.chosen[combo] = unicode(text)
+
+    def setComboColumns(self, combo, columns):
+		""" Fill a combo with columns (best first), keeping the column chosen by the user """
+		if not columns:
+			return # Keep what the user typed
+		combo.clear()
+		combo.addItems(columns)
+		if self.chosen.get(combo) in columns:
+			combo.setCurrentIndex(columns.index(self.chosen[combo]))
 
     
     def run(self):
+		if tracing:
+			with tracing.span("Fast SQL Layer run"):
+				self.runQuery()
+		else:
+			self.runQuery()
+
+    def runQuery(self):
 		try:
 			import psycopg2
 		except ImportError, e:
@@ -84,26 +198,47 @@ class PostgisLayer:
 		uniqueFieldName = self.dock.uniqueCombo.currentText()
 		geomFieldName = self.dock.geomCombo.currentText()
 
+		# The connection comes from the connection broker of the viewer, if any
 		try:
-			db = postgis_utils.GeoDB( self.host, int(self.port), self.dbname, self.user, self.passwd )
+			with postgis_utils.shared_connection( self.host, int(self.port), self.dbname, self.user, self.passwd ) as db:
+				self.addQueryLayer( db, uniqueFieldName, geomFieldName )
 		except postgis_utils.DbError, e:
 			QMessageBox.critical(self.iface.mainWindow(), "error", "Couldn't connect to database:\n"+e.msg)
-			return
 
+    def addQueryLayer(self, db, uniqueFieldName, geomFieldName):
 		uri = QgsDataSourceURI()
 		uri.setConnection(self.host, self.port, self.dbname, self.user, self.passwd)
 
-		query = str(self.dock.textQuery.toPlainText()).lstrip().replace(";","")
+		query = self.getQuery()
 
 		# Validate query
 		if not re.match("^SELECT", query.upper() ):
 			QMessageBox.critical(self.iface.mainWindow(), "error", "The query has to be a SELECT clause.")
 			return 
 		try:
-			db._exec_sql( db.con.cursor(), query )
+			rows, width = db.get_query_estimate( query )
 		except postgis_utils.DbError, e:
 			QMessageBox.critical(self.iface.mainWindow(), "error", str(e))
 			return 
+		bytes = rows * width
+		if budget and budget.session.check( bytes ):
+			query, bytes = self.previewQuery( query, rows, width )
+			if query is None:
+				return
+		try:
+			# The query is run to the end by the server, only its size is fetched
+			started = time.time()
+			rows, bytes = db.get_query_size( query )
+			seconds = time.time() - started
+		except (postgis_utils.DbError, postgis_utils.psycopg2.Error), e:
+			QMessageBox.critical(self.iface.mainWindow(), "error", str(e))
+			return 
+		self.recordRun( db, query, started, seconds, rows, bytes )
+		if budget and budget.session.check( bytes ):
+			# The plan underestimated the result: preview it with the measured size of its rows
+			query, bytes = self.previewQuery( query, rows, float( bytes ) / max( rows, 1 ), True )
+			if query is None:
+				return
 
 		QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
 
@@ -114,11 +249,56 @@ class PostgisLayer:
 			QMessageBox.critical(self.iface.mainWindow(), "error", e.msg)
 			return 
 
-		#lstrip() is needed to remove spaces in the first line.
 		uri.setDataSource("", "(" + query + ")", geomFieldName, "", uniqueFieldName)
 		vl = self.iface.addVectorLayer(uri.uri(), "QueryLayer", "postgres", srid)
 		if not vl:
 			QMessageBox.information(self.iface.mainWindow(), "Warning", "Couldn't load" + \
 			  "the layer. It doesn't seem to be a valid layer.")
+		elif budget:
+			budget.session.charge( vl, bytes )
 		QApplication.restoreOverrideCursor()
+
+    def previewQuery(self, query, rows, width, bMeasured=False):
+		""" Offer a preview of a query whose result, estimated from the plan or measured 
+			(bMeasured, width is then the measured bytes per row), exceeds the memory budget 
+			(see budget.py): the rows that fit in it. Return the query to load and its 
+			estimated bytes, or (None, None) if refused """
+		exceeded = budget.session.check( rows * width )
+		limit = int( budget.session.available() // max( width, 1 ) )
+		message = "The result of the query is %s in %s rows, %s, which exceeds the " \
+			"memory budget of %s (%s in use by other layers)." % ( "measured" if bMeasured else "estimated",
+			rows, budget.formatBytes( rows * width ), "a layer" if exceeded == 'layer' else "the session",
+			budget.formatBytes( budget.session.used() ) )
+		if limit < 1:
+			QMessageBox.critical(self.iface.mainWindow(), "Memory budget exceeded", message + \
+				"\nRemove some layers or refine the query.")
+			return None, None
+		answer = QMessageBox.warning(self.iface.mainWindow(), "Memory budget exceeded", message + \
+			"\nLoad a preview with the first %s rows?" % limit, QMessageBox.Yes | QMessageBox.Cancel)
+		if answer != QMessageBox.Yes:
+			return None, None
+		return "SELECT * FROM (%s) AS preview LIMIT %d" % ( query, limit ), int( limit * width )
  
+
+
+class QueryDescriber(QThread):
+    """ Find the geometry columns of a query result and the columns that may identify 
+        its rows, in the background
+    """
+    def __init__(self, plugin, query):
+		QThread.__init__(self)
+		self.plugin = plugin
+		self.query = query
+		self.geomColumns = []
+		self.uniqueColumns = []
+
+    def run(self):
+		p = self.plugin
+		try:
+			# The connection is rolled back once given back (the query may have side effects)
+			with postgis_utils.shared_connection( p.host, int(p.port), p.dbname, p.user, p.passwd ) as db:
+				columns = db.get_query_columns(self.query)
+				self.geomColumns = [column.name for column in columns if column.data_type in ('geometry', 'geography')]
+				self.uniqueColumns = db.get_unique_columns(columns)
+		except (postgis_utils.DbError, postgis_utils.psycopg2.Error), e:
+			pass # Not a valid query (yet)
@@ -13,6 +13,14 @@ Options:
     -s schema
     -t table
 
+Offline snapshot (open a snapshot saved from the legend, without database access):
+postgis_viewer.py --snapshot=<file.sqlite>
+
+Batch mode (render tables to PNG files without GUI):
+postgis_viewer.py --batch=<output dir> [--size=800x600] [--extent=xmin,ymin,xmax,ymax]
+                  [--workers=4] -h host -p port -U user -W password -d database 
+                  schema.table [schema.table ...]
+
 Prerequisities:
     Qt, QGIS, libqt4-sql-psql
 
@@ -34,29 +42,45 @@ Authors:
 License: GNU General Public License v2.0
 """
 
-import os, sys, math, imp, fileinput, re
-import getopt
+import os, sys, math, imp, re, string
+import getopt, time, multiprocessing, itertools, threading
 import getpass, pickle # import stuff for ipc
+import hashlib
+from collections import OrderedDict, deque
+from array import array
+from contextlib import contextmanager
 
 try:
     from PyQt4.QtSql import QSqlDatabase, QSqlQuery
     from PyQt4.QtGui import ( QActionGroup, QAction, QMainWindow, QApplication, QMessageBox, 
         QStatusBar, QFrame, QLabel, QDockWidget, QTreeWidget, QTreeWidgetItem, 
         QPixmap, QIcon, QFont, QMenu, QColorDialog, QAbstractItemView, QTabWidget,
-        QBitmap, QColor, QWidget )
+        QBitmap, QColor, QWidget, QProgressDialog, QImage, QStyledItemDelegate, 
+        QFontMetrics, QPalette, QPushButton, QProgressBar, QLineEdit, QVBoxLayout, QPainter,
+        QFileDialog )
     from PyQt4.QtCore import ( SIGNAL, Qt, QString, QSharedMemory, QIODevice, QPoint, 
-        QObject, QSize )
+        QObject, QSize, QThread, QTimer, QRect )
     from PyQt4.QtNetwork import QLocalServer, QLocalSocket
 
     from qgis.core import ( QgsApplication, QgsDataSourceURI, QgsVectorLayer, 
-        QgsRasterLayer, QgsMapLayerRegistry, QgsContrastEnhancement )
-    from qgis.gui import QgsMapCanvas, QgsMapToolPan, QgsMapToolZoom, QgsMapCanvasLayer
+        QgsRasterLayer, QgsMapLayerRegistry, QgsContrastEnhancement, QgsRectangle,
+        QgsMapSettings, QgsMapRendererCustomPainterJob, QgsMessageLog, QgsFeature, QgsFeatureRequest,
+        QgsVectorFileWriter, QgsGeometry )
+    from qgis.gui import ( QgsMapCanvas, QgsMapToolPan, QgsMapToolZoom, QgsMapCanvasLayer, 
+        QgsMapTool, QgsRubberBand )
 
 except ImportError:
     print >> sys.stderr, 'E: Qt or QGIS not installed.'
     print >> sys.stderr, 'E: Exiting ...'
     sys.exit(1)
 
+from rastercache import RasterTileCache, levelToken, levelBytes, containsExtent, scaleExtent
+from featurecache import FeatureTileCache, tilesFor, tileExtent
+from spatialindex import PackedRTree
+import tracing
+import connections
+import budget
+
 # Set the qgis_prefix and the imgs_dir according to the current os
 qgis_prefix = ""
 imgs_dir = ""
@@ -67,6 +91,68 @@ else: # Linux
     qgis_prefix = "/usr"
     imgs_dir = "/usr/bin/postgis_viewer/imgs/"
 
+# PostGIS raster tiles are cached on disk (see rastercache.py) up to raster_cache_size bytes
+raster_cache_dir = os.path.join( os.path.expanduser( "~" ), ".postgis_viewer", "rastercache" )
+raster_cache_size = 512 * 1024 * 1024
+os.environ.setdefault( "GTIFF_VIRTUAL_MEM_IO", "IF_ENOUGH_RAM" ) # Memory-map cached tiles
+
+# The table of a raster level drawn from the tile cache is checked for changes (see levelToken())
+# at most every raster_cache_check_interval seconds while it's viewed. Tiles are cached for the
+# view grown by raster_cache_margin (mosaics are drawn without database access while panning)
+raster_cache_check_interval = 60
+raster_cache_margin = 2.0
+
+# Raster thumbnails of the legend are stored on disk
+thumbnails_dir = os.path.join( os.path.expanduser( "~" ), ".postgis_viewer", "thumbnails" )
+
+# Plugin names, titles and icons are cached, plugins are imported on demand
+plugins_manifest_file = os.path.join( os.path.expanduser( "~" ), ".postgis_viewer", "plugins.pickle" )
+
+# Exact extents of PostGIS tables are computed in the background for up to extent_timeout ms
+extent_timeout = 60000
+
+# The database browser reads tables browser_page_size at a time
+browser_page_size = 200
+
+# Rendered map images are kept in memory up to canvas_cache_size bytes
+canvas_cache_size = 64 * 1024 * 1024
+
+# Coordinates and scale are shown in the status bar at most every status_update_interval ms
+status_update_interval = 40
+
+# Tables are advised to be analyzed when their dead rows or the rows modified since their last
+# analyze exceed stale_statistics_rows + stale_statistics_ratio * live rows (as autovacuum does)
+stale_statistics_rows = 50
+stale_statistics_ratio = 0.2
+
+# Layers sent by pgAdmin within layer_batch_delay ms are loaded at once, with a single map update
+layer_batch_delay = 200
+
+# Layer properties of the legend are computed by up to properties_workers threads at a time
+properties_workers = 4
+
+# The database connections (see connections.py) are shown in the status bar every connection_status_interval ms
+connection_status_interval = 2000
+
+# Features of PostGIS vector layers are cached in memory by tiles (see featurecache.py) up to
+# feature_cache_size bytes, and fetched again after feature_cache_age seconds
+feature_cache_size = 64 * 1024 * 1024
+feature_cache_age = 300
+
+# Offline snapshots of vector layers (SpatiaLite files, see SnapshotWriter) are saved in snapshots_dir.
+# SQLite memory-maps them up to snapshot_mmap_size bytes, the pages are shared by the processes reading them
+snapshots_dir = os.path.join( os.path.expanduser( "~" ), ".postgis_viewer", "snapshots" )
+snapshot_mmap_size = 2 * 1024 * 1024 * 1024
+os.environ.setdefault( "OGR_SQLITE_PRAGMA", "mmap_size=%d" % snapshot_mmap_size )
+
+# The identify tool looks up the features of client-side layers (indexed_providers) in a packed
+# R-tree (see spatialindex.py), built in the background whenever they're added or redrawn. The
+# features within identify_tolerance pixels of a click are listed, up to identify_limit per
+# layer (all of them are selected)
+indexed_providers = ( 'memory', 'ogr', 'spatialite' )
+identify_tolerance = 3
+identify_limit = 100
+
 class SingletonApp(QApplication):
     
     timeout = 1000
@@ -132,11 +218,40 @@ class SingletonApp(QApplication):
         self.emit( SIGNAL("loadPgLayer"), message )
 
 
+class CanvasImageCache:
+    """ Size-bounded LRU cache of rendered map images """
+    def __init__( self, maxBytes ):
+        self.maxBytes = maxBytes
+        self.images = OrderedDict() # key -> QImage, least recently used first
+        self.size = 0
+
+    def get( self, key ):
+        """ Return the image stored for key, None if there is no such image """
+        if not key in self.images:
+            return None
+        image = self.images.pop( key )
+        self.images[ key ] = image # Most recently used
+        return image
+
+    def put( self, key, image ):
+        if key in self.images:
+            self.size -= self.images.pop( key ).byteCount()
+        self.images[ key ] = image
+        self.size += image.byteCount()
+        while self.size > self.maxBytes and self.images:
+            self.size -= self.images.popitem( last=False )[ 1 ].byteCount()
+
+    def clear( self ):
+        self.images.clear()
+        self.size = 0
+
+
 class ViewerWnd( QMainWindow ):
     def __init__( self, app, dictOpts ):
         QMainWindow.__init__( self )
         self.setWindowTitle( "PostGIS Layer Viewer - v.1.6.1" )
         self.setTabPosition( Qt.BottomDockWidgetArea, QTabWidget.North )
+        self.connectionOpts = dict( ( opt, dictOpts[ opt ] ) for opt in ( '-h', '-p', '-d', '-U', '-W' ) )
 
         self.canvas = QgsMapCanvas()
         self.canvas.setCanvasColor( Qt.white )
@@ -144,24 +259,29 @@ class ViewerWnd( QMainWindow ):
         self.canvas.enableAntiAliasing( True )
         self.setCentralWidget( self.canvas )
 
-        actionZoomIn = QAction( QIcon( imgs_dir + "mActionZoomIn.png" ), QString( "Zoom in" ), self )
-        actionZoomOut = QAction( QIcon( imgs_dir + "mActionZoomOut.png" ), QString( "Zoom out" ), self )
-        actionPan = QAction( QIcon( imgs_dir + "mActionPan.png" ), QString( "Pan" ), self )
-        actionZoomFullExtent = QAction( QIcon( imgs_dir + "mActionZoomFullExtent.png" ), QString( "Zoom full" ), self )
+        actionZoomIn = QAction( getIcon( "mActionZoomIn.png" ), QString( "Zoom in" ), self )
+        actionZoomOut = QAction( getIcon( "mActionZoomOut.png" ), QString( "Zoom out" ), self )
+        actionPan = QAction( getIcon( "mActionPan.png" ), QString( "Pan" ), self )
+        actionZoomFullExtent = QAction( getIcon( "mActionZoomFullExtent.png" ), QString( "Zoom full" ), self )
+        actionIdentify = QAction( QString( "Identify" ), self )
+        actionIdentify.setToolTip( "Identify features (click or drag a rectangle)" )
 
         actionZoomIn.setCheckable( True )
         actionZoomOut.setCheckable( True )
         actionPan.setCheckable( True )
+        actionIdentify.setCheckable( True )
 
         self.connect(actionZoomIn, SIGNAL( "triggered()" ), self.zoomIn )
         self.connect(actionZoomOut, SIGNAL( "triggered()" ), self.zoomOut )
         self.connect(actionPan, SIGNAL( "triggered()" ), self.pan )
         self.connect(actionZoomFullExtent, SIGNAL( "triggered()" ), self.zoomFullExtent )
+        self.connect(actionIdentify, SIGNAL( "triggered()" ), self.identify )
 
         self.actionGroup = QActionGroup( self )
         self.actionGroup.addAction( actionPan )
         self.actionGroup.addAction( actionZoomIn )
         self.actionGroup.addAction( actionZoomOut )        
+        self.actionGroup.addAction( actionIdentify )
 
         # Create the toolbar
         self.toolbar = self.addToolBar( "Map tools" )
@@ -169,6 +289,13 @@ class ViewerWnd( QMainWindow ):
         self.toolbar.addAction( actionZoomIn )
         self.toolbar.addAction( actionZoomOut )
         self.toolbar.addAction( actionZoomFullExtent )
+        self.toolbar.addAction( actionIdentify )
+
+        actionOpenSnapshot = QAction( QString( "Open snapshot" ), self )
+        actionOpenSnapshot.setToolTip( "Open an offline snapshot of a layer" )
+        self.connect( actionOpenSnapshot, SIGNAL( "triggered()" ), self.openSnapshot )
+        self.toolbar.addSeparator()
+        self.toolbar.addAction( actionOpenSnapshot )
 
         # Create the map tools
         self.toolPan = QgsMapToolPan( self.canvas )
@@ -177,6 +304,8 @@ class ViewerWnd( QMainWindow ):
         self.toolZoomIn.setAction( actionZoomIn )
         self.toolZoomOut = QgsMapToolZoom( self.canvas, True ) # true = out
         self.toolZoomOut.setAction( actionZoomOut )
+        self.toolIdentify = IdentifyTool( self )
+        self.toolIdentify.setAction( actionIdentify )
         
         # Create the statusbar
         self.statusbar = QStatusBar( self )
@@ -195,19 +324,100 @@ class ViewerWnd( QMainWindow ):
         self.lblScale.setMinimumWidth( 140 )
         self.statusbar.addPermanentWidget( self.lblScale, 0 )
 
+        self.lblConnections = QLabel()
+        self.lblConnections.setFrameStyle( QFrame.StyledPanel )
+        self.statusbar.addPermanentWidget( self.lblConnections, 0 )
+        self.connectionTimer = QTimer( self )
+        self.connectionTimer.setInterval( connection_status_interval )
+        self.connect( self.connectionTimer, SIGNAL( "timeout()" ), self.updateConnectionStatus )
+        self.connectionTimer.start()
+        self.updateConnectionStatus()
+
+        self.lblFeatureCache = QLabel()
+        self.lblFeatureCache.setFrameStyle( QFrame.StyledPanel )
+        self.statusbar.addPermanentWidget( self.lblFeatureCache, 0 )
+
+        # Advice about the last loaded table (missing spatial index, stale statistics)
+        self.lblAdvice = QLabel()
+        self.btnCreateIndex = QPushButton( "Create spatial index" )
+        self.btnAnalyze = QPushButton( "Vacuum analyze" )
+        self.barMaintenance = QProgressBar()
+        self.barMaintenance.setRange( 0, 0 ) # Busy
+        self.barMaintenance.setMaximumWidth( 100 )
+        for widget in ( self.lblAdvice, self.btnCreateIndex, self.btnAnalyze, self.barMaintenance ):
+            self.statusbar.addWidget( widget )
+            widget.hide()
+        self.connect( self.btnCreateIndex, SIGNAL( "clicked()" ), 
+            lambda: self.maintainTable( 'index' ) )
+        self.connect( self.btnAnalyze, SIGNAL( "clicked()" ), 
+            lambda: self.maintainTable( 'analyze' ) )
+        self.advisor = None
+        self.maintenance = None
+
+        # Mouse moves emit xyCoordinates far more often than the labels can be seen
+        self.lastXY = None
+        self.lastScale = None
+        self.statusTimer = QTimer( self )
+        self.statusTimer.setSingleShot( True )
+        self.statusTimer.setInterval( status_update_interval )
+        self.connect( self.statusTimer, SIGNAL( "timeout()" ), self.updateStatusBar )
+
+        self.renderCache = CanvasImageCache( canvas_cache_size )
+        self.styleVersion = 0 # Changes whenever a layer style changes
+        self.bRenderComplete = False # The last render job finished without being cancelled
+        self.rasterOverviews = {} # Base raster layer id -> RasterOverviews
+        try:
+            self.rasterCache = RasterTileCache( raster_cache_dir, raster_cache_size )
+        except EnvironmentError, e:
+            print 'W: Raster tile cache disabled:', e
+            self.rasterCache = None
+        self.overviewLayerIds = set() # Ids of overview layers, they don't go to the legend
+        self.featureCache = FeatureTileCache( feature_cache_size, feature_cache_age )
+        self.featureTiles = {} # PostGIS vector layer id -> FeatureTiles
+        self.snapshotWriters = set()
+        self.spatialIndexes = {} # Client-side vector layer id -> LayerIndex
+        self.indexBuilders = {} # Client-side vector layer id -> SpatialIndexBuilder running
+        self.extents = {} # Extent key (see extentKey()) -> ( QgsRectangle, bExact )
+        self.extentCalculators = {} # Extent key -> ExtentCalculator
+        self.pendingZoom = None # ( extent key, scale factor, view extent ) to refine
+
         self.createLegendWidget()   # Create the legend widget
 
-        self.connect( app, SIGNAL( "loadPgLayer" ), self.loadLayer )
+        self.pendingLayers = [] # Layers sent by pgAdmin, loaded at once (see queueLayer())
+        self.connect( app, SIGNAL( "loadPgLayer" ), self.queueLayer )
+        self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "layerWillBeRemoved(QString)" ),
+            self.removeRasterOverviews )
+        self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "layerWasAdded(QgsMapLayer *)" ),
+            self.cacheFeatures )
+        self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "layerWillBeRemoved(QString)" ),
+            self.removeFeatureTiles )
+        self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "layerWasAdded(QgsMapLayer *)" ),
+            self.buildSpatialIndex )
+        self.connect( QgsMapLayerRegistry.instance(), SIGNAL( "layerWillBeRemoved(QString)" ),
+            self.dropSpatialIndex )
+        self.connect( self.canvas, SIGNAL( "extentsChanged()" ),
+            lambda: QTimer.singleShot( 0, self.updateFeatureTiles ) )
+        # Wait for the canvas to settle before swapping layers in its layer set
+        self.connect( self.canvas, SIGNAL( "extentsChanged()" ),
+            lambda: QTimer.singleShot( 0, self.updateRasterOverviews ) )
         self.connect( self.canvas, SIGNAL( "scaleChanged(double)" ),
             self.changeScale )
         self.connect( self.canvas, SIGNAL( "xyCoordinates(const QgsPoint&)" ),
             self.updateXY )
+        self.connect( self.canvas, SIGNAL( "renderComplete(QPainter *)" ),
+            self.renderCompleted )
+        self.connect( self.canvas, SIGNAL( "mapCanvasRefreshed()" ),
+            self.storeRenderedImage )
+        if tracing.enabled:
+            QgsMessageLog.instance().messageReceived.connect( providerMessage )
 
         self.pan() # Default
 
         self.plugins = Plugins( self, self.canvas, dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-U'], dictOpts['-W'] )
 
+        self.createBrowserWidget()
         self.createAboutWidget()
+        self.createIdentifyWidget()
         self.layerSRID = '-1'
         self.loadLayer( dictOpts )
     
@@ -220,8 +430,58 @@ class ViewerWnd( QMainWindow ):
     def pan( self ):
         self.canvas.setMapTool( self.toolPan )
 
+    def identify( self ):
+        self.canvas.setMapTool( self.toolIdentify )
+
     def zoomFullExtent( self ):
-        self.canvas.zoomToFullExtent()
+        self.navigate( self.canvas.zoomToFullExtent )
+
+    def navigate( self, zoomFunction ):
+        """ Apply a zoom function, showing the view from the render cache if it was drawn before """
+        self.canvas.freeze( True )
+        zoomFunction()
+        self.canvas.freeze( False )
+
+        image = self.renderCache.get( self.renderKey() )
+        if image:
+            self.canvas.stopRendering()
+            self.bRenderComplete = False # The cancelled job left the old map
+            self.canvas.map().setContent( image, self.canvas.extent() )
+            self.canvas.map().update()
+        else:
+            self.canvas.refresh()
+
+    def renderKey( self ):
+        """ Return what identifies the map being drawn: extent, scale, size, layers and styles """
+        extent = self.canvas.extent()
+        precision = extent.width() / 1e6 or 1.0
+        return ( tuple( int( round( v / precision ) ) for v in ( extent.xMinimum(), extent.yMinimum(),
+                     extent.xMaximum(), extent.yMaximum() ) ),
+                 int( round( self.canvas.scale() ) ), self.canvas.width(), self.canvas.height(),
+                 tuple( ( unicode( l.layer().id() ), l.isVisible() ) for l in self.legend.layers ),
+                 self.styleVersion )
+
+    def renderCompleted( self, painter ):
+        """ Slot. Only emitted by render jobs not cancelled """
+        self.bRenderComplete = True
+
+    def storeRenderedImage( self ):
+        """ Slot. Keep the map just rendered to show it again without rendering """
+        bComplete, self.bRenderComplete = self.bRenderComplete, False
+        if not bComplete:
+            return # Cancelled, the map is the one of a previous view
+        if any( tiles.fetcher for tiles in self.featureTiles.values() ):
+            return # Features are missing, the map will be rendered again once they arrive
+        image = self.canvas.map().contentImage()
+        if not image.isNull():
+            self.renderCache.put( self.renderKey(), QImage( image ) )
+
+    def invalidateRenderCache( self ):
+        """ Forget the rendered maps, the way layers are drawn has changed """
+        self.styleVersion += 1
+        self.renderCache.clear()
+        for tiles in self.featureTiles.values():
+            tiles.copyStyle()
     
     def about( self ):
         pass
@@ -239,6 +499,50 @@ class ViewerWnd( QMainWindow ):
         self.LegendDock.setContentsMargins ( 0, 0, 0, 0 )
         self.addDockWidget( Qt.BottomDockWidgetArea, self.LegendDock )
 
+    def createIdentifyWidget( self ):
+        """ Create the list of identified features and dock it next to the legend """
+        self.identifyResults = QTreeWidget( self )
+        self.identifyResults.setHeaderLabels( [ "Feature", "Value" ] )
+        self.IdentifyDock = QDockWidget( "Identify", self )
+        self.IdentifyDock.setObjectName( "identify" )
+        self.IdentifyDock.setTitleBarWidget( QWidget() )
+        self.IdentifyDock.setContentsMargins( 0, 0, 0, 0 )
+        self.IdentifyDock.setWidget( self.identifyResults )
+        self.tabifyDockWidget( self.LegendDock, self.IdentifyDock )
+        self.LegendDock.raise_()
+
+    def createBrowserWidget( self ):
+        """ Create the database browser (it needs GeoDB) and dock it next to the legend """
+        postgis_utils = importPostgisUtils()
+        if not postgis_utils or not self.connectionOpts['-d']: # E.g., a snapshot opened offline
+            return
+        self.browser = Browser( self, postgis_utils, self.connectionOpts )
+        self.BrowserDock = QDockWidget( "Browser", self )
+        self.BrowserDock.setObjectName( "browser" )
+        self.BrowserDock.setContentsMargins( 0, 0, 0, 0 )
+        self.BrowserDock.setWidget( self.browser )
+        self.plugins.qgisInterface.addDockWidget( Qt.BottomDockWidgetArea, self.BrowserDock )
+
+    def loadTable( self, schema, table, geom=None ):
+        """ Load a table of the current database as a layer (e.g., from the browser) """
+        with tracing.span( "open %s.%s from the browser" % ( schema, table ) ):
+            dictOpts = dict( self.connectionOpts )
+            dictOpts.update( { '-s':schema, '-t':table, '-g':'', 'type':'unknown', 'srid':'', 
+                'col':'', 'overviews':[] } )
+            with sharedDatabase( dictOpts ) as d:
+                if d.isOpen():
+                    query = TracedQuery( d )
+                    detectLayerType( dictOpts, query )
+                    del query
+
+            if dictOpts['type'] == 'unknown':
+                QMessageBox.warning( self, "Error when opening layer", 
+                    "Layer '%s.%s' is neither a raster nor a vector layer." % ( schema, table ) )
+                return
+            if geom and dictOpts['type'] == 'vector':
+                dictOpts['-g'] = geom
+            self.loadLayer( dictOpts )
+
     def createAboutWidget( self ):
         self.AboutDock = QDockWidget( "About", self )
         self.AboutDock.setObjectName( "about" )
@@ -271,33 +575,123 @@ class ViewerWnd( QMainWindow ):
             "<i>Licensed under the terms of GNU GPL v.2.0</i><br \><br \>" \
             "Based on PyQGIS. Plugin Fast SQL Layer by Pablo T. Carreira.</body></html>" )
 
+    def queueLayer( self, dictOpts ):
+        """ Queue a layer sent by pgAdmin, so that a burst of them is loaded at once """
+        self.pendingLayers.append( dictOpts )
+        if len( self.pendingLayers ) == 1:
+            QTimer.singleShot( layer_batch_delay, self.loadPendingLayers )
+
+    def loadPendingLayers( self ):
+        listOpts, self.pendingLayers = self.pendingLayers, []
+        self.loadLayers( listOpts )
+
+    def loadLayers( self, listOpts ):
+        """ Load several layers, updating the legend and the map only once """
+        self.legend.beginUpdate()
+        try:
+            for dictOpts in listOpts:
+                self.loadLayer( dictOpts )
+        finally:
+            self.legend.endUpdate()
+
     def loadLayer( self, dictOpts ):
-        print 'I: Loading the layer...'
-        self.layerSRID = dictOpts[ 'srid' ] # To access the SRID when querying layer properties
-
-        if not self.isActiveWindow():
-            self.activateWindow()            
-            self.raise_() 
-
-        if dictOpts['type'] == 'vector':
-            # QGIS connection
-            uri = QgsDataSourceURI()
-            uri.setConnection( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], 
-                dictOpts['-U'], dictOpts['-W'] )
-            uri.setDataSource( dictOpts['-s'], dictOpts['-t'], dictOpts['-g'] )
-            layer = QgsVectorLayer( uri.uri(), dictOpts['-s'] + '.' + dictOpts['-t'],
-                "postgres" )        
-        elif dictOpts['type'] == 'raster':          
-            connString = "PG: dbname=%s host=%s user=%s password=%s port=%s mode=2 " \
-                "schema=%s column=%s table=%s" % ( dictOpts['-d'], dictOpts['-h'], 
-                dictOpts['-U'], dictOpts['-W'], dictOpts['-p'], dictOpts['-s'], 
-                dictOpts['col'], dictOpts['-t'] )
-            layer = QgsRasterLayer( connString, dictOpts['-s'] + '.' + dictOpts['-t'] )
-            
-            if layer.isValid():
-                layer.setContrastEnhancement( QgsContrastEnhancement.StretchToMinimumMaximum )
+        with tracing.span( "load layer %s" % ( dictOpts.get( 'snapshot' ) or 
+                "%s.%s" % ( dictOpts['-s'], dictOpts['-t'] ) ) ):
+            print 'I: Loading the layer...'
+            self.layerSRID = dictOpts[ 'srid' ] # To access the SRID when querying layer properties
+
+            if not self.isActiveWindow():
+                self.activateWindow()            
+                self.raise_() 
+
+            layer = createLayer( dictOpts )
+            if self.addLayer( layer, self.layerSRID ):
+                if dictOpts['type'] == 'raster':
+                    self.rasterOverviews[ unicode( layer.id() ) ] = RasterOverviews( self, layer, dictOpts )
+                    self.updateRasterOverviews()
+                elif dictOpts['type'] == 'vector':
+                    self.adviseTable( dictOpts )
+
+    def openSnapshot( self ):
+        """ Slot. Open an offline snapshot of a layer, no database access is needed """
+        path = QFileDialog.getOpenFileName( self, "Open offline snapshot", snapshots_dir, "Snapshots (*.sqlite)" )
+        if not path.isEmpty():
+            self.loadLayer( snapshotOpts( unicode( path ), self.connectionOpts ) )
+
+    def snapshotLayer( self, layerId ):
+        """ Save an offline snapshot of a PostGIS vector layer, in the background """
+        layer = QgsMapLayerRegistry.instance().mapLayer( layerId )
+        if not os.path.isdir( snapshots_dir ):
+            os.makedirs( snapshots_dir )
+        name = re.sub( r'[^\w.-]+', '_', unicode( layer.name() ) )
+        path = QFileDialog.getSaveFileName( self, "Save offline snapshot", 
+            os.path.join( snapshots_dir, name + '.sqlite' ), "Snapshots (*.sqlite)" )
+        if path.isEmpty():
+            return
+        writer = SnapshotWriter( layer, unicode( path ), self )
+        self.connect( writer, SIGNAL( "finished()" ), self.snapshotWritten )
+        self.snapshotWriters.add( writer )
+        self.statusbar.showMessage( "Saving snapshot of %s..." % layer.name() )
+        writer.start()
+
+    def snapshotWritten( self ):
+        """ Slot. Report the snapshot just written """
+        writer = self.sender()
+        self.snapshotWriters.discard( writer )
+        if writer.error:
+            self.statusbar.clearMessage()
+            QMessageBox.warning( self, "Offline snapshot", "Snapshot could not be saved:\n" + writer.error )
+        else:
+            self.statusbar.showMessage( "Snapshot saved: " + writer.path, 5000 )
+        writer.deleteLater()
 
-        self.addLayer( layer, self.layerSRID )
+    def adviseTable( self, dictOpts ):
+        """ Check in the background whether a table lacks a spatial index or statistics """
+        postgis_utils = importPostgisUtils()
+        if not postgis_utils or ( self.maintenance and self.maintenance.isRunning() ):
+            return
+        self.hideAdvice()
+        self.advisor = TableAdvisor( postgis_utils, dictOpts, self )
+        self.connect( self.advisor, SIGNAL( "finished()" ), self.showAdvice )
+        self.advisor.start()
+
+    def showAdvice( self ):
+        """ Slot. Show the advice of the table advisor, if any """
+        advisor = self.sender()
+        if advisor is not self.advisor or not advisor.advice:
+            return
+        table = advisor.dictOpts['-s'] + '.' + advisor.dictOpts['-t']
+        messages = { 'index':"has no spatial index", 
+            'analyze':"has stale statistics" if advisor.bStale else "has never been analyzed" }
+        self.lblAdvice.setText( "Table %s %s" % ( table, 
+            " and ".join( messages[ advice ] for advice in advisor.advice ) ) )
+        self.lblAdvice.show()
+        self.btnCreateIndex.setVisible( 'index' in advisor.advice )
+        self.btnAnalyze.setVisible( 'analyze' in advisor.advice )
+
+    def hideAdvice( self ):
+        for widget in ( self.lblAdvice, self.btnCreateIndex, self.btnAnalyze ):
+            widget.hide()
+
+    def maintainTable( self, task ):
+        """ Create the spatial index of the advised table or vacuum analyze it, in the background """
+        with tracing.span( "table maintenance (%s)" % task ):
+            self.hideAdvice()
+            self.maintenance = TableMaintenance( self.advisor.postgis_utils, self.advisor.dictOpts, task, self )
+            self.connect( self.maintenance, SIGNAL( "finished()" ), self.tableMaintained )
+            self.barMaintenance.show()
+            self.statusbar.showMessage( "Creating spatial index..." if task == 'index' else "Vacuum analyze..." )
+            self.maintenance.start()
+
+    def tableMaintained( self ):
+        """ Slot. Report the end of a table maintenance and advise on what's left """
+        self.barMaintenance.hide()
+        if self.maintenance.error:
+            self.statusbar.clearMessage()
+            QMessageBox.warning( self, "Table maintenance", self.maintenance.error )
+        else:
+            self.statusbar.showMessage( "Done", 3000 )
+        self.adviseTable( self.maintenance.dictOpts )
 
     def addLayer( self, layer, srid='-1' ):
         if layer.isValid():
@@ -307,8 +701,8 @@ class ViewerWnd( QMainWindow ):
             else:
                self.layerSRID = 'Unknown SRS (-1)'
 
-            if self.canvas.layerCount() == 0:
-                self.canvas.setExtent( layer.extent() )
+            if self.legend.topLevelItemCount() == 0: # The canvas layer set may not be updated yet
+                self.zoomToLayerExtent( layer )
 
                 if srid != '-1':
                     print 'I: Map SRS (EPSG): %s' % self.layerSRID                    
@@ -324,47 +718,265 @@ class ViewerWnd( QMainWindow ):
         """ Returns the active layer in the layer list widget """
         return self.legend.activeLayer()
 
-    def getLayerProperties( self, l ):
-        """ Create a layer-properties string (l:layer)"""
-        print 'I: Generating layer properties...'
-        if l.type() == 0: # Vector
-            wkbType = ["WKBUnknown","WKBPoint","WKBLineString","WKBPolygon",
-                       "WKBMultiPoint","WKBMultiLineString","WKBMultiPolygon",
-                       "WKBNoGeometry","WKBPoint25D","WKBLineString25D","WKBPolygon25D",
-                       "WKBMultiPoint25D","WKBMultiLineString25D","WKBMultiPolygon25D"]
-            properties = "Source: %s\n" \
-                         "Geometry type: %s\n" \
-                         "Number of features: %s\n" \
-                         "Number of fields: %s\n" \
-                         "SRS (EPSG): %s\n" \
-                         "Extent: %s " \
-                          % ( l.source(), wkbType[l.wkbType()], l.featureCount(), 
-                              l.dataProvider().fields().count(), self.layerSRID, 
-                              l.extent().toString() )
-        elif l.type() == 1: # Raster
-            rType = [ "GrayOrUndefined (single band)", "Palette (single band)", "Multiband", "ColorLayer" ]
-            properties = "Source: %s\n" \
-                         "Raster type: %s\n" \
-                         "Width-Height (pixels): %sx%s\n" \
-                         "Bands: %s\n" \
-                         "SRS (EPSG): %s\n" \
-                         "Extent: %s" \
-                         % ( l.source(), rType[l.rasterType()], l.width(), l.height(),
-                             l.bandCount(), self.layerSRID, l.extent().toString() )
+    def layerExtent( self, layer ):
+        """ Return the best extent known for a layer without scanning its table, 
+            None if unknown. Try the cached extent, then the estimated one (from the
+            table statistics) and compute the exact extent in the background
+        """
+        key = extentKey( layer )
+        if key is None:
+            return layer.extent()
 
+        if key in self.extents:
+            extent, bExact = self.extents[ key ]
+        else:
+            extent, bExact = estimatedExtent( key ), False
+            if extent:
+                self.extents[ key ] = ( extent, False )
+
+        self.calculateExtent( key )
+        return QgsRectangle( extent ) if extent else None
+
+    def calculateExtent( self, key ):
+        """ Compute the exact extent of a table in the background, unless it's known or
+            being computed
+        """
+        if not self.extents.get( key, ( None, False ) )[ 1 ] and not key in self.extentCalculators:
+            calculator = ExtentCalculator( key, self )
+            self.connect( calculator, SIGNAL( "finished()" ), 
+                lambda key=key: self.extentCalculated( key ) )
+            self.extentCalculators[ key ] = calculator
+            calculator.start()
+
+    def zoomToLayerExtent( self, layer, factor=1.0 ):
+        """ Zoom to the best extent known for a layer, the view is refined once 
+            the exact extent is computed (unless the user has moved the map)
+        """
+        extent = self.layerExtent( layer )
+        if extent and not extent.isEmpty():
+            extent.scale( factor )
+            self.canvas.setExtent( extent )
+
+        key = extentKey( layer )
+        if key in self.extentCalculators:
+            self.pendingZoom = ( key, factor, QgsRectangle( self.canvas.extent() ) )
+        else:
+            self.pendingZoom = None
+
+    def extentCalculated( self, key ):
+        """ Slot. Cache the exact extent of a table and refine the pending zoom """
+        calculator = self.extentCalculators.pop( key )
+        if not calculator.extent:
+            print 'W: Exact extent could not be computed:', calculator.error
+            # Keep the estimated extent (if any) and don't scan the table again
+            self.extents[ key ] = ( self.extents.get( key, ( None, False ) )[ 0 ], True )
+            return
+        self.extents[ key ] = ( calculator.extent, True )
+        self.legend.refreshLayerProperties( key )
+
+        if self.pendingZoom and self.pendingZoom[ 0 ] == key:
+            key, factor, viewExtent = self.pendingZoom
+            self.pendingZoom = None
+            if self.canvas.extent() == viewExtent:
+                extent = QgsRectangle( calculator.extent )
+                extent.scale( factor )
+                self.navigate( lambda: self.canvas.setExtent( extent ) )
+
+    def getLayerSRS( self, l ):
+        """ Return the SRS description of the layer being added, for its properties """
+        srs = self.layerSRID
         self.layerSRID = '-1' # Initialize the srid 
-        return properties
+        return srs
+
+    def isOverviewLayer( self, layer ):
+        """ Check if a layer is a raster overview drawn in place of a legend layer """
+        return unicode( layer.id() ) in self.overviewLayerIds
+
+    def updateRasterOverviews( self ):
+        """ Draw each PostGIS raster through the overview that fits the canvas scale """
+        mapUnitsPerPixel = self.canvas.mapUnitsPerPixel()
+        extent = self.canvas.extent()
+        extent = ( extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum() )
+        bChanged = False
+        for overviews in self.rasterOverviews.values():
+            layer = overviews.drawnLayer( mapUnitsPerPixel, extent )
+            if layer is overviews.drawn:
+                continue
+
+            print 'I: Drawing %s with overview factor %d%s' % ( overviews.layer.name(), 
+                overviews.factor, " (tile cache)" if layer in overviews.cachedLayers.values() else "" )
+            overviews.drawn = layer
+            self.legend.setOverviewLayer( overviews.layer.id(), layer )
+            bChanged = True
+
+        if bChanged:
+            self.legend.updateLayerSet()
+        for overviews in self.rasterOverviews.values():
+            overviews.releaseLayers()
+
+    def removeRasterOverviews( self, layerId ):
+        """ Slot. Remove the overview layers of a raster layer being removed """
+        overviews = self.rasterOverviews.pop( unicode( layerId ), None )
+        if overviews:
+            overviews.remove()
+
+    def createRasterOverviews( self, layerId ):
+        """ Create the missing overviews of a PostGIS raster layer """
+        with tracing.span( "create raster overviews" ):
+            overviews = self.rasterOverviews.get( unicode( layerId ) )
+            if overviews:
+                overviews.createMissing()
+
+    def identifyFeatures( self, rect ):
+        """ Select and list the features of the visible vector layers intersecting a rectangle
+            (map units). Client-side layers are looked up in their spatial index (see LayerIndex)
+            once built, PostGIS ones in the spatial index of the server
+        """
+        with tracing.span( "identify" ):
+            QApplication.setOverrideCursor( Qt.WaitCursor )
+            try:
+                rectGeometry = QgsGeometry.fromRect( rect )
+                self.identifyResults.clear()
+                for i in range( self.legend.topLevelItemCount() ):
+                    item = self.legend.topLevelItem( i )
+                    if not item.isVect:
+                        continue
+                    layer = item.drawnCanvasLayer().layer()
+                    if not item.canvasLayer.isVisible():
+                        layer.setSelectedFeatures( [] )
+                        continue
+                    index = self.spatialIndexes.get( unicode( layer.id() ) )
+                    if index:
+                        fids = index.search( rect )
+                        features = layer.getFeatures( QgsFeatureRequest().setFilterFids( set( fids ) ) ) if fids else []
+                    else: # PostGIS layer, or index not built yet
+                        features = layer.getFeatures( QgsFeatureRequest().setFilterRect( rect ) )
+                    features = [ feature for feature in features 
+                        if feature.geometry() and feature.geometry().intersects( rectGeometry ) ]
+                    layer.setSelectedFeatures( [ feature.id() for feature in features ] )
+                    if features:
+                        self.addIdentifyResults( item.canvasLayer.layer().name(), layer, features )
+            finally:
+                QApplication.restoreOverrideCursor()
+            if self.identifyResults.topLevelItemCount():
+                self.IdentifyDock.raise_()
+
+    def addIdentifyResults( self, name, layer, features ):
+        """ List identified features of a layer with their attributes """
+        names = [ unicode( field.name() ) for field in layer.pendingFields().toList() ]
+        layerItem = QTreeWidgetItem( self.identifyResults, [ "%s (%d)" % ( name, len( features ) ) ] )
+        for feature in features[ :identify_limit ]:
+            featureItem = QTreeWidgetItem( layerItem, [ "Feature %d" % feature.id() ] )
+            for fieldName, value in zip( names, feature.attributes() ):
+                QTreeWidgetItem( featureItem, [ fieldName, value.toString() ] )
+        self.identifyResults.expandItem( layerItem )
+
+    def buildSpatialIndex( self, layer ):
+        """ Slot. Build the spatial index of a client-side vector layer (added or redrawn) in 
+            the background, identify uses its current index (if any) or filters its features 
+            by rectangle meanwhile
+        """
+        if layer.type() != 0 or not layer.providerType() in indexed_providers:
+            return
+        builder = SpatialIndexBuilder( layer, self )
+        self.indexBuilders[ builder.layerId ] = builder
+        self.connect( builder, SIGNAL( "finished()" ), self.spatialIndexBuilt )
+        builder.start()
+
+    def spatialIndexBuilt( self ):
+        """ Slot. Use a spatial index, unless its layer was removed or redrawn meanwhile """
+        builder = self.sender()
+        if self.indexBuilders.get( builder.layerId ) is builder:
+            del self.indexBuilders[ builder.layerId ]
+            if builder.index:
+                for features, removedFids in builder.changes:
+                    builder.index.update( features, removedFids )
+                self.spatialIndexes[ builder.layerId ] = builder.index
+                print 'I: Spatial index of %s (%d features) built in %.2f s' % ( builder.name,
+                    len( builder.index.fids ), builder.seconds )
+            else:
+                self.spatialIndexes.pop( builder.layerId, None )
+                print 'W: Spatial index of %s could not be built' % builder.name
+        builder.deleteLater()
+
+    def updateSpatialIndex( self, layer, features, removedFids ):
+        """ Update the spatial index of a memory layer whose features were added and removed,
+            it's rebuilt in the background once it has changed too much
+        """
+        layerId = unicode( layer.id() )
+        index = self.spatialIndexes.get( layerId )
+        builder = self.indexBuilders.get( layerId )
+        if builder:
+            builder.changes.append( ( features, removedFids ) ) # Made after its features were read
+        if index:
+            index.update( features, removedFids )
+            if index.isStale() and not builder:
+                self.buildSpatialIndex( layer )
+        elif not builder:
+            self.buildSpatialIndex( layer )
+
+    def dropSpatialIndex( self, layerId ):
+        """ Slot. Forget the spatial index of a layer, it's removed or its features have changed """
+        self.spatialIndexes.pop( unicode( layerId ), None )
+        self.indexBuilders.pop( unicode( layerId ), None ) # Its result will be dropped
+
+    def cacheFeatures( self, layer ):
+        """ Slot. Draw PostGIS vector layers (e.g., from loadLayer() or the Fast SQL Layer) 
+            from the feature cache
+        """
+        if self.isOverviewLayer( layer ) or extentKey( layer ) is None:
+            return
+        self.featureTiles[ unicode( layer.id() ) ] = FeatureTiles( self, layer )
+        QTimer.singleShot( 0, self.updateFeatureTiles ) # Once the layer is in the legend
+
+    def removeFeatureTiles( self, layerId ):
+        """ Slot. Remove the memory layer drawn in place of a vector layer being removed """
+        tiles = self.featureTiles.pop( unicode( layerId ), None )
+        if tiles:
+            tiles.remove()
+
+    def updateFeatureTiles( self ):
+        """ Draw each PostGIS vector layer with the cached tiles covering the canvas """
+        for tiles in self.featureTiles.values():
+            tiles.update()
+        self.updateFeatureCacheStatus()
+
+    def updateFeatureCacheStatus( self ):
+        """ Show the hit ratio of the feature cache, and the bytes it saved in the tooltip """
+        hits, misses, ratio, saved, size = self.featureCache.stats()
+        self.lblFeatureCache.setText( "Cache: %d%%" % round( ratio * 100 ) )
+        self.lblFeatureCache.setToolTip( "Feature cache: %d hits, %d misses, %s not fetched again, %s cached" % (
+            hits, misses, budget.formatBytes( saved ), budget.formatBytes( size ) ) )
 
     def changeScale( self, scale ):
-        self.lblScale.setText( "Scale 1:" + formatNumber( scale ) )
+        self.lastScale = scale
+        if not self.statusTimer.isActive():
+            self.statusTimer.start()
 
     def updateXY( self, p ):
-        if self.canvas.mapUnits() == 2: # Degrees
-            self.lblXY.setText( formatToDegrees( p.x() ) + " | " \
-                + formatToDegrees( p.y() ) )
-        else: # Unidad lineal
-            self.lblXY.setText( formatNumber( p.x() ) + " | " \
-                + formatNumber( p.y() ) + "" )
+        self.lastXY = ( p.x(), p.y() )
+        if not self.statusTimer.isActive():
+            self.statusTimer.start()
+
+    def updateConnectionStatus( self ):
+        """ Show the database connections of the broker, per database and kind in the tooltip """
+        stats = connections.broker.stats()
+        self.lblConnections.setText( "DB: %d" % sum( busy + idle for database, kind, busy, idle in stats ) )
+        self.lblConnections.setToolTip( "\n".join( "%s (%s): %d in use, %d idle" % ( connections.describe( database ), 
+            kind, busy, idle ) for database, kind, busy, idle in stats if busy or idle ) or "No database connections" )
+
+    def updateStatusBar( self ):
+        """ Show the last coordinates and scale received since the previous update """
+        if self.lastScale is not None:
+            self.lblScale.setText( "Scale 1:" + formatNumber( self.lastScale ) )
+            self.lastScale = None
+        if self.lastXY is not None:
+            x, y = self.lastXY
+            if self.canvas.mapUnits() == 2: # Degrees
+                self.lblXY.setText( formatToDegrees( x ) + " | " + formatToDegrees( y ) )
+            else: # Unidad lineal
+                self.lblXY.setText( formatNumber( x ) + " | " + formatNumber( y ) )
+            self.lastXY = None
 
 
 # Class to expose qgis objects and functionalities to plugins
@@ -382,15 +994,15 @@ class QgisInterface( QObject ):
 
     def zoomFull( self ):
         """ Zoom to the map full extent """
-        self.canvas.zoomToFullExtent()
+        self.myApp.navigate( self.canvas.zoomToFullExtent )
 
     def zoomToPrevious( self ):
         """ Zoom to previous view extent """
-        self.canvas.zoomToPreviousExtent()
+        self.myApp.navigate( self.canvas.zoomToPreviousExtent )
 
     def zoomToNext( self ):
         """ Zoom to next view extent """
-        self.canvas.zoomToNextExtent()
+        self.myApp.navigate( self.canvas.zoomToNextExtent )
 
     def activeLayer( self ):
         """ Get pointer to the active layer (layer selected in the legend) """
@@ -430,47 +1042,1092 @@ class QgisInterface( QObject ):
         self.myApp.tabifyDockWidget( self.myApp.LegendDock, dockwidget )
         self.myApp.LegendDock.raise_() # legendDock at the top
 
-# Class to manage plugins (Read and load the existing plugins)
+# Class to manage plugins (Read the manifest and load plugins on demand)
 class Plugins():
-    """ Class to manage plugins (Read and load existing plugins) """
+    """ Class to manage plugins (Read existing plugins and load them on demand) """
     def __init__( self, myApp, canvas, host, port, dbname, user, passwd ):
         self.qgisInterface = QgisInterface( myApp, canvas )
         self.myApp = myApp
+        self.connectionArgs = ( host, port, dbname, user, passwd )
         self.plugins = []
+        self.actions = {} # Plugin name -> toolbar action shown until the plugin is loaded
         self.pluginsDirName = 'plugins'
-        regExpString = '^def +classFactory\(.*iface.*(\):)$' # To find the classFactory line
-
-        """ Validate that it is a plugins' folder and load them into the application """
-        dir_plugins = os.path.join( os.path.dirname(__file__), self.pluginsDirName )
-
-        if os.path.exists( dir_plugins ):
-            for root, dirs, files in os.walk( dir_plugins ):
-                bPlugIn = False
-
-                if not dir_plugins == root: 
-                    if '__init__.py' in files: 
-                        for line in fileinput.input( os.path.join( root, '__init__.py' ) ):
-                            linea = line.strip()
-                            if re.match( regExpString, linea ):
-                                bPlugIn = True
-                                break
-                        fileinput.close()
-
-                        if bPlugIn:
-                            plugin_name = os.path.basename( root )
-                            f, filename, description = imp.find_module( plugin_name, [ dir_plugins ] )
-
-                            try: 
-                                package = imp.load_module( plugin_name, f, filename, description )
-                                self.plugins.append( package.classFactory( self.qgisInterface, host, port, dbname, user, passwd ) )
-                            except Exception, e:
-                                print 'E: Plugin ' + plugin_name + ' could not be loaded. ERROR!:',e
-                            else:
-                                self.plugins[ -1 ].initGui()
-                                print 'I: Plugin ' + plugin_name + ' successfully loaded!'
+        self.dirPlugins = os.path.join( os.path.dirname(__file__), self.pluginsDirName )
+
+        """ Validate that it is a plugins' folder and add an action per plugin, 
+            plugins are imported when their action is triggered for the first time
+        """
+        if os.path.exists( self.dirPlugins ):
+            for plugin_name, title, iconPath in self.readManifest():
+                action = QAction( QIcon( iconPath ), title, myApp )
+                myApp.connect( action, SIGNAL( "triggered()" ), 
+                    lambda plugin_name=plugin_name: self.loadPlugin( plugin_name ) )
+                self.qgisInterface.addToolBarIcon( action )
+                self.actions[ plugin_name ] = action
         else:
             print "Plugins folder not found."
 
+    def readManifest( self ):
+        """ Return ( plugin name, title, icon path ) of the plugins. The manifest is 
+            cached on disk and only the plugins whose __init__.py changed are read
+        """
+        manifest = {} # Plugin name -> ( __init__.py mtime, title, icon path ), title is None if not a plugin
+        try:
+            f = open( plugins_manifest_file, 'rb' )
+            try:
+                manifest = pickle.load( f )
+            finally:
+                f.close()
+        except Exception:
+            pass
+
+        plugins = []
+        found = set()
+        bChanged = False
+        for plugin_name in sorted( os.listdir( self.dirPlugins ) ):
+            initFile = os.path.join( self.dirPlugins, plugin_name, '__init__.py' )
+            try:
+                mtime = os.path.getmtime( initFile )
+            except OSError:
+                continue # Not a package
+            found.add( plugin_name )
+            entry = manifest.get( plugin_name )
+            if entry is None or entry[ 0 ] != mtime:
+                entry = ( mtime, ) + self.scanPlugin( plugin_name, initFile )
+                manifest[ plugin_name ] = entry
+                bChanged = True
+            if entry[ 1 ]:
+                plugins.append( ( plugin_name, entry[ 1 ], entry[ 2 ] ) )
+
+        for plugin_name in set( manifest ) - found: # Removed plugins
+            del manifest[ plugin_name ]
+            bChanged = True
+
+        if bChanged:
+            try:
+                if not os.path.isdir( os.path.dirname( plugins_manifest_file ) ):
+                    os.makedirs( os.path.dirname( plugins_manifest_file ) )
+                f = open( plugins_manifest_file, 'wb' )
+                try:
+                    pickle.dump( manifest, f, pickle.HIGHEST_PROTOCOL )
+                finally:
+                    f.close()
+            except EnvironmentError, e:
+                print 'W: Plugins manifest could not be saved:', e
+        return plugins
+
+    def scanPlugin( self, plugin_name, initFile ):
+        """ Read the title and icon path of a plugin from its __init__.py, 
+            ( None, None ) if it has no classFactory
+        """
+        f = open( initFile, 'rU' )
+        try:
+            source = f.read()
+        finally:
+            f.close()
+
+        if not re.search( '^def +classFactory\(.*iface.*(\):)$', source, re.M ): # To find the classFactory line
+            return ( None, None )
+
+        title = re.search( '^def +name\(\):\s*return +["\'](.*)["\']', source, re.M )
+        icon = re.search( '^def +icon\(\):\s*return +["\'](.*)["\']', source, re.M )
+        return ( title.group( 1 ) if title else plugin_name,
+            os.path.join( os.path.dirname( initFile ), icon.group( 1 ) ) if icon else '' )
+
+    def loadPlugin( self, plugin_name ):
+        """ Import a plugin and create its GUI, replacing its startup action """
+        action = self.actions.get( plugin_name )
+        if not action:
+            return
+
+        f, filename, description = imp.find_module( plugin_name, [ self.dirPlugins ] )
+        try: 
+            package = imp.load_module( plugin_name, f, filename, description )
+            plugin = package.classFactory( self.qgisInterface, *self.connectionArgs )
+            plugin.initGui()
+        except Exception, e:
+            print 'E: Plugin ' + plugin_name + ' could not be loaded. ERROR!:',e
+            return
+        finally:
+            if f:
+                f.close()
+
+        del self.actions[ plugin_name ]
+        self.qgisInterface.removeToolBarIcon( action )
+        self.plugins.append( plugin )
+        print 'I: Plugin ' + plugin_name + ' successfully loaded!'
+
+        # The click that loaded the plugin is meant for the plugin
+        pluginAction = getattr( plugin, 'action', None )
+        if isinstance( pluginAction, QAction ):
+            pluginAction.trigger()
+
+# Base class of the threads that run SQL for a user action
+class TracedThread( QThread ):
+    """ Thread whose statements are attributed to the action that started it (see tracing.py).
+        Subclasses implement work() instead of run()
+    """
+    def __init__( self, parent=None ):
+        QThread.__init__( self, parent )
+        self.span = tracing.attach()
+
+    def run( self ):
+        with tracing.resume( self.span ):
+            self.work()
+        removeClosedDatabases() # No longer referenced by work()
+
+
+# Classes to check and maintain PostGIS tables in the background (using GeoDB)
+class TableAdvisor( TracedThread ):
+    """ Look for a missing spatial index and missing or stale statistics of a table. Once 
+        finished, advice is a list with 'index' and/or 'analyze' (bStale if the table was analyzed)
+    """
+    def __init__( self, postgis_utils, dictOpts, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.postgis_utils = postgis_utils
+        self.dictOpts = dict( dictOpts )
+        self.advice = []
+        self.bStale = False
+
+    def work( self ):
+        try:
+            with self.postgis_utils.shared_connection( self.dictOpts['-h'], int( self.dictOpts['-p'] ), 
+                    self.dictOpts['-d'], self.dictOpts['-U'], self.dictOpts['-W'] ) as db:
+                table, schema, geom = self.dictOpts['-t'], self.dictOpts['-s'], self.dictOpts['-g']
+                stats = db.get_table_analyze_info( table, schema )
+                if stats is None: # Not a table (e.g., a view)
+                    return
+                geomNums = [ field.num for field in db.get_table_fields( table, schema ) if field.name == geom ]
+                bIndexed = False
+                for index in db.get_table_indexes( table, schema ):
+                    if index.method == 'gist' and set( geomNums ) & set( index.columns ):
+                        bIndexed = True
+                if not bIndexed:
+                    self.advice.append( 'index' )
+                live, dead, lastAnalyze, modified = stats
+                if lastAnalyze is None:
+                    self.advice.append( 'analyze' )
+                elif max( dead, modified or 0 ) > stale_statistics_rows + stale_statistics_ratio * live:
+                    self.advice.append( 'analyze' )
+                    self.bStale = True
+        except Exception, e:
+            print 'W: Table could not be checked:', e
+            self.advice = []
+
+
+class TableMaintenance( TracedThread ):
+    """ Run a table maintenance task ('index' or 'analyze') with GeoDB """
+    def __init__( self, postgis_utils, dictOpts, task, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.postgis_utils = postgis_utils
+        self.dictOpts = dict( dictOpts )
+        self.task = task
+        self.error = ''
+
+    def work( self ):
+        try:
+            with self.postgis_utils.shared_connection( self.dictOpts['-h'], int( self.dictOpts['-p'] ), 
+                    self.dictOpts['-d'], self.dictOpts['-U'], self.dictOpts['-W'] ) as db:
+                if self.task == 'index':
+                    db.create_spatial_index( self.dictOpts['-t'], self.dictOpts['-s'], self.dictOpts['-g'] )
+                # A new index is only used by the planner with fresh statistics
+                db.vacuum_analyze( self.dictOpts['-t'], self.dictOpts['-s'] )
+        except Exception, e:
+            self.error = unicode( e )
+
+
+# Classes to browse the database catalog
+class Browser( QWidget ):
+    """ Schemas and tables of the database. Tables are read with GeoDB when their schema 
+        is expanded, browser_page_size at a time, and the filter is run by the server
+    """
+    def __init__( self, viewer, postgis_utils, dictOpts ):
+        QWidget.__init__( self, viewer )
+        self.viewer = viewer
+        self.postgis_utils = postgis_utils
+        self.dictOpts = dictOpts
+        self.cache = {} # ( kind, schema, filter, offset ) -> rows
+        self.schemaItems = {} # Schema name -> item
+        self.filterText = ''
+
+        self.txtFilter = QLineEdit( self )
+        self.txtFilter.setPlaceholderText( "Filter tables" )
+        self.tree = QTreeWidget( self )
+        self.tree.setHeaderHidden( True )
+        layout = QVBoxLayout( self )
+        layout.setContentsMargins( 0, 0, 0, 0 )
+        layout.addWidget( self.txtFilter )
+        layout.addWidget( self.tree )
+
+        self.filterTimer = QTimer( self ) # Wait until the user stops typing
+        self.filterTimer.setSingleShot( True )
+        self.filterTimer.setInterval( 300 )
+        self.connect( self.filterTimer, SIGNAL( "timeout()" ), self.applyFilter )
+        self.connect( self.txtFilter, SIGNAL( "textChanged(QString)" ), self.filterTimer.start )
+        self.connect( self.tree, SIGNAL( "itemExpanded(QTreeWidgetItem*)" ), self.expandItem )
+        self.connect( self.tree, SIGNAL( "itemActivated(QTreeWidgetItem*,int)" ), self.activateItem )
+
+        self.request( 'schemas', None, '', 0 )
+
+    def request( self, kind, schema, text, offset ):
+        """ Show a page of the catalog, reading it in the background if it's not cached """
+        with tracing.span( "browse catalog" ):
+            key = ( kind, schema, text, offset )
+            if key in self.cache:
+                self.showRows( key, self.cache[ key ] )
+                return
+            loader = CatalogLoader( self.postgis_utils, self.dictOpts, key, self )
+            self.connect( loader, SIGNAL( "finished()" ), self.catalogLoaded )
+            loader.start()
+
+    def catalogLoaded( self ):
+        """ Slot. Cache and show the rows read by a catalog loader """
+        loader = self.sender()
+        if loader.error:
+            print 'W: Catalog could not be read:', loader.error
+            return
+        self.cache[ loader.key ] = loader.rows
+        self.showRows( loader.key, loader.rows )
+
+    def applyFilter( self ):
+        """ Slot. Show the tables matching the filter, or the schemas if there is no filter """
+        self.filterText = unicode( self.txtFilter.text() ).strip()
+        self.tree.clear()
+        self.schemaItems = {}
+        if self.filterText:
+            self.request( 'tables', None, self.filterText, 0 )
+        else:
+            self.request( 'schemas', None, '', 0 )
+
+    def schemaItem( self, schema ):
+        """ Return the item of a schema, creating it if needed """
+        if not schema in self.schemaItems:
+            item = QTreeWidgetItem( [ schema ] )
+            item.schema = schema
+            item.bLoaded = False
+            item.setChildIndicatorPolicy( QTreeWidgetItem.ShowIndicator )
+            self.tree.addTopLevelItem( item )
+            self.schemaItems[ schema ] = item
+        return self.schemaItems[ schema ]
+
+    def showRows( self, key, rows ):
+        kind, schema, text, offset = key
+        if text != self.filterText: # Outdated
+            return
+
+        if kind == 'schemas':
+            for row in rows: # ( oid, name, owner, perms )
+                self.schemaItem( row[ 1 ] )
+            return
+
+        if schema is not None: # Empty schemas lose their expand indicator
+            self.schemaItem( schema ).setChildIndicatorPolicy( QTreeWidgetItem.DontShowIndicatorWhenChildless )
+        for row in rows[ :browser_page_size ]: # ( relname, nspname, relkind, ..., geometry column, ... )
+            parent = self.schemaItem( row[ 1 ] )
+            parent.bLoaded = True
+            item = QTreeWidgetItem( [ row[ 0 ] + ( " (%s)" % row[ 6 ] if row[ 6 ] else "" ) ] )
+            item.table = ( row[ 1 ], row[ 0 ], row[ 6 ] )
+            parent.addChild( item )
+            if text:
+                parent.setExpanded( True )
+
+        if len( rows ) > browser_page_size:
+            more = QTreeWidgetItem( [ "More..." ] )
+            more.nextPage = ( schema, offset + browser_page_size )
+            if schema is None: # Filtered tables of all schemas
+                self.tree.addTopLevelItem( more )
+            else:
+                self.schemaItem( schema ).addChild( more )
+
+    def expandItem( self, item ):
+        """ Slot. Read the first page of tables of a schema the first time it's expanded """
+        if hasattr( item, 'schema' ) and not item.bLoaded:
+            item.bLoaded = True
+            self.request( 'tables', item.schema, self.filterText, 0 )
+
+    def activateItem( self, item, column ):
+        """ Slot. Load a table or read the next page of tables """
+        if hasattr( item, 'nextPage' ):
+            schema, offset = item.nextPage
+            if item.parent():
+                item.parent().removeChild( item )
+            else:
+                self.tree.takeTopLevelItem( self.tree.indexOfTopLevelItem( item ) )
+            self.request( 'tables', schema, self.filterText, offset )
+        elif hasattr( item, 'table' ):
+            self.viewer.loadTable( *item.table )
+
+
+class CatalogLoader( TracedThread ):
+    """ Read schemas or a page of tables with GeoDB, using its own connection """
+    def __init__( self, postgis_utils, dictOpts, key, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.postgis_utils = postgis_utils
+        self.dictOpts = dictOpts
+        self.key = key # ( 'schemas' or 'tables', schema, filter, offset )
+        self.rows = []
+        self.error = ''
+
+    def work( self ):
+        kind, schema, text, offset = self.key
+        try:
+            with self.postgis_utils.shared_connection( self.dictOpts['-h'], int( self.dictOpts['-p'] ), 
+                    self.dictOpts['-d'], self.dictOpts['-U'], self.dictOpts['-W'] ) as db:
+                if kind == 'schemas':
+                    self.rows = db.list_schemas()
+                else: # One more row to know whether there is a next page
+                    self.rows = db.list_geotables( schema, browser_page_size + 1, offset, text or None )
+        except Exception, e:
+            self.error = unicode( e )
+
+
+# Class to compute the exact extent of PostGIS tables in the background
+class ExtentCalculator( TracedThread ):
+    """ Compute the extent of a PostGIS table (or query) with ST_Extent, using its own 
+        connection and giving up after extent_timeout ms. Once finished, extent is 
+        a QgsRectangle (None if it couldn't be computed)
+    """
+    def __init__( self, key, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.key = key
+        self.extent = None
+        self.error = ''
+
+    def work( self ):
+        with sharedDatabase( extentConnectionOpts( self.key ) ) as d:
+            if d.isOpen():
+                query = TracedQuery( d )
+                query.exec_( "SET statement_timeout = %d" % extent_timeout )
+                if query.exec_( "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM \
+                        ( SELECT ST_Extent(%s) AS e FROM %s ) AS extent" % ( 
+                        quoteIdentifier( self.key[ 7 ] ), extentSource( self.key ) ) ) and query.next():
+                    self.extent = rectangleFromQuery( query )
+                else:
+                    self.error = unicode( query.lastError().text() )
+                del query
+            else:
+                self.error = unicode( d.lastError().text() )
+
+# A couple of classes to draw PostGIS rasters through their overviews
+class RasterOverviews( QObject ):
+    """ Keep track of the overview tables (raster_overviews) of a PostGIS raster
+        layer and choose the one that best fits the canvas scale
+    """
+    def __init__( self, viewer, layer, dictOpts ):
+        QObject.__init__( self, viewer )
+        self.viewer = viewer
+        self.layer = layer # Base layer, the one shown in the legend
+        self.dictOpts = dict( dictOpts )
+        self.overviews = list( dictOpts.get( 'overviews', [] ) ) # ( schema, table, factor )
+        self.layers = {} # factor -> QgsRasterLayer, created on demand
+        self.cachedLayers = {} # factor -> QgsRasterLayer of a VRT of cached tiles (see cachedLayer())
+        self.cachedViews = {} # factor -> ( extent, VRT path, tile ids pinned ) of the cached layer
+        self.released = [] # ( factor, layer, view ) not drawn anymore, see releaseLayers()
+        self.fillers = {} # factor -> RasterCacheFiller running
+        self.checked = {} # factor -> time its table was last checked for changes
+        self.failed = {} # factor -> time of the last filler error
+        self.factor = 1 # Factor to draw, 1 is the base table
+        self.drawn = None # Layer drawn instead of the base layer
+        self.builder = None
+        self.bRemoved = False
+
+    def bestFactor( self, mapUnitsPerPixel ):
+        """ Return the coarsest overview factor whose pixels are not bigger than the canvas ones """
+        pixelSize = self.layer.rasterUnitsPerPixelX()
+        best = 1
+        for schema, table, factor in self.overviews:
+            if factor > best and pixelSize * factor <= mapUnitsPerPixel:
+                best = factor
+        return best
+
+    def drawnLayer( self, mapUnitsPerPixel, extent ):
+        """ Return the layer to draw at a scale, None to draw the base layer.
+            extent: ( xMin, yMin, xMax, yMax ) viewed, its tiles are cached
+        """
+        self.factor = self.bestFactor( mapUnitsPerPixel )
+        if self.viewer.rasterCache and self.levelTable( self.factor ):
+            layer = self.cachedLayer( self.factor, extent )
+            if layer:
+                return layer
+        if self.factor == 1:
+            return None
+        return self.overviewLayer( self.factor ) or self.drawn
+
+    def levelTable( self, factor ):
+        """ Return ( schema, table ) of an overview factor, None if there is no such overview """
+        if factor == 1:
+            return ( self.dictOpts['-s'], self.dictOpts['-t'] )
+        for schema, table, f in self.overviews:
+            if f == factor:
+                return ( schema, table )
+        return None
+
+    def overviewLayer( self, factor ):
+        """ Return the raster layer of an overview factor, create it if necessary """
+        if not factor in self.layers:
+            if not self.levelTable( factor ):
+                return None
+            schema, table = self.levelTable( factor )
+            layer = QgsRasterLayer( rasterConnString( self.dictOpts, schema, table ), self.layer.name() )
+            if not layer.isValid():
+                print 'E: Overview %s.%s could not be loaded' % ( schema, table )
+                return None
+            self.addLayer( layer )
+            self.layers[ factor ] = layer
+        return self.layers[ factor ]
+
+    def addLayer( self, layer ):
+        """ Register a layer to be drawn in place of the base layer """
+        layer.setContrastEnhancement( QgsContrastEnhancement.StretchToMinimumMaximum )
+        self.viewer.overviewLayerIds.add( unicode( layer.id() ) )
+        QgsMapLayerRegistry.instance().addMapLayer( layer )
+
+    def removeLayer( self, layer ):
+        self.viewer.overviewLayerIds.discard( unicode( layer.id() ) )
+        QgsMapLayerRegistry.instance().removeMapLayer( layer.id() )
+
+    def levelKey( self, factor ):
+        """ Return the tile cache key of an overview factor """
+        schema, table = self.levelTable( factor )
+        return ( "%s:%s/%s@%s" % ( self.dictOpts['-h'], self.dictOpts['-p'], self.dictOpts['-d'],
+            self.dictOpts['-U'] ), schema, table, self.dictOpts['col'], factor )
+
+    def cachedLayer( self, factor, extent ):
+        """ Return the layer of a VRT of the cached tiles of an overview factor covering extent,
+            None if some are missing (they're cached in the background meanwhile)
+        """
+        cache = self.viewer.rasterCache
+        levelKey = self.levelKey( factor )
+        now = time.time()
+        bCheck = now - self.checked.get( factor, 0 ) > raster_cache_check_interval
+        if factor in self.cachedViews and containsExtent( self.cachedViews[ factor ][ 0 ], extent ):
+            if bCheck:
+                self.fillCache( factor, self.cachedViews[ factor ][ 0 ], True )
+            return self.cachedLayers[ factor ]
+
+        view = scaleExtent( extent, raster_cache_margin )
+        path, tileIds = cache.extentVrt( levelKey, view )
+        layer = None
+        if path:
+            layer = QgsRasterLayer( path, self.layer.name() )
+            if layer.isValid():
+                self.releaseLayer( factor )
+                cache.pin( levelKey, tileIds )
+                self.addLayer( layer )
+                self.cachedLayers[ factor ] = layer
+                self.cachedViews[ factor ] = ( view, path, tileIds )
+            else:
+                cache.removeVrt( path )
+                layer = None
+        if bCheck or ( not layer and not cache.covers( levelKey, view ) and
+                now - self.failed.get( factor, 0 ) > raster_cache_check_interval ):
+            self.fillCache( factor, view, bCheck )
+        return layer
+
+    def fillCache( self, factor, extent, bCheck ):
+        """ Cache the tiles of an overview factor within extent in the background, checking
+            first whether its table has changed if bCheck
+        """
+        if factor in self.fillers:
+            return
+        if bCheck:
+            self.checked[ factor ] = time.time()
+        filler = RasterCacheFiller( self.viewer.rasterCache, self.dictOpts, self.levelKey( factor ),
+            extent, bCheck, self )
+        self.fillers[ factor ] = filler
+        self.connect( filler, SIGNAL( "finished()" ), lambda: self.cacheFilled( factor ) )
+        filler.start()
+
+    def cacheFilled( self, factor ):
+        """ Slot. Draw the tiles just cached, from the database if the table has changed """
+        filler = self.fillers.pop( factor )
+        if filler.error:
+            print 'W: Tiles of %s (factor %d) not cached: %s' % ( self.layer.name(), factor, filler.error )
+            self.failed[ factor ] = time.time()
+        if self.bRemoved:
+            return
+        if filler.bChanged and factor in self.cachedLayers:
+            print 'I: %s (factor %d) has changed, its tiles will be cached again' % ( self.layer.name(), factor )
+            self.releaseLayer( factor )
+        self.viewer.updateRasterOverviews()
+
+    def releaseLayer( self, factor ):
+        """ Stop drawing the cached layer of a factor, it's removed by releaseLayers() """
+        if factor in self.cachedLayers:
+            self.released.append( ( factor, self.cachedLayers.pop( factor ), self.cachedViews.pop( factor ) ) )
+
+    def releaseLayers( self ):
+        """ Remove the cached layers not drawn anymore, unpin their tiles and remove their VRTs """
+        released, self.released = self.released, []
+        for factor, layer, ( view, path, tileIds ) in released:
+            self.removeLayer( layer )
+            self.viewer.rasterCache.unpin( self.levelKey( factor ), tileIds )
+            self.viewer.rasterCache.removeVrt( path )
+
+    def remove( self ):
+        """ Remove the layers drawn in place of the base layer, it's being removed """
+        self.bRemoved = True
+        for filler in self.fillers.values():
+            filler.cancel()
+        for factor in self.cachedLayers.keys():
+            self.releaseLayer( factor )
+        self.releaseLayers()
+        for layer in self.layers.values():
+            self.removeLayer( layer )
+
+    def missingFactors( self ):
+        """ Return the power-of-two factors without overview, down to a 256 pixels raster """
+        existing = [ f for s, t, f in self.overviews ]
+        size = max( self.layer.width(), self.layer.height() )
+        factors = []
+        factor = 2
+        while size / factor >= 256:
+            if not factor in existing:
+                factors.append( factor )
+            factor *= 2
+        return factors
+
+    def createMissing( self ):
+        """ Run ST_CreateOverview for the missing factors in the background """
+        if self.builder and self.builder.isRunning():
+            return
+
+        factors = self.missingFactors()
+        if not factors:
+            QMessageBox.information( self.viewer, "Raster overviews",
+                "Layer '%s' already has all its overviews." % self.layer.name() )
+            return
+
+        self.progress = QProgressDialog( "Creating overviews of '%s'..." % self.layer.name(),
+            "Cancel", 0, len( factors ), self.viewer )
+        self.progress.setMinimumDuration( 0 )
+        self.progress.setValue( 0 )
+
+        self.builder = OverviewBuilder( self.dictOpts, factors, self )
+        self.connect( self.builder, SIGNAL( "overviewCreated(int)" ), self.progress.setValue )
+        self.connect( self.builder, SIGNAL( "finished()" ), self.builderFinished )
+        self.connect( self.progress, SIGNAL( "canceled()" ), self.builder.cancel )
+        self.builder.start()
+
+    def builderFinished( self ):
+        """ Slot. Start using the new overviews """
+        self.progress.close()
+        if self.builder.error:
+            QMessageBox.warning( self.viewer, "Raster overviews",
+                "Overviews could not be created:\n" + self.builder.error )
+        if self.builder.overviews:
+            self.overviews = self.builder.overviews
+            print 'I: %d overviews available for %s' % ( len( self.overviews ), self.layer.name() )
+            self.viewer.updateRasterOverviews()
+
+
+class OverviewBuilder( TracedThread ):
+    """ Create overviews of a PostGIS raster with ST_CreateOverview, using its own connection """
+    def __init__( self, dictOpts, factors, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.dictOpts = dictOpts
+        self.factors = factors
+        self.overviews = [] # Overviews registered once finished
+        self.error = ''
+        self.bCancel = False
+
+    def cancel( self ):
+        """ Slot. Stop after the overview being created """
+        self.bCancel = True
+
+    def work( self ):
+        with sharedDatabase( self.dictOpts ) as d:
+            if d.isOpen():
+                query = TracedQuery( d )
+                table = '"%s"."%s"' % ( self.dictOpts['-s'].replace( '"', '""' ),
+                    self.dictOpts['-t'].replace( '"', '""' ) )
+                for i, factor in enumerate( self.factors ):
+                    if self.bCancel:
+                        break
+                    if not query.exec_( "SELECT ST_CreateOverview( '%s'::regclass, '%s', %d )" % (
+                            table.replace( "'", "''" ), self.dictOpts['col'].replace( "'", "''" ), factor ) ):
+                        self.error = unicode( query.lastError().text() )
+                        break
+                    self.emit( SIGNAL( "overviewCreated(int)" ), i + 1 )
+
+                self.overviews = getRasterOverviews( query, self.dictOpts['-s'],
+                    self.dictOpts['-t'], self.dictOpts['col'] )
+                del query
+            else:
+                self.error = unicode( d.lastError().text() )
+
+
+class RasterCacheFiller( TracedThread ):
+    """ Cache the tiles of a PostGIS raster table (an overview level) within an extent, using
+        its own connection. If bCheck, the table is checked for changes first: a token of its
+        file node, size and write counters (see levelToken()), no need to read its tiles.
+        bChanged tells whether the cached tiles were dropped because the table has changed
+    """
+    batchSize = 50 # Tiles fetched per query
+
+    def __init__( self, cache, dictOpts, levelKey, extent, bCheck, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.cache = cache
+        self.dictOpts = dictOpts
+        self.levelKey = levelKey
+        self.extent = extent
+        self.bCheck = bCheck
+        self.bChanged = False
+        self.error = ''
+        self.bCancel = False
+
+    def cancel( self ):
+        """ Slot. Stop after the batch of tiles being fetched """
+        self.bCancel = True
+
+    def work( self ):
+        with sharedDatabase( self.dictOpts ) as d:
+            if d.isOpen():
+                self.fill( TracedQuery( d ) )
+            else:
+                self.error = unicode( d.lastError().text() )
+
+    def fill( self, query ):
+        connection, schema, table, column, factor = self.levelKey
+        table = '"%s"."%s"' % ( schema.replace( '"', '""' ), table.replace( '"', '""' ) )
+        column = '"%s"' % column.replace( '"', '""' )
+
+        level = self.cache.level( self.levelKey )
+        if self.bCheck or level is None:
+            if not query.exec_( "SELECT c.relfilenode, pg_relation_size(c.oid), s.n_tup_ins, s.n_tup_upd, \
+                    s.n_tup_del FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid \
+                    WHERE c.oid = '%s'::regclass" % table.replace( "'", "''" ) ) or not query.next():
+                self.error = unicode( query.lastError().text() ) or "Table not found"
+                return
+            token = levelToken( unicode( query.value( i ).toString() ) for i in range( 5 ) )
+            if level is None or level.token != token:
+                self.bChanged = level is not None
+                level = self.describe( query, table, column, token )
+                if level is None:
+                    return
+
+        if self.cache.covers( self.levelKey, self.extent ):
+            return
+        if not level.isListed( self.extent ):
+            # Tiles within the extent (through the spatial index of the table), and their georeference
+            xMin, yMin, xMax, yMax = self.extent
+            if not query.exec_( "SELECT ctid::text, ST_UpperLeftX(%(c)s), ST_UpperLeftY(%(c)s), \
+                    ST_ScaleX(%(c)s), ST_ScaleY(%(c)s), ST_SkewX(%(c)s), ST_SkewY(%(c)s), \
+                    ST_Width(%(c)s), ST_Height(%(c)s) FROM %(t)s \
+                    WHERE %(c)s && ST_MakeEnvelope(%(x1)r, %(y1)r, %(x2)r, %(y2)r, %(srid)d)" % { 'c':column, 't':table,
+                    'x1':xMin, 'y1':yMin, 'x2':xMax, 'y2':yMax, 'srid':level.srid } ):
+                self.error = unicode( query.lastError().text() )
+                return
+            tiles = {}
+            while query.next():
+                tiles[ str( query.value( 0 ).toString() ) ] = [ query.value( i ).toDouble()[ 0 ] for i in range( 1, 7 ) ] + \
+                    [ query.value( 7 ).toInt()[ 0 ], query.value( 8 ).toInt()[ 0 ] ]
+            self.cache.addListing( self.levelKey, self.extent, tiles )
+
+        tiles = self.cache.tilesIn( self.levelKey, self.extent )
+        if levelBytes( tiles.values(), level.bands ) > self.cache.maxBytes / 2:
+            self.error = "Too big for the tile cache"
+            return
+        missing = [ tileId for tileId in tiles if not self.cache.hasTile( self.levelKey, tileId ) ]
+        for i in range( 0, len( missing ), self.batchSize ):
+            if self.bCancel:
+                return
+            batch = missing[ i:i + self.batchSize ]
+            if not query.exec_( "SELECT ctid::text, ST_AsGDALRaster(%s, 'GTiff') FROM %s \
+                    WHERE ctid = ANY('{%s}'::tid[])" % ( column, table, ','.join( '"%s"' % t for t in batch ) ) ):
+                self.error = unicode( query.lastError().text() )
+                return
+            while query.next():
+                self.cache.putTile( self.levelKey, str( query.value( 0 ).toString() ),
+                    str( query.value( 1 ).toByteArray() ) )
+            self.cache.save() # Index the tiles (and the evictions) of every batch
+
+    def describe( self, query, table, column, token ):
+        """ Register the level in the cache with its bands and SRS, taken from any tile.
+            Return its RasterLevel, None if they couldn't be read
+        """
+        query.exec_( "SELECT ST_BandPixelType(r, b), ST_BandNoDataValue(r, b), \
+                (SELECT srtext FROM spatial_ref_sys WHERE srid = ST_SRID(r)), ST_SRID(r) \
+                FROM (SELECT r, generate_series(1, ST_NumBands(r)) AS b FROM \
+                (SELECT %(c)s AS r FROM %(t)s WHERE %(c)s IS NOT NULL LIMIT 1) AS foo) AS bar" % { 'c':column, 't':table } )
+        bands = []
+        srsWkt = ''
+        srid = 0
+        while query.next():
+            bands.append( ( str( query.value( 0 ).toString() ),
+                None if query.value( 1 ).isNull() else query.value( 1 ).toDouble()[ 0 ] ) )
+            srsWkt = unicode( query.value( 2 ).toString() )
+            srid = query.value( 3 ).toInt()[ 0 ]
+        if not bands:
+            self.error = unicode( query.lastError().text() ) or "No bands found"
+            return None
+        return self.cache.setLevel( self.levelKey, token, bands, srsWkt, srid )
+
+class IdentifyTool( QgsMapTool ):
+    """ Identify the features within identify_tolerance pixels of a click, or in a dragged
+        rectangle (see ViewerWnd.identifyFeatures())
+    """
+    def __init__( self, viewer ):
+        QgsMapTool.__init__( self, viewer.canvas )
+        self.viewer = viewer
+        self.start = None # Press position
+        self.rubberBand = None
+
+    def canvasPressEvent( self, e ):
+        self.start = e.pos()
+
+    def canvasMoveEvent( self, e ):
+        if self.start is None:
+            return
+        if self.rubberBand is None:
+            self.rubberBand = QgsRubberBand( self.canvas(), True )
+        self.rubberBand.setToGeometry( QgsGeometry.fromRect( self.mapRect( e.pos() ) ), None )
+
+    def canvasReleaseEvent( self, e ):
+        if self.start is None:
+            return
+        rect = self.mapRect( e.pos() )
+        self.start = None
+        if self.rubberBand:
+            self.rubberBand.reset( True )
+            self.rubberBand = None
+        self.viewer.identifyFeatures( rect )
+
+    def mapRect( self, end ):
+        """ Return the map rectangle from the press position to end, grown by identify_tolerance pixels """
+        p1 = self.toMapCoordinates( self.start )
+        p2 = self.toMapCoordinates( end )
+        tolerance = identify_tolerance * self.canvas().mapUnitsPerPixel()
+        return QgsRectangle( min( p1.x(), p2.x() ) - tolerance, min( p1.y(), p2.y() ) - tolerance,
+            max( p1.x(), p2.x() ) + tolerance, max( p1.y(), p2.y() ) + tolerance )
+
+
+class LayerIndex:
+    """ Packed R-tree (see spatialindex.py) of the bounding boxes of the features of a 
+        client-side vector layer, e.g., a snapshot or a layer drawn from the feature cache.
+        The tree is static: features added afterwards are searched in a list and removed
+        ones are filtered out, until the index is rebuilt (see isStale())
+    """
+    def __init__( self, features ):
+        boxes = array( 'd' )
+        self.fids = [] # 64 bits feature ids (array 'l' is 32 bits on Windows)
+        for feature in features:
+            geometry = feature.geometry()
+            if geometry:
+                box = geometry.boundingBox()
+                boxes.extend( ( box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum() ) )
+                self.fids.append( feature.id() )
+        self.tree = PackedRTree( len( self.fids ) )
+        for i in xrange( 0, len( boxes ), 4 ):
+            self.tree.add( boxes[ i ], boxes[ i + 1 ], boxes[ i + 2 ], boxes[ i + 3 ] )
+        self.tree.finish()
+        self.added = {} # Feature id -> ( xMin, yMin, xMax, yMax ), of the features added since
+        self.removed = set() # Ids of the features of the tree removed since
+
+    def update( self, features, removedFids ):
+        """ Add features (QgsFeature) and remove the features of removedFids """
+        for fid in removedFids:
+            if self.added.pop( fid, None ) is None:
+                self.removed.add( fid )
+        for feature in features:
+            geometry = feature.geometry()
+            if geometry:
+                box = geometry.boundingBox()
+                self.added[ feature.id() ] = ( box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum() )
+
+    def isStale( self ):
+        """ Check whether so many features were added or removed that the index should be rebuilt """
+        return len( self.added ) + len( self.removed ) > max( 1024, len( self.fids ) / 4 )
+
+    def search( self, rect ):
+        """ Return the ids of the features whose bounding box intersects a QgsRectangle """
+        xMin, yMin, xMax, yMax = rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()
+        fids = [ self.fids[ i ] for i in self.tree.search( xMin, yMin, xMax, yMax ) ]
+        if self.removed:
+            fids = [ fid for fid in fids if not fid in self.removed ]
+        fids.extend( fid for fid, ( x1, y1, x2, y2 ) in self.added.iteritems()
+            if x1 <= xMax and x2 >= xMin and y1 <= yMax and y2 >= yMin )
+        return fids
+
+
+class SpatialIndexBuilder( TracedThread ):
+    """ Build the LayerIndex of a client-side vector layer in the background. Other layers
+        are read through a layer of their own, memory layers are read beforehand (their
+        features can't be read while they change)
+    """
+    def __init__( self, layer, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.layerId = unicode( layer.id() )
+        self.name = unicode( layer.name() )
+        self.source = unicode( layer.source() )
+        self.providerKey = unicode( layer.providerType() )
+        self.subset = unicode( layer.subsetString() )
+        self.features = None
+        if self.providerKey == 'memory':
+            self.features = list( layer.getFeatures( QgsFeatureRequest().setSubsetOfAttributes( [] ) ) )
+        self.index = None
+        self.changes = [] # ( features, removedFids ) made to the layer while building (see updateSpatialIndex())
+        self.seconds = 0
+
+    def work( self ):
+        start = time.time()
+        if self.features is None:
+            layer = QgsVectorLayer( self.source, "index", self.providerKey )
+            if not layer.isValid():
+                return
+            if self.subset:
+                layer.setSubsetString( self.subset )
+            self.index = LayerIndex( layer.getFeatures( QgsFeatureRequest().setSubsetOfAttributes( [] ) ) )
+            del layer
+        else:
+            self.index = LayerIndex( self.features )
+            self.features = None
+        self.seconds = time.time() - start
+
+
+class FeatureTiles( QObject ):
+    """ Draw a PostGIS vector layer from the feature cache (see featurecache.py): a memory
+        layer with the features of the tiles covering the canvas is drawn in place of it.
+        Missing tiles are fetched in the background, the layer is drawn once they arrive.
+        Only the features entering or leaving the view are added to or deleted from the
+        memory layer (and its spatial index)
+    """
+    geometryTypes = { 1:'Point', 2:'LineString', 3:'Polygon', 4:'MultiPoint', 
+        5:'MultiLineString', 6:'MultiPolygon' }
+
+    def __init__( self, viewer, layer ):
+        QObject.__init__( self, viewer )
+        self.viewer = viewer
+        self.layer = layer
+        self.layerKey = extentKey( layer )
+        self.memoryLayer = None # Created on the first update
+        self.memoryIds = {} # Feature id -> id of the feature in the memory layer
+        self.bShown = False # The memory layer is drawn in place of the layer
+        self.tiles = None # Tiles drawn by the memory layer, None: the layer itself is drawn
+        self.drawnTime = 0
+        self.fetcher = None
+        self.features = {} # Feature id -> cached QgsFeature, of the tiles being fetched
+        self.maxBand = None # Coarser zoom bands don't fit in the cache
+        self.bDisabled = False # The layer can't be cached, it's drawn by itself
+        self.bRemoved = False
+        self.connect( layer, SIGNAL( "dataChanged()" ), self.invalidate )
+
+    def update( self ):
+        """ Draw the tiles covering the canvas, fetching the missing ones """
+        if self.fetcher or self.bRemoved:
+            return # Updated once fetched
+        extent = self.viewer.canvas.extent()
+        tiles = tilesFor( ( extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum() ),
+            self.viewer.canvas.mapUnitsPerPixel() )
+        if tiles == self.tiles and time.time() - self.drawnTime < self.viewer.featureCache.maxAge:
+            return
+        if self.bDisabled or ( self.maxBand is not None and tiles[ 0 ][ 0 ] > self.maxBand ):
+            self.draw( None, {} )
+            return
+
+        features = {}
+        missing = []
+        for tile in tiles:
+            tileFeatures = self.viewer.featureCache.get( self.layerKey, tile )
+            if tileFeatures is None:
+                missing.append( tile )
+            else:
+                features.update( ( feature.id(), feature ) for feature in tileFeatures )
+        if not missing:
+            self.draw( tiles, features )
+            return
+
+        if not self.showMemoryLayer(): # Or the layer itself would fetch its features too
+            self.draw( None, {} )
+            return
+        self.features = features
+        self.fetcher = FeatureTileFetcher( self.viewer.featureCache, self.layerKey, self.layer, tiles, missing, self )
+        self.connect( self.fetcher, SIGNAL( "finished()" ), self.fetched )
+        self.fetcher.start()
+
+    def fetched( self ):
+        """ Slot. Draw the tiles just fetched along with the cached ones """
+        fetcher, self.fetcher = self.fetcher, None
+        features, self.features = self.features, {}
+        fetcher.deleteLater()
+        if self.bRemoved:
+            return
+        if fetcher.error:
+            print 'W: Features of %s not cached: %s' % ( self.layer.name(), fetcher.error )
+            if fetcher.bTooBig:
+                self.maxBand = fetcher.tiles[ 0 ][ 0 ] - 1
+            else:
+                self.bDisabled = True
+            self.draw( None, {} )
+        elif not fetcher.bCancel:
+            features.update( fetcher.features )
+            self.draw( fetcher.tiles, features, fetcher.features )
+        self.viewer.updateFeatureTiles() # The canvas may have moved meanwhile
+
+    def draw( self, tiles, features, fetched={} ):
+        """ Draw the features of tiles (feature id -> QgsFeature) through the memory layer
+            (tiles None: draw the layer itself). Fetched features already drawn are replaced,
+            they may have changed since cached
+        """
+        self.tiles = tiles
+        if tiles is None:
+            if self.bShown:
+                self.bShown = False
+                self.viewer.legend.setOverviewLayer( self.layer.id(), None )
+                self.viewer.legend.updateLayerSet()
+            return
+        if not self.showMemoryLayer():
+            self.tiles = None
+            return
+
+        provider = self.memoryLayer.dataProvider()
+        removedFids = [ self.memoryIds.pop( fid ) for fid in self.memoryIds.keys() 
+            if not fid in features or fid in fetched ]
+        newFids = [ fid for fid in features if not fid in self.memoryIds ]
+        if removedFids:
+            provider.deleteFeatures( removedFids )
+        addedFeatures = []
+        if newFids:
+            bAdded, addedFeatures = provider.addFeatures( [ features[ fid ] for fid in newFids ] )
+            if not bAdded:
+                print 'W: Features of %s could not be drawn from the cache' % self.layer.name()
+            self.memoryIds.update( zip( newFids, [ feature.id() for feature in addedFeatures ] ) )
+        self.drawnTime = time.time()
+        if removedFids or addedFeatures:
+            self.viewer.updateSpatialIndex( self.memoryLayer, addedFeatures, removedFids )
+            self.memoryLayer.updateExtents()
+            self.viewer.canvas.refresh()
+
+    def showMemoryLayer( self ):
+        """ Draw the memory layer in place of the layer, return False if it can't be created """
+        if self.memoryLayer is None and not self.createMemoryLayer():
+            return False
+        if not self.bShown:
+            self.bShown = True
+            self.copyStyle()
+            self.viewer.legend.setOverviewLayer( self.layer.id(), self.memoryLayer )
+            self.viewer.legend.updateLayerSet()
+        return True
+
+    def createMemoryLayer( self ):
+        """ Create the memory layer with the geometry type, SRS and fields of the layer """
+        geometryType = self.geometryTypes.get( self.layer.wkbType() & 0xff )
+        if not geometryType:
+            self.bDisabled = True
+            return False
+        layer = QgsVectorLayer( "%s?crs=%s" % ( geometryType, self.layer.crs().authid() ),
+            self.layer.name(), "memory" )
+        layer.dataProvider().addAttributes( self.layer.pendingFields().toList() )
+        layer.updateFields()
+        self.viewer.overviewLayerIds.add( unicode( layer.id() ) )
+        QgsMapLayerRegistry.instance().addMapLayer( layer )
+        self.memoryLayer = layer
+        return True
+
+    def copyStyle( self ):
+        """ Draw the memory layer like the layer """
+        if self.memoryLayer:
+            self.memoryLayer.setRendererV2( self.layer.rendererV2().clone() )
+
+    def invalidate( self ):
+        """ Slot. Fetch the features again, the data of the layer has changed """
+        self.viewer.featureCache.invalidate( self.layerKey )
+        self.drawnTime = 0
+        if self.fetcher:
+            self.fetcher.cancel() # Its features may be outdated, fetched again once finished
+        if self.memoryIds:
+            removedFids = self.memoryIds.values()
+            self.memoryIds = {}
+            self.memoryLayer.dataProvider().deleteFeatures( removedFids )
+            self.viewer.updateSpatialIndex( self.memoryLayer, [], removedFids )
+        self.viewer.invalidateRenderCache()
+        self.update()
+
+    def remove( self ):
+        """ Remove the memory layer, the layer is being removed """
+        self.bRemoved = True
+        if self.fetcher:
+            self.fetcher.cancel()
+        if self.memoryLayer:
+            self.viewer.overviewLayerIds.discard( unicode( self.memoryLayer.id() ) )
+            QgsMapLayerRegistry.instance().removeMapLayer( self.memoryLayer.id() )
+            self.memoryLayer = None
+            self.memoryIds = {}
+
+
+class FeatureTileFetcher( TracedThread ):
+    """ Fetch the features of the missing tiles of a vector layer and store them in the
+        feature cache, using a layer of its own. The cached tiles of the layer may take half 
+        the cache, its other tiles are evicted to fit the ones to draw. Once finished, 
+        features are the fetched ones (feature id -> QgsFeature)
+    """
+    def __init__( self, cache, layerKey, layer, tiles, missing, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.cache = cache
+        self.layerKey = layerKey
+        self.source = unicode( layer.source() )
+        self.providerKey = unicode( layer.providerType() )
+        self.tiles = tiles # All the tiles to draw
+        self.missing = missing
+        self.features = {}
+        self.error = ''
+        self.bTooBig = False
+        self.bCancel = False
+
+    def cancel( self ):
+        """ Slot. Stop after the tile being fetched """
+        self.bCancel = True
+
+    def work( self ):
+        layer = QgsVectorLayer( self.source, "features", self.providerKey )
+        if not layer.isValid():
+            self.error = "Layer could not be opened"
+            return
+        for tile in self.missing:
+            if self.bCancel:
+                break
+            request = QgsFeatureRequest().setFilterRect( QgsRectangle( *tileExtent( tile ) ) )
+            features = [ QgsFeature( feature ) for feature in layer.getFeatures( request ) ]
+            tileSize = sum( featureBytes( feature ) for feature in features )
+            if not self.cache.put( self.layerKey, tile, features, tileSize, self.cache.maxBytes / 2, self.tiles ):
+                self.error = "Too big for the feature cache"
+                self.bTooBig = True
+                break
+            self.features.update( ( feature.id(), feature ) for feature in features )
+        del layer
+
+class SnapshotWriter( TracedThread ):
+    """ Write an offline snapshot of a vector layer, using a layer of its own: a SpatiaLite
+        file with its features (WKB geometries and attribute columns) and a spatial index 
+        (R*Tree). It's written to a temporary file and renamed, so that it's never read half written
+    """
+    def __init__( self, layer, path, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.source = unicode( layer.source() )
+        self.providerKey = unicode( layer.providerType() )
+        self.path = path
+        self.error = ''
+
+    def work( self ):
+        layer = QgsVectorLayer( self.source, "snapshot", self.providerKey )
+        if not layer.isValid():
+            self.error = "Layer could not be opened"
+            return
+        tmpPath = os.path.splitext( self.path )[ 0 ] + '.tmp.sqlite'
+        if os.path.exists( tmpPath ):
+            os.remove( tmpPath )
+        error = QgsVectorFileWriter.writeAsVectorFormat( layer, tmpPath, "utf-8", None, "SQLite", 
+            False, None, [ "SPATIALITE=YES" ], [ "SPATIAL_INDEX=YES" ] )
+        del layer
+        if error != QgsVectorFileWriter.NoError:
+            self.error = "Features could not be written (error %d)" % error
+            if os.path.exists( tmpPath ):
+                os.remove( tmpPath )
+            return
+        if os.name == "nt" and os.path.exists( self.path ):
+            os.remove( self.path )
+        os.rename( tmpPath, self.path )
+
 # A couple of classes for the layer list widget and the layer properties
 class LegendItem( QTreeWidgetItem ):
     """ Provide a widget to show and manage the properties of one single layer """
@@ -482,6 +2139,7 @@ class LegendItem( QTreeWidgetItem ):
         self.setText( 0, self.canvasLayer.layer().name() )
         self.isVect = ( self.canvasLayer.layer().type() == 0 ) # 0: Vector, 1: Raster
         self.layerId = self.canvasLayer.layer().id()
+        self.overviewLayer = None # Canvas layer of a raster overview drawn instead of the layer
 
         if self.isVect:
             geom = self.canvasLayer.layer().dataProvider().geometryType()
@@ -489,28 +2147,34 @@ class LegendItem( QTreeWidgetItem ):
         self.setCheckState( 0, Qt.Checked )
 
         if self.isVect:
-            pm = QPixmap( 20, 20 )
-            icon = QIcon()
             if geom == 1 or geom == 4 or geom == 8 or geom == 11: # Point
-                icon.addPixmap( QPixmap( imgs_dir + "mIconPointLayer.png" ), QIcon.Normal, QIcon.On)
+                icon = getIcon( "mIconPointLayer.png" )
             elif geom == 2 or geom == 5 or geom == 9 or geom == 12: # Polyline
-                icon.addPixmap( QPixmap( imgs_dir + "mIconLineLayer.png"), QIcon.Normal, QIcon.On)
+                icon = getIcon( "mIconLineLayer.png" )
             elif geom == 3 or geom == 6 or geom == 10 or geom == 13: # Polygon
-                icon.addPixmap( QPixmap( imgs_dir + "mIconPolygonLayer.png"), QIcon.Normal, QIcon.On)
+                icon = getIcon( "mIconPolygonLayer.png" )
             else: # Not a valid WKT Geometry
                 geom = self.canvasLayer.layer().geometryType() # QGis Geometry
                 if geom == 0: # Point
-                    icon.addPixmap( QPixmap( imgs_dir + "mIconPointLayer.png" ), QIcon.Normal, QIcon.On)
+                    icon = getIcon( "mIconPointLayer.png" )
                 elif geom == 1: # Line
-                    icon.addPixmap( QPixmap( imgs_dir + "mIconLineLayer.png"), QIcon.Normal, QIcon.On)
+                    icon = getIcon( "mIconLineLayer.png" )
                 elif geom == 2: # Polygon
-                    icon.addPixmap( QPixmap( imgs_dir + "mIconPolygonLayer.png"), QIcon.Normal, QIcon.On)
+                    icon = getIcon( "mIconPolygonLayer.png" )
                 else:
                     raise RuntimeError, 'Unknown geometry: ' + str( geom )
 
         else:
-            qimg = self.canvasLayer.layer().previewAsImage( QSize(20,20) )
-            icon = QIcon( QBitmap().fromImage( qimg ) )
+            # Reading the raster is slow, show a placeholder until the thumbnail is ready
+            source = unicode( self.canvasLayer.layer().source() )
+            image = QImage( thumbnailPath( source ) )
+            if image.isNull():
+                icon = getPlaceholderIcon()
+                self.thumbnailLoader = ThumbnailLoader( source, QSize( 20, 20 ), self.legend )
+                self.legend.connect( self.thumbnailLoader, SIGNAL( "finished()" ), self.thumbnailLoaded )
+                self.thumbnailLoader.start()
+            else:
+                icon = QIcon( QBitmap.fromImage( image ) )
 
         self.setIcon( 0, icon )
 
@@ -519,28 +2183,38 @@ class LegendItem( QTreeWidgetItem ):
         layerFont.setBold( True )
         self.setFont( 0, layerFont )
 
-        # Display layer properties
-        self.properties = self.legend.pyQGisApp.getLayerProperties( self.canvasLayer.layer() )
+        # Display layer properties, computed in the background (see PropertiesPool)
+        self.properties = "Source: %s\nLoading properties..." % self.canvasLayer.layer().source()
         self.child = QTreeWidgetItem( self )
         self.child.setFlags( Qt.NoItemFlags ) # Avoid the item to be selected
         self.displayLayerProperties()
+        self.srs = self.legend.pyQGisApp.getLayerSRS( self.canvasLayer.layer() )
+        self.legend.propertiesPool.request( self, self.srs )
         
     def displayLayerProperties( self ):
-        """ It is required to build the QLabel widget every time it is set """        
-        propertiesFont = QFont()
-        propertiesFont.setItalic( True )
-        propertiesFont.setPointSize( 8 )
-        propertiesFont.setStyleStrategy( QFont.PreferAntialias )
-
-        label = QLabel( self.properties )
-        label.setTextInteractionFlags( Qt.TextSelectableByMouse | Qt.TextSelectableByKeyboard )
-        label.setFont( propertiesFont )
-        self.legend.setItemWidget( self.child, 0, label )
-        
+        """ Set the properties text, LegendItemDelegate paints it """
+        self.child.setText( 0, self.properties )
+        self.child.setToolTip( 0, self.properties )
+        # Measured once here, so that the view doesn't measure it on every layout
+        self.child.setSizeHint( 0, self.legend.delegate.propertiesSize( self.properties ) )
+
     def nextSibling( self ):
         """ Return the next layer item """
         return self.legend.nextSibling( self )
 
+    def thumbnailLoaded( self ):
+        """ Slot. Replace the placeholder icon by the raster thumbnail """
+        if self.thumbnailLoader.image:
+            self.setIcon( 0, QIcon( QBitmap.fromImage( self.thumbnailLoader.image ) ) )
+        self.thumbnailLoader = None
+
+    def drawnCanvasLayer( self ):
+        """ Return the canvas layer to draw, i.e., the raster overview if there is one """
+        if self.overviewLayer:
+            self.overviewLayer.setVisible( self.canvasLayer.isVisible() )
+            return self.overviewLayer
+        return self.canvasLayer
+
     def storeAppearanceSettings( self ):
         """ Store the appearance of the layer item """
         self.__itemIsExpanded = self.isExpanded()
@@ -548,8 +2222,159 @@ class LegendItem( QTreeWidgetItem ):
     def restoreAppearanceSettings( self ):
         """ Restore the appearance of the layer item """
         self.setExpanded( self.__itemIsExpanded )
-        self.displayLayerProperties() # Generate the QLabel widget again
-        
+
+
+class ThumbnailLoader( QThread ):
+    """ Draw the thumbnail of a raster in the background, using a raster layer of its own,
+        and store it on disk (see thumbnailPath())
+    """
+    def __init__( self, source, size, parent=None ):
+        QThread.__init__( self, parent )
+        self.source = source
+        self.size = size
+        self.image = None
+
+    def run( self ):
+        layer = QgsRasterLayer( self.source, "thumbnail" )
+        if layer.isValid():
+            image = layer.previewAsImage( self.size )
+            if not image.isNull():
+                self.image = QImage( image )
+                if not os.path.isdir( thumbnails_dir ):
+                    try:
+                        os.makedirs( thumbnails_dir )
+                    except OSError:
+                        pass
+                self.image.save( thumbnailPath( self.source ), "PNG" )
+        del layer
+
+
+class PropertiesLoader( TracedThread ):
+    """ Compute the properties of a layer in the background, using a layer of its own
+
+        The properties of PostGIS vector layers are estimated, not to scan their tables:
+        the extent is the one known by the viewer (see ViewerWnd.layerExtent()), or else
+        the one estimated from the table statistics (see estimatedExtent()), like the
+        number of features (see estimatedFeatureCount())
+    """
+    def __init__( self, item, srs, extent=None, parent=None ):
+        TracedThread.__init__( self, parent )
+        self.item = item
+        layer = item.canvasLayer.layer()
+        self.source = unicode( layer.source() )
+        self.providerKey = unicode( layer.providerType() )
+        self.isVect = item.isVect
+        self.srs = srs
+        self.bytes = layerBytes( layer ) # A custom property, not set on the layer of the loader
+        self.key = extentKey( layer )
+        self.extent = extent # ( QgsRectangle or None, bExact ) of PostGIS vector layers, None: unknown
+        self.bEstimated = False # The extent was estimated by the loader
+        self.properties = None
+
+    def work( self ):
+        if self.isVect:
+            layer = QgsVectorLayer( self.source, "properties", self.providerKey )
+        else:
+            layer = QgsRasterLayer( self.source, "properties", self.providerKey )
+        if layer.isValid():
+            if self.key is None:
+                self.properties = layerProperties( layer, self.srs, self.bytes )
+            else:
+                if self.extent is None:
+                    self.extent = ( estimatedExtent( self.key ), False )
+                    self.bEstimated = True
+                self.properties = layerProperties( layer, self.srs, self.bytes, self.extent,
+                    estimatedFeatureCount( self.key ) )
+        del layer
+
+
+class PropertiesPool( QObject ):
+    """ Run the PropertiesLoaders of the legend, properties_workers at a time, and
+        show their results as they arrive
+    """
+    def __init__( self, legend ):
+        QObject.__init__( self, legend )
+        self.legend = legend
+        self.queue = deque() # Loaders waiting for a free worker
+        self.running = set()
+
+    def request( self, item, srs ):
+        """ Compute the properties of a legend item """
+        if item.canvasLayer.layer().providerType() == 'memory':
+            # Nothing to read from a data source, and a layer of its own would be empty
+            layer = item.canvasLayer.layer()
+            item.properties = layerProperties( layer, srs, layerBytes( layer ) )
+            item.displayLayerProperties()
+            return
+        extent = None
+        key = extentKey( item.canvasLayer.layer() )
+        if key is not None:
+            # Known, or estimated by the loader. The exact one is computed in the background
+            viewer = self.legend.pyQGisApp
+            extent = viewer.extents.get( key )
+            viewer.calculateExtent( key )
+        loader = PropertiesLoader( item, srs, extent, self )
+        item.propertiesLoader = loader # The latest one, older results are dropped
+        self.connect( loader, SIGNAL( "finished()" ), self.loaded )
+        self.queue.append( loader )
+        self.startNext()
+
+    def startNext( self ):
+        while self.queue and len( self.running ) < properties_workers:
+            loader = self.queue.popleft()
+            self.running.add( loader )
+            loader.start()
+
+    def loaded( self ):
+        """ Slot. Show the properties of a loader and start the next one """
+        loader = self.sender()
+        self.running.discard( loader )
+        if loader.properties is None:
+            print 'W: Layer properties could not be read:', loader.source
+            loader.properties = "Source: %s\nProperties not available" % loader.source
+        if loader.bEstimated and loader.extent[ 0 ]:
+            # Unless the exact one was computed meanwhile
+            self.legend.pyQGisApp.extents.setdefault( loader.key, loader.extent )
+        if self.legend.legendItem( loader.item.layerId ) is loader.item and \
+                loader.item.propertiesLoader is loader: # Not removed nor requested again meanwhile
+            loader.item.properties = loader.properties
+            loader.item.displayLayerProperties()
+        loader.item = None
+        loader.deleteLater()
+        self.startNext()
+
+
+class LegendItemDelegate( QStyledItemDelegate ):
+    """ Paint the layer properties (child items) as multi-line italic text, so that
+        the legend doesn't need a widget per layer
+    """
+    margin = 2
+
+    def __init__( self, parent ):
+        QStyledItemDelegate.__init__( self, parent )
+        self.propertiesFont = QFont()
+        self.propertiesFont.setItalic( True )
+        self.propertiesFont.setPointSize( 8 )
+        self.propertiesFont.setStyleStrategy( QFont.PreferAntialias )
+        self.metrics = QFontMetrics( self.propertiesFont )
+
+    def propertiesSize( self, text ):
+        """ Return the size needed to paint a properties text """
+        rect = self.metrics.boundingRect( QRect( 0, 0, 100000, 100000 ), Qt.AlignLeft | Qt.AlignTop, text )
+        return QSize( rect.width() + 2 * self.margin, rect.height() + 2 * self.margin )
+
+    def paint( self, painter, option, index ):
+        if not index.parent().isValid(): # Layer item
+            QStyledItemDelegate.paint( self, painter, option, index )
+            return
+
+        painter.save()
+        painter.setFont( self.propertiesFont )
+        painter.setPen( option.palette.color( QPalette.Text ) )
+        painter.drawText( option.rect.adjusted( self.margin, self.margin, -self.margin, -self.margin ),
+            Qt.AlignLeft | Qt.AlignTop, index.data().toString() )
+        painter.restore()
+
 
 class Legend( QTreeWidget ):
     """
@@ -562,6 +2387,15 @@ class Legend( QTreeWidget ):
         self.canvas = None
         self.layers = self.getLayerSet()
 
+        # Indexes of the layer items, kept in sync on add, remove and reorder
+        self.itemsById = {} # layer id -> legend item
+        self.itemsByName = {} # legend name -> legend item
+        self.rows = None # layer id -> position in the legend, built on demand
+
+        # Layer set updates are coalesced, see beginUpdate() and requestLayerSetUpdate()
+        self.updateDepth = 0
+        self.bLayerSetPending = False
+
         self.bMousePressedFlag = False
         self.itemBeingMoved = None
 
@@ -573,6 +2407,9 @@ class Legend( QTreeWidget ):
         self.setHeaderHidden( True )
         self.setRootIsDecorated( True )
         self.setContextMenuPolicy( Qt.CustomContextMenu )
+        self.delegate = LegendItemDelegate( self )
+        self.setItemDelegate( self.delegate )
+        self.propertiesPool = PropertiesPool( self )
 
         self.connect( self, SIGNAL( "customContextMenuRequested(QPoint)" ),
             self.showMenu )
@@ -601,15 +2438,20 @@ class Legend( QTreeWidget ):
     def getMenu( self, isVect, canvasLayer ):
         """ Create a context menu for a layer """
         menu = QMenu()
-        menu.addAction( QIcon( imgs_dir + "mActionZoomToLayer.png" ), "&Zoom to layer extent", self.zoomToLayer )
+        menu.addAction( getIcon( "mActionZoomToLayer.png" ), "&Zoom to layer extent", self.zoomToLayer )
         menu.addSeparator()
         if isVect :
-            menu.addAction( QIcon( imgs_dir + "symbology.png" ), "&Symbology...", self.layerSymbology )
+            menu.addAction( getIcon( "symbology.png" ), "&Symbology...", self.layerSymbology )
+            if canvasLayer.layer().providerType() == 'postgres':
+                menu.addAction( "Save offline &snapshot...", self.saveSnapshot )
+        else:
+            menu.addAction( "Create &overviews...", self.createOverviews )
+        menu.addAction( "Copy &properties", self.copyProperties )
         menu.addSeparator()
-        menu.addAction( QIcon( imgs_dir + "collapse.png" ), "&Collapse all", self.collapseAll )
-        menu.addAction( QIcon( imgs_dir + "expand.png" ), "&Expand all", self.expandAll )
+        menu.addAction( getIcon( "collapse.png" ), "&Collapse all", self.collapseAll )
+        menu.addAction( getIcon( "expand.png" ), "&Expand all", self.expandAll )
         menu.addSeparator()
-        menu.addAction( QIcon( imgs_dir + "removeLayer.png" ), "&Remove layer", self.removeCurrentLayer )
+        menu.addAction( getIcon( "removeLayer.png" ), "&Remove layer", self.removeCurrentLayer )
         return menu
 
     def mousePressEvent(self, event):
@@ -686,28 +2528,25 @@ class Legend( QTreeWidget ):
 
     def addLayerToLegend( self, canvasLayer ):
         """ Slot. Create and add a legend item based on a layer """
+        if self.pyQGisApp.isOverviewLayer( canvasLayer ):
+            return # Overviews are drawn through the legend item of their raster
         legendLayer = LegendItem( self, QgsMapCanvasLayer( canvasLayer ) )
         self.addLayer( legendLayer )
 
     def addLayer( self, legendLayer ):
         """ Add a legend item to the legend widget """
         self.insertTopLevelItem ( 0, legendLayer )
+        self.indexLayer( legendLayer )
         self.expandItem( legendLayer )
         self.setCurrentItem( legendLayer )
-        self.updateLayerSet()
+        self.requestLayerSetUpdate() # Many layers may be added in a row
 
     def updateLayerStatus( self, item ):
         """ Update the layer status """
         if ( item ):
             if self.isLegendLayer( item ): # Is the item a layer item?
-                for i in self.layers:
-                    if i.layer().id() == item.layerId:
-                        if item.checkState( 0 ) == Qt.Unchecked:
-                            i.setVisible( False )
-                        else:
-                            i.setVisible( True )
-                        self.canvas.setLayerSet( self.layers )
-                        return
+                item.canvasLayer.setVisible( item.checkState( 0 ) != Qt.Unchecked )
+                self.updateLayerSet()
 
     def currentItemChanged( self, newItem, oldItem ):
         """ Slot. Capture a new currentItem and emit a SIGNAL to inform the new type 
@@ -729,6 +2568,18 @@ class Legend( QTreeWidget ):
         """ Slot. Manage the zoomToLayer action in the context Menu """
         self.zoomToLegendLayer( self.currentItem() )
 
+    def copyProperties( self ):
+        """ Slot. Copy the properties of the current layer to the clipboard """
+        QApplication.clipboard().setText( self.currentItem().properties )
+
+    def saveSnapshot( self ):
+        """ Slot. Manage the saveSnapshot action in the context Menu """
+        self.pyQGisApp.snapshotLayer( self.currentItem().layerId )
+
+    def createOverviews( self ):
+        """ Slot. Manage the createOverviews action in the context Menu """
+        self.pyQGisApp.createRasterOverviews( self.currentItem().layerId )
+
     def removeCurrentLayer( self ):
         """ Slot. Manage the removeCurrentLayer action in the context Menu """
         QgsMapLayerRegistry.instance().removeMapLayer( self.currentItem().canvasLayer.layer().id() )
@@ -740,31 +2591,22 @@ class Legend( QTreeWidget ):
         legendLayer = self.currentItem()
         
         if legendLayer.isVect == True:
-            geom = legendLayer.canvasLayer.layer().geometryType() # QGis Geometry
-            for i in self.layers:
-                if i.layer().id() == legendLayer.layerId:
-                    color = QColorDialog.getColor( i.layer().rendererV2().symbols()[ 0 ].color(), self.pyQGisApp )
-                    break
+            color = QColorDialog.getColor( legendLayer.canvasLayer.layer().rendererV2().symbols()[ 0 ].color(), self.pyQGisApp )
             if color.isValid():
-                pm = QPixmap()
-                iconChild = QIcon()
-                legendLayer.canvasLayer.layer().rendererV2().symbols()[ 0 ].setColor( color )                                       
+                legendLayer.canvasLayer.layer().rendererV2().symbols()[ 0 ].setColor( color )
+                self.pyQGisApp.invalidateRenderCache()
                 self.canvas.refresh()
 
     def zoomToLegendLayer( self, legendLayer ):
         """ Zoom the map to a layer extent """
-        for i in self.layers:
-            if i.layer().id() == legendLayer.layerId:
-                extent = i.layer().extent()
-                extent.scale( 1.05 )
-                self.canvas.setExtent( extent )
-                self.canvas.refresh()
-                break
+        self.pyQGisApp.zoomToLayerExtent( legendLayer.canvasLayer.layer(), 1.05 )
+        self.canvas.refresh()
 
     def removeLegendLayer( self, legendLayer ):
         """ Remove a layer item in the legend """
         if self.topLevelItemCount() == 1:
             self.clear()
+            self.clearIndexes()
         else: # Manage the currentLayer before the remove
             indice = self.indexOfTopLevelItem( legendLayer )
             if indice == 0:
@@ -774,24 +2616,103 @@ class Legend( QTreeWidget ):
 
             self.setCurrentItem( newCurrentItem )
             self.takeTopLevelItem( self.indexOfTopLevelItem( legendLayer ) )
+            self.unindexLayer( legendLayer )
 
     def removeAll( self ):
         """ Remove all legend items """
         self.clear()
-        self.updateLayerSet()
+        self.clearIndexes()
+        self.requestLayerSetUpdate()
+
+    def indexLayer( self, item ):
+        """ Add a layer item to the indexes """
+        self.itemsById[ unicode( item.layerId ) ] = item
+        self.itemsByName[ unicode( item.text( 0 ) ) ] = item
+        self.rows = None
+
+    def unindexLayer( self, item ):
+        """ Remove a layer item from the indexes """
+        self.itemsById.pop( unicode( item.layerId ), None )
+        if self.itemsByName.get( unicode( item.text( 0 ) ) ) is item:
+            del self.itemsByName[ unicode( item.text( 0 ) ) ]
+        self.rows = None
+
+    def clearIndexes( self ):
+        self.itemsById.clear()
+        self.itemsByName.clear()
+        self.rows = None
+
+    def legendItem( self, layerId ):
+        """ Return the layer item of a layer id, None if the layer is not in the legend """
+        return self.itemsById.get( unicode( layerId ) )
+
+    def refreshLayerProperties( self, key ):
+        """ Compute again the properties of the layers of an extent key (see extentKey()),
+            e.g., once their exact extent is known
+        """
+        for item in self.itemsById.values():
+            if extentKey( item.canvasLayer.layer() ) == key:
+                self.propertiesPool.request( item, item.srs )
+
+    def canvasLayer( self, layerId ):
+        """ Return the canvas layer of a layer id, None if the layer is not in the legend """
+        item = self.legendItem( layerId )
+        return item.canvasLayer if item else None
+
+    def row( self, item ):
+        """ Return the position of a layer item in the legend """
+        if self.rows is None:
+            self.rows = dict( ( unicode( self.topLevelItem( i ).layerId ), i ) 
+                for i in range( self.topLevelItemCount() ) )
+        return self.rows[ unicode( item.layerId ) ]
 
     def updateLayerSet( self ):
-        """ Update the LayerSet and set it to canvas """
+        """ Update the LayerSet and set it to canvas (at endUpdate() inside a batch).
+            Rendered maps of other layer sets stay cached, the layer set is part of their key
+        """
+        if self.updateDepth > 0:
+            self.bLayerSetPending = True
+            return
+        self.bLayerSetPending = False
         self.layers = self.getLayerSet()
         self.canvas.setLayerSet( self.layers )
 
+    def beginUpdate( self ):
+        """ Start a batch of legend changes, the LayerSet is updated once at endUpdate() """
+        self.updateDepth += 1
+
+    def endUpdate( self ):
+        """ Finish a batch of legend changes """
+        self.updateDepth -= 1
+        if self.updateDepth == 0 and self.bLayerSetPending:
+            self.updateLayerSet()
+
+    def requestLayerSetUpdate( self ):
+        """ Update the LayerSet when control returns to the event loop, so that a burst
+            of changes (e.g., layers added to the registry) is drawn only once
+        """
+        if not self.bLayerSetPending:
+            self.bLayerSetPending = True
+            QTimer.singleShot( 0, self.flushLayerSet )
+
+    def flushLayerSet( self ):
+        """ Slot. Apply a pending LayerSet update """
+        if self.bLayerSetPending:
+            self.updateLayerSet()
+
     def getLayerSet( self ):
         """ Get the LayerSet by reading the layer items in the legend """
         layers = []
         for i in range( self.topLevelItemCount() ):
-            layers.append( self.topLevelItem( i ).canvasLayer )
+            layers.append( self.topLevelItem( i ).drawnCanvasLayer() )
         return layers
 
+    def setOverviewLayer( self, layerId, layer ):
+        """ Draw a raster overview layer instead of the legend layer (None: draw the layer) """
+        item = self.legendItem( layerId )
+        if item:
+            item.overviewLayer = QgsMapCanvasLayer( layer ) if layer else None
+
     def activeLayer( self ):
         """ Return the selected layer """
         if self.currentItem():
@@ -832,30 +2753,16 @@ class Legend( QTreeWidget ):
 
     def nextSibling( self, item ):
         """ Return the next layer item based on a given item """
-        for i in range( self.topLevelItemCount() ):
-            if item.layerId == self.topLevelItem( i ).layerId:
-                break
-        if i < self.topLevelItemCount():                                            
-            return self.topLevelItem( i + 1 )
-        else:
-            return None
+        return self.topLevelItem( self.row( item ) + 1 ) # None for the last item
 
     def moveItem( self, itemToMove, afterItem ):
         """ Move the itemToMove after the afterItem in the legend """
         itemToMove.storeAppearanceSettings() # Store settings in the moved item
         self.takeTopLevelItem( self.indexOfTopLevelItem( itemToMove ) )
         self.insertTopLevelItem( self.indexOfTopLevelItem( afterItem ) + 1, itemToMove )
+        self.rows = None
         itemToMove.restoreAppearanceSettings() # Apply the settings again
-        self.updatePropertiesWidget() # Regenerate all the QLabel widgets for displaying purposes
 
-    def updatePropertiesWidget(self):
-        """ Weird function to create QLabel widgets for refreshing the properties 
-            It is required to avoid a disgusting overlap in QLabel widgets
-        """
-        for i in range( self.topLevelItemCount() ):
-            item = self.topLevelItem( i )
-            item.displayLayerProperties()
-            
     def checkLayerOrderUpdate( self ):
         """
             Check if the initial layers order is equal to the final one.
@@ -894,25 +2801,118 @@ class Legend( QTreeWidget ):
         import re
         name_validation = re.compile( "\s\(\d+\)$", re.UNICODE ) # Strings like " (1)"
 
-        bRepetida = True
         i = 1
-        while bRepetida:
-            bRepetida = False
-
-            # If necessary add a sufix like " (1)" to avoid to repeat names in the legend
-            for j in range( self.topLevelItemCount() ):
-                item = self.topLevelItem( j )
-                if item.text( 0 ) == name:
-                    bRepetida = True
-                    if name_validation.search( name ): # The name already has numeration
-                        name = name[ :-4 ]  + ' (' + str( i ) + ')'
-                    else: # Add numeration because the name doesn't have it
-                        name = name + ' (' + str( i ) + ')'
-                    i += 1
+        # If necessary add a sufix like " (1)" to avoid to repeat names in the legend
+        while unicode( name ) in self.itemsByName:
+            if name_validation.search( name ): # The name already has numeration
+                name = name_validation.sub( '', name ) + ' (' + str( i ) + ')'
+            else: # Add numeration because the name doesn't have it
+                name = name + ' (' + str( i ) + ')'
+            i += 1
         return name
 
 
+class TracedQuery( QSqlQuery ):
+    """ QSqlQuery whose statements are attributed to the active tracing span """
+    def exec_( self, *args ):
+        if not tracing.enabled or not args:
+            return QSqlQuery.exec_( self, *args )
+        start = time.time()
+        result = QSqlQuery.exec_( self, *args )
+        tracing.record( 'qtsql', args[ 0 ], time.time() - start )
+        return result
+
+def providerMessage( message, tag, level ):
+    """ Attribute the messages of the PostGIS provider (e.g., failed statements) to the active span """
+    if 'postgis' in unicode( tag ).lower():
+        tracing.record( 'provider', message, 0.0 )
+
+
 # Some helpful functions
+icons = {} # File name -> QIcon, loaded once and shared by all layers, menus and tools
+
+def getIcon( fileName ):
+    """ Return the icon of an image in imgs_dir """
+    if not fileName in icons:
+        icons[ fileName ] = QIcon( imgs_dir + fileName )
+    return icons[ fileName ]
+
+def getPlaceholderIcon():
+    """ Return the icon shown while a raster thumbnail is being drawn """
+    if not None in icons:
+        pixmap = QPixmap( 20, 20 )
+        pixmap.fill( QColor( 220, 220, 220 ) )
+        icons[ None ] = QIcon( pixmap )
+    return icons[ None ]
+
+def thumbnailPath( source ):
+    """ Return the path of the thumbnail of a raster source (hashed, it has the password) """
+    return os.path.join( thumbnails_dir, hashlib.sha1( source.encode( 'utf-8' ) ).hexdigest() + '.png' )
+
+def layerBytes( l ):
+    """ Return the bytes charged to a layer in the memory budget (see budget.py), or None """
+    value, bOk = l.customProperty( budget.bytes_property ).toLongLong()
+    return value if bOk else None
+
+def featureBytes( feature ):
+    """ Return the bytes of a feature (geometry as WKB, attributes as text) """
+    bytes = sum( len( attribute.toString() ) for attribute in feature.attributes() )
+    if feature.geometry():
+        bytes += feature.geometry().wkbSize()
+    return bytes
+
+def memoryLayerBytes( l ):
+    """ Return the bytes held by a memory layer """
+    return sum( featureBytes( feature ) for feature in l.getFeatures() )
+
+def layerProperties( l, srs, bytes=None, extent=None, featureCount=None ):
+    """ Create a layer-properties string (l:layer, srs:SRS description, bytes: charged to 
+        the layer in the memory budget, if any)
+
+        PostGIS vector layers give extent: ( QgsRectangle or None, bExact ) and featureCount:
+        estimated number of features or None, not to scan their tables for them
+    """
+    if extentKey( l ) is not None:
+        rectangle, bExact = extent or ( None, False )
+        extentText = rectangle.toString() if rectangle else "unknown"
+        if rectangle and not bExact:
+            extentText += " (estimated)"
+        countText = "~%d (estimated)" % featureCount if featureCount is not None else "unknown"
+    elif l.type() == 0:
+        extentText, countText = l.extent().toString(), l.featureCount()
+    if l.type() == 0: # Vector
+        wkbType = ["WKBUnknown","WKBPoint","WKBLineString","WKBPolygon",
+                   "WKBMultiPoint","WKBMultiLineString","WKBMultiPolygon",
+                   "WKBNoGeometry","WKBPoint25D","WKBLineString25D","WKBPolygon25D",
+                   "WKBMultiPoint25D","WKBMultiLineString25D","WKBMultiPolygon25D"]
+        properties = "Source: %s\n" \
+                     "Geometry type: %s\n" \
+                     "Number of features: %s\n" \
+                     "Number of fields: %s\n" \
+                     "SRS (EPSG): %s\n" \
+                     "Extent: %s " \
+                      % ( l.source(), wkbType[l.wkbType()], countText, 
+                          l.dataProvider().fields().count(), srs, 
+                          extentText )
+        if l.providerType() == 'memory':
+            properties += "\nMemory: %s" % budget.formatBytes( memoryLayerBytes( l ) )
+        elif bytes is not None:
+            properties += "\nMemory (estimated): %s" % budget.formatBytes( bytes )
+    elif l.type() == 1: # Raster
+        rType = [ "GrayOrUndefined (single band)", "Palette (single band)", "Multiband", "ColorLayer" ]
+        properties = "Source: %s\n" \
+                     "Raster type: %s\n" \
+                     "Width-Height (pixels): %sx%s\n" \
+                     "Bands: %s\n" \
+                     "SRS (EPSG): %s\n" \
+                     "Extent: %s" \
+                     % ( l.source(), rType[l.rasterType()], l.width(), l.height(),
+                         l.bandCount(), srs, l.extent().toString() )
+    return properties
+
+number_formats = [ ',.%df' % precision for precision in range( 10 ) ]
+swap_separators = string.maketrans( ',.', '.,' )
+
 def formatNumber( number, precision=0, group_sep='.', decimal_sep=',' ):
     """
         number: Number to be formatted 
@@ -920,42 +2920,250 @@ def formatNumber( number, precision=0, group_sep='.', decimal_sep=',' ):
         group_sep: Miles separator
         decimal_sep: Decimal separator
     """
-    number = ( '%.*f' % ( max( 0, precision ), number ) ).split( '.' )
-    integer_part = number[ 0 ]
-
-    if integer_part[ 0 ] == '-':
-        sign = integer_part[ 0 ]
-        integer_part = integer_part[ 1: ]
-    else:
-        sign = ''
-
-    if len( number ) == 2:
-        decimal_part = decimal_sep + number[ 1 ]
-    else:
-        decimal_part = ''
-
-    integer_part = list( integer_part )
-    c = len( integer_part )
-
-    while c > 3:
-        c -= 3
-        integer_part.insert( c, group_sep )
-
-    return sign + ''.join( integer_part ) + decimal_part
+    # Let format() group the thousands, then swap in the separators
+    number = format( number, number_formats[ max( 0, precision ) ] if precision < 10 else ',.%df' % precision )
+    if group_sep == '.' and decimal_sep == ',':
+        return number.translate( swap_separators )
+    return number.replace( ',', '\0' ).replace( '.', decimal_sep ).replace( '\0', group_sep )
 
 def formatToDegrees( number ):
     """ Returns the degrees-minutes-seconds form of number """
     sign = ''
     if number < 0:
-        number = math.fabs( number )
+        number = -number
         sign = '-'
 
     deg = math.floor( number )
-    minu = math.floor( ( number - deg ) * 60 )
-    sec = ( ( ( number - deg ) * 60 ) - minu ) * 60 
+    minutes = ( number - deg ) * 60
+    minu = math.floor( minutes )
+    sec = ( minutes - minu ) * 60
+
+    return u"%s%.0f° %.0f' %.2f\"" % ( sign, deg, minu, sec )
+
+def rasterConnString( dictOpts, schema, table ):
+    """ Return the GDAL connection string of a PostGIS raster table """
+    return "PG: dbname=%s host=%s user=%s password=%s port=%s mode=2 " \
+        "schema=%s column=%s table=%s" % ( dictOpts['-d'], dictOpts['-h'], 
+        dictOpts['-U'], dictOpts['-W'], dictOpts['-p'], schema, 
+        dictOpts['col'], table )
+
+def openDatabase( dictOpts, connectionName ):
+    """ Open a named QPSQL connection with the connection options """
+    d = QSqlDatabase.addDatabase( "QPSQL", connectionName )
+    d.setHostName( dictOpts['-h'] )
+    d.setPort( int( dictOpts['-p'] ) )
+    d.setDatabaseName( dictOpts['-d'] )
+    d.setUserName( dictOpts['-U'] )
+    d.setPassword( dictOpts['-W'] )
+    d.open()
+    return d
+
+connection_numbers = itertools.count() # Names of the shared connections
+closed_connections = threading.local() # names: connections closed by the thread, not removed yet
+
+def closeDatabase( name ):
+    """ Close a named connection opened with openDatabase(). It's removed once the with 
+        block using it (its QSqlDatabase and queries) is gone: by the event loop in the 
+        GUI thread, at the end of TracedThread.run() in the others
+    """
+    QSqlDatabase.database( name, False ).close()
+    closed_connections.__dict__.setdefault( 'names', [] ).append( name )
+    if QThread.currentThread() == QApplication.instance().thread():
+        QTimer.singleShot( 0, removeClosedDatabases )
+
+def removeClosedDatabases():
+    """ Remove the connections closed by the current thread (see closeDatabase()) """
+    names, closed_connections.names = getattr( closed_connections, 'names', [] ), []
+    for name in names:
+        QSqlDatabase.removeDatabase( name )
+
+@contextmanager
+def sharedDatabase( dictOpts ):
+    """ With block with a QPSQL connection to the database of dictOpts from the connection 
+        broker (see connections.py), which only handles its name. Connections of the GUI 
+        thread are kept open for reuse, those of other threads (they can't be used elsewhere)
+        are closed
+    """
+    bGuiThread = QThread.currentThread() == QApplication.instance().thread()
+    database = connections.databaseKey( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], dictOpts['-U'] )
+    with connections.broker.connection( database, 'qtsql' if bGuiThread else 'qtsql, threads',
+            lambda: unicode( openDatabase( dictOpts, "PgSQLDbShared_%d" % next( connection_numbers ) ).connectionName() ),
+            closeDatabase, lambda name: bGuiThread and QSqlDatabase.database( name, False ).isOpen(),
+            bThreadBound=True ) as name:
+        yield QSqlDatabase.database( name, False )
+
+def importPostgisUtils():
+    """ Return the postgis_utils module (GeoDB) of the FastSQLlayer plugin, 
+        None if it can't be imported (it needs psycopg2)
+    """
+    if not 'postgis_utils' in sys.modules:
+        try:
+            f, filename, description = imp.find_module( 'postgis_utils', 
+                [ os.path.join( os.path.dirname( __file__ ), 'plugins', 'FastSQLlayer' ) ] )
+            try:
+                imp.load_module( 'postgis_utils', f, filename, description )
+            finally:
+                f.close()
+        except ImportError, e:
+            print 'W: Table advice disabled:', e
+            return None
+    return sys.modules[ 'postgis_utils' ]
+
+def createLayer( dictOpts ):
+    """ Create the QGIS layer of a table described by dictOpts (see detectLayerType()) """
+    if dictOpts['type'] == 'vector':
+        # QGIS connection
+        uri = QgsDataSourceURI()
+        uri.setConnection( dictOpts['-h'], dictOpts['-p'], dictOpts['-d'], 
+            dictOpts['-U'], dictOpts['-W'] )
+        uri.setDataSource( dictOpts['-s'], dictOpts['-t'], dictOpts['-g'] )
+        layer = QgsVectorLayer( uri.uri(), dictOpts['-s'] + '.' + dictOpts['-t'],
+            "postgres" )        
+    elif dictOpts['type'] == 'raster':
+        connString = rasterConnString( dictOpts, dictOpts['-s'], dictOpts['-t'] )
+        layer = QgsRasterLayer( connString, dictOpts['-s'] + '.' + dictOpts['-t'] )
+
+        if layer.isValid():
+            layer.setContrastEnhancement( QgsContrastEnhancement.StretchToMinimumMaximum )
+    elif dictOpts['type'] == 'snapshot':
+        layer = QgsVectorLayer( dictOpts['snapshot'], dictOpts['-t'], "ogr" )
+    return layer
+
+def snapshotOpts( path, dictOpts ):
+    """ Return the options (as in dictOpts) of an offline snapshot, keeping the connection ones """
+    opts = dict( dictOpts )
+    opts.update( { '-s':'', '-t':os.path.splitext( os.path.basename( path ) )[ 0 ], '-g':'', 
+        'type':'snapshot', 'srid':'', 'col':'', 'overviews':[], 'snapshot':os.path.abspath( path ) } )
+    return opts
+
+def extentKey( layer ):
+    """ Return the key of the extent of a PostGIS vector layer, None for other layers """
+    if layer.type() != 0 or layer.providerType() != "postgres":
+        return None
+    uri = QgsDataSourceURI( layer.source() )
+    return ( unicode( uri.host() ), unicode( uri.port() ), unicode( uri.database() ),
+        unicode( uri.username() ), unicode( uri.password() ), unicode( uri.schema() ),
+        unicode( uri.table() ), unicode( uri.geometryColumn() ) )
+
+def quoteIdentifier( name ):
+    return '"%s"' % name.replace( '"', '""' )
+
+def extentConnectionOpts( key ):
+    """ Return the connection options (as in dictOpts) of an extent key """
+    return { '-h':key[ 0 ], '-p':key[ 1 ] or '5432', '-d':key[ 2 ], '-U':key[ 3 ], '-W':key[ 4 ] }
+
+def extentSource( key ):
+    """ Return the FROM clause of an extent key, either a table or a query layer """
+    schema, table = key[ 5 ], key[ 6 ]
+    if table.startswith( '(' ): # Query layer
+        return table + ' AS subquery'
+    if schema:
+        return quoteIdentifier( schema ) + '.' + quoteIdentifier( table )
+    return quoteIdentifier( table )
+
+def rectangleFromQuery( query ):
+    """ Return a QgsRectangle from the xmin, ymin, xmax, ymax values of a query, None if NULL """
+    if query.value( 0 ).isNull():
+        return None
+    return QgsRectangle( query.value( 0 ).toDouble()[ 0 ], query.value( 1 ).toDouble()[ 0 ],
+        query.value( 2 ).toDouble()[ 0 ], query.value( 3 ).toDouble()[ 0 ] )
 
-    return sign + "%.0f"%deg + u'° ' + "%.0f"%minu + "' " \
-        + "%.2f"%sec + "\""
+def estimatedExtent( key ):
+    """ Return the extent of a table estimated from its statistics (ST_EstimatedExtent), 
+        None if there are no statistics or it's a query layer
+    """
+    schema, table, column = key[ 5 ], key[ 6 ], key[ 7 ]
+    if table.startswith( '(' ):
+        return None
+
+    extent = None
+    with sharedDatabase( extentConnectionOpts( key ) ) as d:
+        if d.isOpen():
+            query = TracedQuery( d )
+            if query.exec_( "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM \
+                    ST_EstimatedExtent( '%s', '%s', '%s' ) AS e" % ( ( schema or 'public' ).replace( "'", "''" ), 
+                    table.replace( "'", "''" ), column.replace( "'", "''" ) ) ) and query.next():
+                extent = rectangleFromQuery( query )
+            del query
+    return extent
+
+def estimatedFeatureCount( key ):
+    """ Return the number of rows of a table estimated from its statistics (pg_class.reltuples),
+        or of a query layer from its plan, None if unknown (e.g., never analyzed)
+    """
+    schema, table = key[ 5 ], key[ 6 ]
+    count = None
+    with sharedDatabase( extentConnectionOpts( key ) ) as d:
+        if d.isOpen():
+            query = TracedQuery( d )
+            if table.startswith( '(' ):
+                if query.exec_( "EXPLAIN SELECT * FROM %s AS t" % table ) and query.next():
+                    match = re.search( r"rows=(\d+)", unicode( query.value( 0 ).toString() ) )
+                    if match:
+                        count = int( match.group( 1 ) )
+            elif query.exec_( "SELECT c.reltuples, c.relpages FROM pg_class c \
+                    JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = '%s' AND \
+                    c.relname = '%s'" % ( ( schema or 'public' ).replace( "'", "''" ),
+                    table.replace( "'", "''" ) ) ) and query.next():
+                reltuples, relpages = query.value( 0 ).toDouble()[ 0 ], query.value( 1 ).toInt()[ 0 ]
+                if reltuples > 0 or relpages > 0: # -1 or 0 and 0 if never analyzed
+                    count = max( int( reltuples ), 0 )
+            del query
+    return count
+
+def detectLayerType( dictOpts, query ):
+    """ Fill dictOpts with the type (raster/vector), SRID and columns of the table dictOpts['-t'] """
+    schema, table = dictOpts['-s'].replace( "'", "''" ), dictOpts['-t'].replace( "'", "''" ) # In literals
+    query.exec_( "SELECT Count(srid) FROM raster_columns WHERE r_table_schema = '%s' AND r_table_name = '%s'" % ( schema, table ) )
+    
+    if query.next() and query.value( 0 ).toBool(): # Raster layer (WKTRaster)!            
+        query.exec_( "SELECT srid, r_raster_column FROM raster_columns \
+                      WHERE r_table_schema = '%s' AND \
+                      r_table_name = '%s' " % ( schema, table ) )
+        if query.next():
+            dictOpts[ 'srid' ] = str( query.value( 0 ).toString() )
+            dictOpts[ 'col' ] = str( query.value( 1 ).toString() )
+
+        dictOpts[ 'overviews' ] = getRasterOverviews( query, dictOpts['-s'], 
+            dictOpts['-t'], dictOpts['col'] )
+        dictOpts['type'] = 'raster'
+        print 'I: Raster layer detected'
+        
+    else: # Vector layer?            
+        query.exec_( "SELECT column_name FROM information_schema.columns \
+                WHERE table_schema = '%s' AND \
+                table_name = '%s' AND \
+                udt_name = 'geometry' LIMIT 1" % ( schema, table ) )          
+
+        if not query.next(): # Geography layer?        
+            query.exec_( "SELECT column_name FROM information_schema.columns \
+                    WHERE table_schema = '%s' AND \
+                    table_name = '%s' AND \
+                    udt_name = 'geography' LIMIT 1" % ( schema, table ) )
+
+        if query.first(): # Vector layer!        
+            dictOpts[ '-g' ] = str( query.value( 0 ).toString() )
+
+            query.exec_( "SELECT srid FROM geometry_columns \
+                          WHERE f_table_schema = '%s' AND \
+                          f_table_name = '%s' " % ( schema, table ) )
+            if query.next():
+                dictOpts[ 'srid' ] = str( query.value( 0 ).toString() )
+
+            dictOpts['type'] = 'vector'
+            print 'I: Vector layer detected'
+
+def getRasterOverviews( query, schema, table, column ):
+    """ Return the overviews of a raster column as ( schema, table, factor ) tuples """
+    overviews = []
+    if query.exec_( "SELECT o_table_schema, o_table_name, overview_factor FROM raster_overviews \
+                     WHERE r_table_schema = '%s' AND r_table_name = '%s' AND \
+                     r_raster_column = '%s' ORDER BY overview_factor" % ( schema.replace( "'", "''" ), 
+                     table.replace( "'", "''" ), column.replace( "'", "''" ) ) ):
+        while query.next():
+            overviews.append( ( str( query.value( 0 ).toString() ), 
+                str( query.value( 1 ).toString() ), query.value( 2 ).toInt()[ 0 ] ) )
+    return overviews
 
 def show_error(title, text):
     QMessageBox.critical(None, title, text,
@@ -966,69 +3174,151 @@ def show_error(title, text):
     sys.exit(1)
 
 
-def main( argv ):
-    print 'I: Starting viewer ...'    
-    app = SingletonApp( argv )
+# Batch mode: render tables to images in a pool of processes, each with its own QGIS
+batchWorker = {} # QgsApplication and connection options of the current worker process
+
+def initBatchWorker( dictOpts ):
+    """ Initialize QGIS once per worker process (without GUI) """
+    batchWorker[ 'app' ] = QgsApplication( [], False )
+    QgsApplication.setPrefixPath( qgis_prefix, True )
+    QgsApplication.initQgis()
+    batchWorker[ 'opts' ] = dictOpts
+    d = openDatabase( dictOpts, "PgSQLDbBatch" )
+    if d.isOpen():
+        batchWorker[ 'query' ] = TracedQuery( d ) # Kept open for all the tables of the worker
+        batchWorker[ 'error' ] = ''
+    else:
+        batchWorker[ 'query' ] = None
+        batchWorker[ 'error' ] = 'Connection failed: %s' % d.lastError().text()
 
+def renderTable( job ):
+    """ Render a table ('schema.table') to a PNG file. Return ( table, path, error, timings ),
+        errors are returned too, so that a table doesn't stop the rendering of the others
+    """
+    table = job[ 0 ]
+    timings = {}
+    if batchWorker[ 'error' ]:
+        return ( table, None, batchWorker[ 'error' ], timings )
+    try:
+        return renderTableJob( job, timings )
+    except Exception, e:
+        return ( table, None, '%s: %s' % ( e.__class__.__name__, e ), timings )
+
+def renderTableJob( job, timings ):
+    """ Render a table for renderTable(), filling timings """
+    table, outputDir, size, extent = job
+    start = time.time()
+    dictOpts = dict( batchWorker[ 'opts' ] )
+    schema, name = table.split( '.', 1 ) if '.' in table else ( 'public', table )
+    dictOpts.update( { '-s':schema, '-t':name, '-g':'', 'type':'unknown', 'srid':'', 
+        'col':'', 'overviews':[] } )
+    detectLayerType( dictOpts, batchWorker[ 'query' ] )
+    timings[ 'detect' ] = time.time() - start
+    if dictOpts['type'] == 'unknown':
+        return ( table, None, 'Neither a raster nor a vector layer', timings )
+
+    start = time.time()
+    layer = createLayer( dictOpts )
+    if not layer.isValid():
+        return ( table, None, 'Invalid layer', timings )
+    QgsMapLayerRegistry.instance().addMapLayer( layer, False )
+    try:
+        if extent:
+            extent = QgsRectangle( *extent )
+        else:
+            key = extentKey( layer )
+            extent = ( estimatedExtent( key ) if key else None ) or layer.extent()
+        timings[ 'load' ] = time.time() - start
+
+        start = time.time()
+        settings = QgsMapSettings()
+        settings.setLayers( [ layer.id() ] )
+        settings.setOutputSize( QSize( *size ) )
+        settings.setExtent( extent )
+        settings.setBackgroundColor( QColor( Qt.white ) )
+        image = QImage( QSize( *size ), QImage.Format_ARGB32_Premultiplied )
+        image.fill( QColor( Qt.white ).rgb() )
+        painter = QPainter( image )
+        job = QgsMapRendererCustomPainterJob( settings, painter )
+        job.start()
+        job.waitForFinished()
+        painter.end()
+        path = os.path.join( outputDir, re.sub( r'[^\w.-]+', '_', schema + '.' + name ) + '.png' )
+        bSaved = image.save( path, "PNG" )
+    finally:
+        QgsMapLayerRegistry.instance().removeMapLayer( layer.id() )
+    timings[ 'render' ] = time.time() - start
+    return ( table, path if bSaved else None, '' if bSaved else 'Image could not be saved', timings )
+
+def batchRender( dictOpts, tables, outputDir, size, extent, workers ):
+    """ Render tables to outputDir in a pool of worker processes, reporting timings """
+    if not os.path.isdir( outputDir ):
+        os.makedirs( outputDir )
+    connectionOpts = dict( ( opt, dictOpts[ opt ] ) for opt in ( '-h', '-p', '-d', '-U', '-W' ) )
+    pool = multiprocessing.Pool( workers, initBatchWorker, ( connectionOpts, ) )
+    start = time.time()
+    failures = 0
+    try:
+        jobs = [ ( table, outputDir, size, extent ) for table in tables ]
+        for table, path, error, timings in pool.imap_unordered( renderTable, jobs ):
+            total = sum( timings.values() )
+            details = ', '.join( '%s %.2f s' % ( step, timings[ step ] ) 
+                for step in ( 'detect', 'load', 'render' ) if step in timings )
+            if path:
+                print 'I: %s rendered in %.2f s (%s)' % ( table, total, details )
+            else:
+                failures += 1
+                print 'E: %s could not be rendered: %s (%s)' % ( table, error, details )
+    finally:
+        pool.close()
+        pool.join()
+    print 'I: %d tables rendered in %.2f s (%d failed)' % ( len( tables ), time.time() - start, failures )
+    return failures
+
+def main( argv ):
     dictOpts = { '-h':'', '-p':'5432', '-U':'', '-W':'', '-d':'', '-s':'public', 
-                  '-t':'', '-g':'', 'type':'unknown', 'srid':'', 'col':'' }
+                  '-t':'', '-g':'', 'type':'unknown', 'srid':'', 'col':'', 'overviews':[] }
 
-    opts, args = getopt.getopt( sys.argv[1:], 'h:p:U:W:d:s:t:g:', [] )
+    opts, args = getopt.getopt( argv[1:], 'h:p:U:W:d:s:t:g:', [ 'batch=', 'size=', 'extent=', 'workers=', 'snapshot=' ] )
     dictOpts.update( opts )
+
+    if '--batch' in dictOpts:
+        if not args:
+            print >> sys.stderr, 'E: Tables to render are required'
+            print __doc__
+            sys.exit( 1 )
+        size = tuple( int( value ) for value in dictOpts.get( '--size', '800x600' ).split( 'x' ) )
+        extent = tuple( float( value ) for value in dictOpts[ '--extent' ].split( ',' ) ) \
+            if '--extent' in dictOpts else None
+        workers = int( dictOpts.get( '--workers', multiprocessing.cpu_count() ) )
+        sys.exit( 1 if batchRender( dictOpts, args, dictOpts[ '--batch' ], size, extent, workers ) else 0 )
+
+    print 'I: Starting viewer ...'    
+    app = SingletonApp( argv )
     
-    if dictOpts['-t'] == '':
+    if '--snapshot' in dictOpts: # No database access
+        if not os.path.isfile( dictOpts['--snapshot'] ):
+            print >> sys.stderr, 'E: Snapshot not found:', dictOpts['--snapshot']
+            sys.exit( 1 )
+        dictOpts = snapshotOpts( dictOpts['--snapshot'], dictOpts )
+        bConnected = True
+    elif dictOpts['-t'] == '':
         print >> sys.stderr, 'E: Table name is required'
         print __doc__
         sys.exit( 1 )
-
-    d = QSqlDatabase.addDatabase( "QPSQL", "PgSQLDb" )
-    d.setHostName( dictOpts['-h'] )
-    d.setPort( int( dictOpts['-p'] ) )
-    d.setDatabaseName( dictOpts['-d'] )
-    d.setUserName( dictOpts['-U'] )
-    d.setPassword( dictOpts['-W'] )
-
-    if d.open():
-        print 'I: Database connection was succesfull'
-        
-        query = QSqlQuery( d )
-        query.exec_( "SELECT Count(srid) FROM raster_columns WHERE r_table_schema = '%s' AND r_table_name = '%s'" % ( dictOpts['-s'], dictOpts['-t'] ) )
-        
-        if query.next() and query.value( 0 ).toBool(): # Raster layer (WKTRaster)!            
-            query.exec_( "SELECT srid, r_raster_column FROM raster_columns \
-                          WHERE r_table_schema = '%s' AND \
-                          r_table_name = '%s' " % ( dictOpts['-s'], dictOpts['-t'] ) )
-            if query.next():
-                dictOpts[ 'srid' ] = str( query.value( 0 ).toString() )
-                dictOpts[ 'col' ] = str( query.value( 1 ).toString() )
-
-            dictOpts['type'] = 'raster'
-            print 'I: Raster layer detected'
-            
-        else: # Vector layer?            
-            query.exec_( "SELECT column_name FROM information_schema.columns \
-                    WHERE table_schema = '%s' AND \
-                    table_name = '%s' AND \
-                    udt_name = 'geometry' LIMIT 1" % ( dictOpts['-s'], dictOpts['-t'] ) )          
-
-            if not query.next(): # Geography layer?        
-                query.exec_( "SELECT column_name FROM information_schema.columns \
-                        WHERE table_schema = '%s' AND \
-                        table_name = '%s' AND \
-                        udt_name = 'geography' LIMIT 1" % ( dictOpts['-s'], dictOpts['-t'] ) )
-
-            if query.first(): # Vector layer!        
-                dictOpts[ '-g' ] = str( query.value( 0 ).toString() )
-
-                query.exec_( "SELECT srid FROM geometry_columns \
-                              WHERE f_table_schema = '%s' AND \
-                              f_table_name = '%s' " % ( dictOpts['-s'], dictOpts['-t'] ) )
-                if query.next():
-                    dictOpts[ 'srid' ] = str( query.value( 0 ).toString() )
-
-                dictOpts['type'] = 'vector'
-                print 'I: Vector layer detected'
-
+    else:
+        # The connection is given back to the broker, for the viewer to reuse it
+        with sharedDatabase( dictOpts ) as d:
+            bConnected = d.isOpen()
+            if bConnected:
+                print 'I: Database connection was succesfull'
+                
+                query = TracedQuery( d )
+                with tracing.span( "detect %s.%s" % ( dictOpts['-s'], dictOpts['-t'] ) ):
+                    detectLayerType( dictOpts, query )
+                del query
+
+    if bConnected:
         if not dictOpts[ 'type' ] == 'unknown': # The object is a layer
             if app.is_running:
                 # Application already running, send message to load data
@@ -1049,6 +3339,7 @@ def main( argv ):
                 retval = app.exec_()
 
                 # Exit
+                connections.broker.closeAll()
                 QgsApplication.exitQgis()
                 print 'I: Exiting ...'
                 sys.exit(retval)      
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of PostGIS raster tiles for the PostGIS Layer Viewer.
+
+Tiles are stored as GeoTIFF files (ST_AsGDALRaster) as the parts of a
+(connection, schema, table, column, overview level) are viewed. Each level
+remembers the georeference of the tiles listed so far and the extents where
+they were listed, so that a view whose tiles are cached gets a GDAL VRT mosaic
+of them (see extentVrt()) and QGIS draws it from local files without database
+access. A level is dropped when the token of its table changes (see levelToken()).
+Uncompressed GeoTIFFs are memory-mapped by GDAL (GTIFF_VIRTUAL_MEM_IO).
+
+License: GNU General Public License v2.0
+"""
+
+import os, pickle, hashlib, threading
+from collections import OrderedDict
+
+# PostGIS pixel types and the GDAL types ST_AsGDALRaster writes them as
+gdalDataTypes = { '1BB':'Byte', '2BUI':'Byte', '4BUI':'Byte', '8BUI':'Byte', '8BSI':'Int16',
+    '16BSI':'Int16', '16BUI':'UInt16', '32BSI':'Int32', '32BUI':'UInt32', '32BF':'Float32',
+    '64BF':'Float64' }
+gdalDataSizes = { 'Byte':1, 'Int16':2, 'UInt16':2, 'Int32':4, 'UInt32':4, 'Float32':4, 'Float64':8 }
+
+
+class RasterLevel:
+    """ What the cache knows about a level: token of its table, bands, SRS and listed tiles """
+    maxExtents = 64 # Listed extents remembered, the oldest ones are forgotten
+
+    def __init__( self, token, bands, srsWkt, srid ):
+        self.token = token
+        self.bands = bands # [ ( PostGIS pixel type, nodata value or None ) ]
+        self.srsWkt = srsWkt
+        self.srid = srid
+        self.tiles = {} # tileId -> [ upperLeftX, upperLeftY, scaleX, scaleY, skewX, skewY, width, height ]
+        self.extents = [] # ( xMin, yMin, xMax, yMax ) where all the tiles were listed, most recent last
+
+    def isListed( self, extent ):
+        return any( containsExtent( listed, extent ) for listed in self.extents )
+
+    def addListing( self, extent, tiles ):
+        self.tiles.update( tiles )
+        self.extents.append( tuple( extent ) )
+        del self.extents[ :-self.maxExtents ]
+
+    def tilesIn( self, extent ):
+        """ Return the ids of the listed tiles intersecting an extent """
+        xMin, yMin, xMax, yMax = extent
+        tileIds = []
+        for tileId, ( ulx, uly, sx, sy, skx, sky, width, height ) in self.tiles.iteritems():
+            x1, x2 = sorted( ( ulx, ulx + sx * width ) )
+            y1, y2 = sorted( ( uly, uly + sy * height ) )
+            if x1 <= xMax and x2 >= xMin and y1 <= yMax and y2 >= yMin:
+                tileIds.append( tileId )
+        return tileIds
+
+
+class RasterTileCache:
+    """ Size-bounded on-disk LRU cache of raster tiles, grouped by levels
+
+        levelKey: ( connection, schema, table, column, overview level )
+        tileId: Identifier of the tile in the table (ctid)
+        extent: ( xMin, yMin, xMax, yMax )
+    """
+    indexName = 'index.pickle'
+
+    def __init__( self, directory, maxBytes ):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.RLock() # Tiles are stored from worker threads
+        self.tiles = OrderedDict() # ( levelKey, tileId ) -> ( fileName, size ), LRU first
+        self.levels = {} # levelKey -> RasterLevel
+        self.pinned = {} # ( levelKey, tileId ) -> pins (tiles being drawn), never evicted
+        self.size = 0
+
+        if not os.path.isdir( self.directory ):
+            os.makedirs( self.directory )
+        self.load()
+
+    def load( self ):
+        """ Read the index, forgetting the tiles whose file is gone and removing the files
+            it doesn't list (e.g., tiles cached after the index was last saved, or VRTs)
+        """
+        try:
+            f = open( os.path.join( self.directory, self.indexName ), 'rb' )
+            try:
+                tiles, levels = pickle.load( f )
+            finally:
+                f.close()
+        except Exception:
+            tiles, levels = {}, {}
+
+        for levelKey, level in levels.items():
+            if isinstance( level, RasterLevel ): # Not from an older index
+                self.levels[ levelKey ] = level
+        for key, ( fileName, size ) in tiles.items():
+            if key[ 0 ] in self.levels and os.path.exists( os.path.join( self.directory, fileName ) ):
+                self.tiles[ key ] = ( fileName, size )
+                self.size += size
+
+        listed = set( fileName for fileName, size in self.tiles.values() )
+        listed.add( self.indexName )
+        for fileName in os.listdir( self.directory ):
+            if not fileName in listed:
+                self.removeFile( fileName )
+
+    def save( self ):
+        """ Write the index (write and rename, so that it is never left half written) """
+        with self.lock:
+            fileName = os.path.join( self.directory, self.indexName )
+            f = open( fileName + '.tmp', 'wb' )
+            try:
+                pickle.dump( ( self.tiles, self.levels ), f, pickle.HIGHEST_PROTOCOL )
+            finally:
+                f.close()
+            if os.name == "nt" and os.path.exists( fileName ):
+                os.remove( fileName )
+            os.rename( fileName + '.tmp', fileName )
+
+    def fileName( self, key ):
+        """ Return a file name for a tile or level key """
+        return hashlib.sha1( repr( key ) ).hexdigest()
+
+    def hasTile( self, levelKey, tileId ):
+        with self.lock:
+            return ( levelKey, tileId ) in self.tiles
+
+    def tilePath( self, levelKey, tileId ):
+        """ Return the path of a cached tile """
+        with self.lock:
+            return os.path.join( self.directory, self.tiles[ ( levelKey, tileId ) ][ 0 ] )
+
+    def putTile( self, levelKey, tileId, data ):
+        """ Store the GeoTIFF bytes of a tile, evicting old tiles if needed """
+        key = ( levelKey, tileId )
+        fileName = self.fileName( key ) + '.tif'
+        path = os.path.join( self.directory, fileName )
+        f = open( path + '.tmp', 'wb' )
+        try:
+            f.write( data )
+        finally:
+            f.close()
+        if os.name == "nt" and os.path.exists( path ):
+            os.remove( path )
+        os.rename( path + '.tmp', path )
+
+        with self.lock:
+            if key in self.tiles:
+                self.size -= self.tiles.pop( key )[ 1 ]
+            self.tiles[ key ] = ( fileName, len( data ) )
+            self.size += len( data )
+            self.evict()
+
+    def evict( self ):
+        """ Remove least recently used tiles until the cache fits in maxBytes """
+        with self.lock:
+            for key in list( self.tiles.keys() ):
+                if self.size <= self.maxBytes:
+                    break
+                if key in self.pinned:
+                    continue
+                fileName, size = self.tiles.pop( key )
+                self.size -= size
+                self.removeFile( fileName )
+
+    def removeFile( self, fileName ):
+        try:
+            os.remove( os.path.join( self.directory, fileName ) )
+        except OSError:
+            pass
+
+    def level( self, levelKey ):
+        """ Return the RasterLevel of a level, None if it's not in the cache """
+        with self.lock:
+            return self.levels.get( levelKey )
+
+    def setLevel( self, levelKey, token, bands, srsWkt, srid ):
+        """ Register a level (dropping its tiles if it was cached already), return its RasterLevel """
+        self.invalidate( levelKey )
+        with self.lock:
+            level = self.levels[ levelKey ] = RasterLevel( token, bands, srsWkt, srid )
+        self.save()
+        return level
+
+    def addListing( self, levelKey, extent, tiles ):
+        """ Record the georeference of all the tiles of a level within an extent """
+        with self.lock:
+            self.levels[ levelKey ].addListing( extent, tiles )
+
+    def tilesIn( self, levelKey, extent ):
+        """ Return the listed tiles ( tileId -> georeference ) of a level intersecting an extent """
+        with self.lock:
+            level = self.levels[ levelKey ]
+            return dict( ( tileId, level.tiles[ tileId ] ) for tileId in level.tilesIn( extent ) )
+
+    def covers( self, levelKey, extent ):
+        """ Check whether all the tiles of a level within an extent are cached """
+        with self.lock:
+            level = self.levels.get( levelKey )
+            if level is None or not level.isListed( extent ):
+                return False
+            for tileId in level.tilesIn( extent ):
+                if not ( levelKey, tileId ) in self.tiles:
+                    return False
+            return True
+
+    def extentVrt( self, levelKey, extent ):
+        """ Return ( VRT path, tile ids ) of a mosaic of the cached tiles of a level covering an
+            extent, ( None, [] ) if some tile is missing, there are none or they're not aligned.
+            The VRT is removed by removeVrt() once it's not drawn
+        """
+        with self.lock:
+            if not self.covers( levelKey, extent ):
+                return ( None, [] )
+            level = self.levels[ levelKey ]
+            tileIds = sorted( level.tilesIn( extent ) )
+            tiles = [ [ self.tilePath( levelKey, tileId ) ] + level.tiles[ tileId ] for tileId in tileIds ]
+            for tileId in tileIds: # Most recently used
+                self.tiles[ ( levelKey, tileId ) ] = self.tiles.pop( ( levelKey, tileId ) )
+            bands, srsWkt = level.bands, level.srsWkt
+        vrtXml = buildVrt( tiles, bands, srsWkt )
+        if not vrtXml:
+            return ( None, [] )
+        path = os.path.join( self.directory, 'view-%s.vrt' % self.fileName( ( levelKey, tileIds ) ) )
+        if not os.path.exists( path ):
+            f = open( path, 'w' )
+            try:
+                f.write( vrtXml )
+            finally:
+                f.close()
+        return ( path, tileIds )
+
+    def removeVrt( self, path ):
+        self.removeFile( os.path.basename( path ) )
+
+    def invalidate( self, levelKey ):
+        """ Remove a level and its tiles, e.g., when its table has changed """
+        with self.lock:
+            self.levels.pop( levelKey, None )
+            for key in list( self.tiles.keys() ):
+                if key[ 0 ] == levelKey:
+                    fileName, size = self.tiles.pop( key )
+                    self.size -= size
+                    self.removeFile( fileName )
+        self.save()
+
+    def pin( self, levelKey, tileIds ):
+        """ Keep tiles (e.g., of a VRT being drawn) from being evicted """
+        with self.lock:
+            for tileId in tileIds:
+                key = ( levelKey, tileId )
+                self.pinned[ key ] = self.pinned.get( key, 0 ) + 1
+
+    def unpin( self, levelKey, tileIds ):
+        """ Release the pins of tiles, they may be evicted once all their pins are released """
+        with self.lock:
+            for tileId in tileIds:
+                key = ( levelKey, tileId )
+                pins = self.pinned.pop( key, 0 ) - 1
+                if pins > 0:
+                    self.pinned[ key ] = pins
+
+
+def levelToken( values ):
+    """ Return a token of values that change whenever a table is written (see RasterCacheFiller) """
+    return hashlib.sha1( repr( tuple( values ) ) ).hexdigest()
+
+def containsExtent( outer, inner ):
+    return outer[ 0 ] <= inner[ 0 ] and outer[ 1 ] <= inner[ 1 ] and \
+        outer[ 2 ] >= inner[ 2 ] and outer[ 3 ] >= inner[ 3 ]
+
+def scaleExtent( extent, factor ):
+    """ Return an extent scaled by factor around its center """
+    xMin, yMin, xMax, yMax = extent
+    dx, dy = ( xMax - xMin ) * ( factor - 1 ) / 2, ( yMax - yMin ) * ( factor - 1 ) / 2
+    return ( xMin - dx, yMin - dy, xMax + dx, yMax + dy )
+
+def buildVrt( tiles, bands, srsWkt ):
+    """ Return the XML of a VRT mosaic of tiles, None if the tiles are not aligned
+
+        tiles: List of ( path, upperLeftX, upperLeftY, scaleX, scaleY, skewX, skewY, width, height )
+        bands: List of ( PostGIS pixel type, nodata value or None )
+    """
+    if not tiles:
+        return None
+    scaleX, scaleY = tiles[ 0 ][ 3 ], tiles[ 0 ][ 4 ]
+    for path, ulx, uly, sx, sy, skx, sky, width, height in tiles:
+        if skx or sky or sx != scaleX or sy != scaleY:
+            return None
+
+    minX = min( t[ 1 ] for t in tiles )
+    maxY = max( t[ 2 ] for t in tiles ) if scaleY < 0 else min( t[ 2 ] for t in tiles )
+    offsets = []
+    xSize = ySize = 0
+    for path, ulx, uly, sx, sy, skx, sky, width, height in tiles:
+        xOff = ( ulx - minX ) / scaleX
+        yOff = ( uly - maxY ) / scaleY
+        if abs( xOff - round( xOff ) ) > 1e-6 or abs( yOff - round( yOff ) ) > 1e-6:
+            return None # Not on the same grid
+        xOff, yOff = int( round( xOff ) ), int( round( yOff ) )
+        offsets.append( ( xOff, yOff ) )
+        xSize = max( xSize, xOff + width )
+        ySize = max( ySize, yOff + height )
+
+    xml = [ '<VRTDataset rasterXSize="%d" rasterYSize="%d">' % ( xSize, ySize ) ]
+    if srsWkt:
+        xml.append( '  <SRS>%s</SRS>' % srsWkt.replace( '&', '&amp;' ).replace( '<', '&lt;' ).replace( '>', '&gt;' ).replace( '"', '&quot;' ) )
+    xml.append( '  <GeoTransform>%r, %r, 0.0, %r, 0.0, %r</GeoTransform>' % ( minX, scaleX, maxY, scaleY ) )
+    for b, ( pixelType, nodata ) in enumerate( bands ):
+        xml.append( '  <VRTRasterBand dataType="%s" band="%d">' % ( gdalDataTypes.get( pixelType, 'Float64' ), b + 1 ) )
+        if nodata is not None:
+            xml.append( '    <NoDataValue>%r</NoDataValue>' % nodata )
+        for ( path, ulx, uly, sx, sy, skx, sky, width, height ), ( xOff, yOff ) in zip( tiles, offsets ):
+            xml.append( '    <SimpleSource>' )
+            xml.append( '      <SourceFilename relativeToVRT="1">%s</SourceFilename>' % os.path.basename( path ) )
+            xml.append( '      <SourceBand>%d</SourceBand>' % ( b + 1 ) )
+            xml.append( '      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>' % ( width, height ) )
+            xml.append( '      <DstRect xOff="%d" yOff="%d" xSize="%d" ySize="%d"/>' % ( xOff, yOff, width, height ) )
+            xml.append( '    </SimpleSource>' )
+        xml.append( '  </VRTRasterBand>' )
+    xml.append( '</VRTDataset>' )
+    return '\n'.join( xml ) + '\n'
+
+def levelBytes( tiles, bands ):
+    """ Estimate the size of the uncompressed tiles of a level (tiles end with width, height) """
+    pixelSize = sum( gdalDataSizes[ gdalDataTypes.get( pixelType, 'Float64' ) ] for pixelType, nodata in bands )
+    return sum( t[ -2 ] * t[ -1 ] for t in tiles ) * pixelSize
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Static packed Hilbert R-tree for the PostGIS Layer Viewer.
+
+The tree is built in bulk: the boxes of the items are added, then finish() sorts
+them by the Hilbert value of their centers and packs them in nodes of nodeSize
+boxes, level by level up to the root. All the boxes and node links are kept in
+two flat arrays (no objects per item or node), so millions of items take a few
+tens of MB and a query only visits the nodes intersecting its box.
+
+    tree = PackedRTree( len( boxes ) )
+    for minX, minY, maxX, maxY in boxes:
+        tree.add( minX, minY, maxX, maxY )
+    tree.finish()
+    tree.search( minX, minY, maxX, maxY ) # Indexes (in order of add()) of the items intersecting
+
+License: GNU General Public License v2.0
+"""
+
+import math
+from array import array
+
+hilbert_max = ( 1 << 16 ) - 1 # Centers are scaled to a hilbert_max x hilbert_max grid
+
+
+def hilbert( x, y ):
+    """ Return the Hilbert curve index of a cell ( x, y ) of a 2^16 x 2^16 grid """
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ ( x | y )
+    d = x & ( y ^ 0xFFFF )
+
+    A = a | ( b >> 1 )
+    B = ( a >> 1 ) ^ a
+    C = ( ( c >> 1 ) ^ ( b & ( d >> 1 ) ) ) ^ c
+    D = ( ( a & ( c >> 1 ) ) ^ ( d >> 1 ) ) ^ d
+
+    a, b, c, d = A, B, C, D
+    A = ( a & ( a >> 2 ) ) ^ ( b & ( b >> 2 ) )
+    B = ( a & ( b >> 2 ) ) ^ ( b & ( ( a ^ b ) >> 2 ) )
+    C ^= ( a & ( c >> 2 ) ) ^ ( b & ( d >> 2 ) )
+    D ^= ( b & ( c >> 2 ) ) ^ ( ( a ^ b ) & ( d >> 2 ) )
+
+    a, b, c, d = A, B, C, D
+    A = ( a & ( a >> 4 ) ) ^ ( b & ( b >> 4 ) )
+    B = ( a & ( b >> 4 ) ) ^ ( b & ( ( a ^ b ) >> 4 ) )
+    C ^= ( a & ( c >> 4 ) ) ^ ( b & ( d >> 4 ) )
+    D ^= ( b & ( c >> 4 ) ) ^ ( ( a ^ b ) & ( d >> 4 ) )
+
+    a, b, c, d = A, B, C, D
+    C ^= ( a & ( c >> 8 ) ) ^ ( b & ( d >> 8 ) )
+    D ^= ( b & ( c >> 8 ) ) ^ ( ( a ^ b ) & ( d >> 8 ) )
+
+    a = C ^ ( C >> 1 )
+    b = D ^ ( D >> 1 )
+    i0 = x ^ y
+    i1 = b | ( 0xFFFF ^ ( i0 | a ) )
+    return ( interleave( i1 ) << 1 ) | interleave( i0 )
+
+def interleave( x ):
+    """ Spread the 16 bits of x to the even bits of a 32 bits value """
+    x = ( x | ( x << 8 ) ) & 0x00FF00FF
+    x = ( x | ( x << 4 ) ) & 0x0F0F0F0F
+    x = ( x | ( x << 2 ) ) & 0x33333333
+    return ( x | ( x << 1 ) ) & 0x55555555
+
+
+class PackedRTree:
+    """ Static packed Hilbert R-tree (see the module docstring)
+
+        boxes: minX, minY, maxX, maxY of the items (sorted once finished), then of the nodes
+        indices: per box, the index of the item (leaves) or the position in boxes of the
+            first child (nodes)
+    """
+    def __init__( self, numItems, nodeSize=16 ):
+        self.numItems = numItems
+        self.nodeSize = max( nodeSize, 2 )
+
+        # Positions in boxes where each level ends, leaves first
+        n = numItems
+        numNodes = n
+        self.levelBounds = [ n * 4 ]
+        while n > 1:
+            n = int( math.ceil( float( n ) / self.nodeSize ) )
+            numNodes += n
+            self.levelBounds.append( numNodes * 4 )
+
+        self.boxes = array( 'd', [ 0.0 ] ) * ( numNodes * 4 )
+        self.indices = array( 'l', [ 0 ] ) * numNodes
+        self.pos = 0
+        self.minX = self.minY = float( 'inf' )
+        self.maxX = self.maxY = float( '-inf' )
+
+    def add( self, minX, minY, maxX, maxY ):
+        """ Add the box of an item, return its index """
+        index = self.pos >> 2
+        self.indices[ index ] = index
+        self.boxes[ self.pos:self.pos + 4 ] = array( 'd', ( minX, minY, maxX, maxY ) )
+        self.pos += 4
+        self.minX = min( self.minX, minX )
+        self.minY = min( self.minY, minY )
+        self.maxX = max( self.maxX, maxX )
+        self.maxY = max( self.maxY, maxY )
+        return index
+
+    def finish( self ):
+        """ Sort the items along the Hilbert curve and build the nodes above them """
+        if self.pos >> 2 != self.numItems:
+            raise ValueError( "Added %d items instead of %d" % ( self.pos >> 2, self.numItems ) )
+        boxes = self.boxes
+        n = self.numItems
+        if n > self.nodeSize:
+            width = ( self.maxX - self.minX ) or 1.0
+            height = ( self.maxY - self.minY ) or 1.0
+            values = [ hilbert(
+                int( hilbert_max * ( ( boxes[ i ] + boxes[ i + 2 ] ) / 2 - self.minX ) / width ),
+                int( hilbert_max * ( ( boxes[ i + 1 ] + boxes[ i + 3 ] ) / 2 - self.minY ) / height ) )
+                for i in xrange( 0, n * 4, 4 ) ]
+            order = sorted( xrange( n ), key=values.__getitem__ )
+            sortedBoxes = array( 'd' )
+            for i in order:
+                sortedBoxes.extend( boxes[ i * 4:i * 4 + 4 ] )
+            boxes[ :n * 4 ] = sortedBoxes
+            self.indices[ :n ] = array( 'l', order )
+
+        # Each node gets the union of the boxes of its children
+        pos = 0
+        for end in self.levelBounds[ :-1 ]:
+            while pos < end:
+                nodeIndex = pos
+                nodeMinX, nodeMinY = boxes[ pos ], boxes[ pos + 1 ]
+                nodeMaxX, nodeMaxY = boxes[ pos + 2 ], boxes[ pos + 3 ]
+                pos += 4
+                for i in xrange( 1, self.nodeSize ):
+                    if pos >= end:
+                        break
+                    nodeMinX = min( nodeMinX, boxes[ pos ] )
+                    nodeMinY = min( nodeMinY, boxes[ pos + 1 ] )
+                    nodeMaxX = max( nodeMaxX, boxes[ pos + 2 ] )
+                    nodeMaxY = max( nodeMaxY, boxes[ pos + 3 ] )
+                    pos += 4
+                self.indices[ self.pos >> 2 ] = nodeIndex
+                boxes[ self.pos:self.pos + 4 ] = array( 'd', ( nodeMinX, nodeMinY, nodeMaxX, nodeMaxY ) )
+                self.pos += 4
+
+    def search( self, minX, minY, maxX, maxY ):
+        """ Return the indexes of the items whose box intersects a box """
+        if not self.numItems:
+            return []
+        boxes, indices = self.boxes, self.indices
+        leavesEnd = self.numItems * 4
+        results = []
+        queue = []
+        nodeIndex = len( boxes ) - 4 # Root
+        while True:
+            # The children of a node are nodeSize boxes at most, within its level
+            levelEnd = min( bound for bound in self.levelBounds if bound > nodeIndex )
+            end = min( nodeIndex + self.nodeSize * 4, levelEnd )
+            for pos in xrange( nodeIndex, end, 4 ):
+                if maxX < boxes[ pos ] or maxY < boxes[ pos + 1 ] or \
+                        minX > boxes[ pos + 2 ] or minY > boxes[ pos + 3 ]:
+                    continue
+                if nodeIndex < leavesEnd:
+                    results.append( indices[ pos >> 2 ] )
+                else:
+                    queue.append( indices[ pos >> 2 ] )
+            if not queue:
+                return results
+            nodeIndex = queue.pop()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Round-trip tracing for the PostGIS Layer Viewer and its plugins.
+
+Every user action (opening a table, running a query, ...) is a span, and the
+SQL statements run while it's active, either by the viewer (QSqlQuery), the
+plugins (GeoDB) or QGIS providers (when they report them), are attributed to
+it with their duration. Work started by the action in other threads is
+attributed to it as well (see attach() and resume()). Once the action and its
+background work are finished, a summary is written to the trace log.
+
+Tracing is enabled by the POSTGIS_VIEWER_TRACE environment variable, which is
+either the path of the log file, '-' for stderr or '1' for the default log
+(~/.postgis_viewer/trace.log).
+
+License: GNU General Public License v2.0
+"""
+
+import os, sys, time, threading
+
+default_log = os.path.join( os.path.expanduser( "~" ), ".postgis_viewer", "trace.log" )
+max_statement_length = 200 # Statements are truncated in the log
+
+enabled = bool( os.environ.get( "POSTGIS_VIEWER_TRACE" ) )
+local = threading.local() # Active span of each thread
+lock = threading.Lock()
+
+
+class Span:
+    """ A user action and the statements it caused """
+    def __init__( self, name ):
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.statements = [] # ( source, statement, seconds )
+        self.pending = 1 # The action itself plus its background work
+
+    def record( self, source, statement, seconds ):
+        with lock:
+            self.statements.append( ( source, statement, seconds ) )
+
+    def attach( self ):
+        """ Register background work of the action """
+        with lock:
+            self.pending += 1
+        return self
+
+    def detach( self ):
+        """ Finish the action or some of its background work, writing the summary at the end """
+        with lock:
+            self.pending -= 1
+            if self.pending:
+                return
+            self.end = time.time()
+        writeSummary( self )
+
+    def summary( self ):
+        """ Return the lines of the summary of the span """
+        sources = {}
+        for source, statement, seconds in self.statements:
+            count, total = sources.get( source, ( 0, 0.0 ) )
+            sources[ source ] = ( count + 1, total + seconds )
+        lines = [ "%s %s: %d statements, %.1f ms in SQL, %.1f ms total (%s)" % (
+            time.strftime( "%Y-%m-%d %H:%M:%S", time.localtime( self.start ) ), self.name,
+            len( self.statements ), sum( s[ 2 ] for s in self.statements ) * 1000,
+            ( self.end - self.start ) * 1000, ", ".join( "%s %d / %.1f ms" % ( source, count, total * 1000 )
+            for source, ( count, total ) in sorted( sources.items() ) ) or "no SQL" ) ]
+        for source, statement, seconds in self.statements:
+            statement = " ".join( unicode( statement ).split() )
+            if len( statement ) > max_statement_length:
+                statement = statement[ :max_statement_length ] + "..."
+            lines.append( "    %8.1f ms  %-8s %s" % ( seconds * 1000, source, statement ) )
+        return lines
+
+
+class SpanContext:
+    """ Make a span (new or resumed) the active one of the thread while in a with block """
+    def __init__( self, span, bOwner ):
+        self.span = span
+        self.bOwner = bOwner # Whether the block is the whole action (or background work)
+
+    def __enter__( self ):
+        self.previous = getattr( local, 'span', None )
+        local.span = self.span
+        return self.span
+
+    def __exit__( self, excType, excValue, traceback ):
+        local.span = self.previous
+        if self.span and self.bOwner:
+            self.span.detach()
+        return False
+
+
+def currentSpan():
+    return getattr( local, 'span', None )
+
+def span( name ):
+    """ Start a user action (with block). Nested actions belong to the outer one """
+    if not enabled or currentSpan():
+        return SpanContext( currentSpan(), False )
+    return SpanContext( Span( name ), True )
+
+def attach():
+    """ Return the active span, registering background work for it (see resume()) """
+    current = currentSpan()
+    return current.attach() if current else None
+
+def resume( attachedSpan ):
+    """ Make an attached span active in another thread, until the end of the with block """
+    return SpanContext( attachedSpan, True )
+
+def record( source, statement, seconds ):
+    """ Attribute a statement to the active span """
+    current = currentSpan()
+    if current:
+        current.record( source, statement, seconds )
+
+def writeSummary( finishedSpan ):
+    target = os.environ.get( "POSTGIS_VIEWER_TRACE" )
+    text = "\n".join( finishedSpan.summary() ) + "\n"
+    if target == '-':
+        sys.stderr.write( text.encode( 'utf-8' ) )
+        return
+    path = default_log if target == '1' else target
+    try:
+        directory = os.path.dirname( path )
+        if directory and not os.path.isdir( directory ):
+            os.makedirs( directory )
+        f = open( path, 'a' )
+        try:
+            f.write( text.encode( 'utf-8' ) )
+        finally:
+            f.close()
+    except EnvironmentError, e:
+        print 'W: Trace could not be written:', e